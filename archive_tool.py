@@ -0,0 +1,124 @@
+import argparse
+import glob, os
+import sys
+from core.sgf_parser import SgfError, iter_named_games
+from core.game_archive import GameArchive, GameArchiveWriter
+
+def list_sgf_files(paths):
+    # The SGF files of the paths. A directory gives its *.sgf files.
+    filenames = list()
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(sorted(glob.glob(os.path.join(path, "*.sgf"))))
+        else:
+            filenames.append(path)
+    return filenames
+
+def pack_file(writer, filename):
+    # Pack the games of one SGF file. Name the games by the byte offset if
+    # it is a collection. Return the errors, [ (offset, error) ].
+    errors = list()
+    for offset, name, game in iter_named_games(filename, errors, os.path.basename(filename)):
+        try:
+            writer.add(game, name)
+        except SgfError as err:
+            errors.append((offset, str(err)))
+    return errors
+
+def pack(args):
+    # SGF files and directories to one archive. Every game of a collection
+    # is one record.
+    num_errors = 0
+    with GameArchiveWriter(args.archive) as writer:
+        for filename in list_sgf_files(args.inputs):
+            errors = pack_file(writer, filename)
+            for offset, err in errors:
+                sys.stderr.write("Skip the game {}#{}: {}\n".format(filename, offset, err))
+            num_errors += len(errors)
+        print("Pack {} games into {}, skip {}.".format(len(writer), args.archive, num_errors))
+
+def unpack(args):
+    # One archive back to the SGF files. Use the original name if there
+    # is one, or the collection file with --collection.
+    with GameArchive(args.archive) as archive:
+        if args.collection is not None:
+            with open(args.collection, "w", encoding="utf-8") as f:
+                for i in range(len(archive)):
+                    f.write(archive.game(i).to_sgf())
+            print("Unpack {} games into {}.".format(len(archive), args.collection))
+            return
+        if not os.path.isdir(args.out_dir):
+            os.makedirs(args.out_dir)
+        used = set()
+        for i in range(len(archive)):
+            name = archive.metadata(i).get("name", "game-{}".format(i))
+            name = name.replace("#", "-").replace(os.sep, "-")
+            if name.endswith(".sgf"):
+                name = name[:-4]
+            base = name
+            idx = 1
+            while name in used:
+                # The games of different directories may share the name.
+                name = "{}-{}".format(base, idx)
+                idx += 1
+            used.add(name)
+            with open(os.path.join(args.out_dir, name + ".sgf"), "w", encoding="utf-8") as f:
+                f.write(archive.game(i).to_sgf())
+        print("Unpack {} games into {}.".format(len(archive), args.out_dir))
+
+def info(args):
+    with GameArchive(args.archive) as archive:
+        counts = dict()
+        for s in archive.board_sizes:
+            counts[s] = counts.get(s, 0) + 1
+        print("{}: {} games".format(args.archive, len(archive)))
+        for s in sorted(counts.keys()):
+            print("  {}x{}: {} games".format(s, s, counts[s]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+
+    pack_parser = subparsers.add_parser("pack", help="Pack the SGF files into one archive.")
+    pack_parser.add_argument("archive",
+                             type=str,
+                             metavar="<archive>",
+                             help="The archive to write.")
+    pack_parser.add_argument("inputs",
+                             type=str,
+                             nargs="+",
+                             metavar="<path-to-SGF>",
+                             help="The SGF files or directories.")
+
+    unpack_parser = subparsers.add_parser("unpack", help="Write the archive back to the SGF files.")
+    unpack_parser.add_argument("archive",
+                               type=str,
+                               metavar="<archive>",
+                               help="The archive to read.")
+    unpack_parser.add_argument("out_dir",
+                               type=str,
+                               nargs="?",
+                               metavar="<path>",
+                               default=".",
+                               help="Write one SGF file for each game here.")
+    unpack_parser.add_argument("--collection",
+                               type=str,
+                               metavar="<path>",
+                               default=None,
+                               help="Write all games into this one SGF collection instead.")
+
+    info_parser = subparsers.add_parser("info", help="Show the games of the archive.")
+    info_parser.add_argument("archive",
+                             type=str,
+                             metavar="<archive>",
+                             help="The archive to read.")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        pack(args)
+    elif args.command == "unpack":
+        unpack(args)
+    elif args.command == "info":
+        info(args)
+    else:
+        parser.print_help()
@@ -0,0 +1,123 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from core.gtp import Query, GtpResponseHandler, GtpStreamReader
+
+ANALYSIS_LINE = \
+    "info move D4 visits 1024 winrate 5123 prior 1000 lcb 4900 order 0 pv D4 Q16 D16 Q4 " \
+    "info move Q16 visits 512 winrate 5011 prior 900 lcb 4800 order 1 pv Q16 D4 Q4 D16 " \
+    "info move C3 visits 128 winrate 4711 prior 100 lcb 4500 order 2 pv C3 D4"
+
+def make_stream(num_responses, analysis_lines):
+    # Every other query is a lz-analyze response with many lines, the
+    # others are normal one-line responses.
+    commands = list()
+    out = list()
+    for i in range(num_responses):
+        if i % 2 == 0:
+            commands.append("lz-analyze 10\n")
+            out.append("=\n")
+            out.extend([ "{}\n".format(ANALYSIS_LINE) ] * analysis_lines)
+            out.append("\n")
+        else:
+            commands.append("genmove b\n")
+            out.append("= D4\n\n")
+    return commands, "".join(out)
+
+def run_engine(path, text):
+    return subprocess.Popen(
+        ["cat", path],
+        stdout=subprocess.PIPE,
+        text=text
+    )
+
+def bench_text_readline(path, commands):
+    # The former text mode path of GTPEnginePipe._handle_gtp_loop.
+    engine = run_engine(path, True)
+    finished, analysis = list(), list()
+    wait_queue = [ Query(c) for c in commands ]
+    handling_query = None
+    receiving_analysis = False
+    start = time.perf_counter()
+    while len(wait_queue) > 0 or handling_query is not None:
+        if handling_query is None:
+            handling_query = wait_queue.pop(0)
+            main_command = handling_query.get_main_command()
+            if len(main_command.split("-")) <= 2 and \
+                   main_command.split("-")[-1] in ["analyze", "analyze_genmove"]:
+                receiving_analysis = True
+        line = engine.stdout.readline().strip()
+        if not line:
+            if receiving_analysis:
+                analysis.append({"type" : "end", "data" : None})
+                receiving_analysis = False
+            finished.append(handling_query)
+            handling_query = None
+            continue
+        if line.split()[0] in ["=", "?"] and \
+               handling_query.result is None:
+            handling_query.result = line.split()[0]
+            line = line[1:].strip()
+        if receiving_analysis and len(line) > 0:
+            analysis_out = {"type" : "info", "data" : line}
+            if "play" in line:
+                analysis_out["type"] = "play"
+            analysis.append(analysis_out)
+        handling_query.append_raw(line.encode())
+    elapsed = time.perf_counter() - start
+    engine.wait()
+    return elapsed, len(finished), len(analysis)
+
+def bench_bytes_chunk(path, commands):
+    engine = run_engine(path, False)
+    finished, analysis = list(), list()
+    wait_queue = [ Query(c) for c in commands ]
+    wait_queue.reverse()
+    reader = GtpStreamReader(
+        GtpResponseHandler(finished.append, analysis.append),
+        lambda: wait_queue.pop() if len(wait_queue) > 0 else None
+    )
+    start = time.perf_counter()
+    while True:
+        data = engine.stdout.read1(GtpStreamReader.READ_SIZE)
+        if not data:
+            reader.close()
+            break
+        reader.feed(data)
+    elapsed = time.perf_counter() - start
+    engine.wait()
+    return elapsed, len(finished), len(analysis)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-responses",
+                        type=int,
+                        metavar="<int>",
+                        default=20000,
+                        help="The number of GTP responses.")
+    parser.add_argument("-l", "--analysis-lines",
+                        type=int,
+                        metavar="<int>",
+                        default=20,
+                        help="The number of lines for each analysis response.")
+    args = parser.parse_args()
+
+    commands, stream = make_stream(args.num_responses, args.analysis_lines)
+    with tempfile.NamedTemporaryFile("w", suffix=".gtp", delete=False) as f:
+        f.write(stream)
+        path = f.name
+    try:
+        size = os.path.getsize(path) / (1024 * 1024)
+        print("Stream size: {:.2f} MB, {} responses.".format(size, len(commands)))
+        for name, fn in [("text readline", bench_text_readline),
+                         ("bytes chunk", bench_bytes_chunk)]:
+            elapsed, num_finished, num_analysis = fn(path, commands)
+            print("{:>14}: {:.3f} sec, {:.2f} MB/s, {} responses, {} analysis lines".format(
+                      name, elapsed, size / elapsed, num_finished, num_analysis))
+    finally:
+        os.remove(path)
@@ -0,0 +1,131 @@
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from core.sgf_loader import SgfLoader
+from core.sgf_parser import parse_sgf_games, SgfCollection
+
+def make_archive(num_games, board_size, num_moves, seed=0):
+    # One SGF collection of random games. Some nodes carry a comment.
+    # There is no escape and no setup stone, so the former loop can
+    # parse it too.
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrs"
+    games = list()
+    for i in range(num_games):
+        buf = [ "(;GM[1]FF[4]SZ[{}]KM[7.5]PB[black-{}]PW[white-{}]RE[B+R]".format(
+                    board_size, i, i) ]
+        for m in range(num_moves):
+            color = "B" if m % 2 == 0 else "W"
+            point = letters[rng.randrange(board_size)] + letters[rng.randrange(board_size)]
+            buf.append(";{}[{}]".format(color, point))
+            if rng.random() < 0.05:
+                buf.append("C[visits {} winrate {:.4f}]".format(
+                               rng.randrange(100000), rng.random()))
+        buf.append(")\n")
+        games.append("".join(buf))
+    return "".join(games)
+
+def bench_loop(text):
+    # The former SgfLoader._parse, one character at a time.
+    loader = SgfLoader.__new__(SgfLoader)
+    loader.history = list()
+    loader.black_player = str()
+    loader.white_player = str()
+    loader.board_size = None
+    loader.komi = None
+    start = time.perf_counter()
+    loader._parse(text)
+    return time.perf_counter() - start, len(loader.history)
+
+def bench_tokenizer(text):
+    start = time.perf_counter()
+    games = parse_sgf_games(text)
+    elapsed = time.perf_counter() - start
+    return elapsed, sum([ len(g.moves) for g in games ])
+
+def bench_stream(text):
+    # Stream the games from the file, one at a time.
+    with tempfile.NamedTemporaryFile(suffix=".sgf") as f:
+        # Write it in chunks. One encoded copy would show up in the peak
+        # memory.
+        for i in range(0, len(text), 1024 * 1024):
+            f.write(text[i:i + 1024 * 1024].encode())
+        f.flush()
+        start = time.perf_counter()
+        num_moves = 0
+        with SgfCollection(f.name) as collection:
+            for _, _, game in collection:
+                num_moves += len(game.moves)
+        return time.perf_counter() - start, num_moves
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def peak_memory(fn, text):
+    # The peak Python allocation of one phase in MB, without the input
+    # text. Traced in a second run, so the timing is not slowed down.
+    tracemalloc.start()
+    try:
+        fn(text)
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+def bench_big_file(filename):
+    # Stream a file on the disk and show the resident size on the way.
+    start = time.perf_counter()
+    num_games = 0
+    with SgfCollection(filename) as collection:
+        for _, _, game in collection:
+            num_games += 1
+            if num_games % 50000 == 0:
+                print("{} games, {:.1f} sec, max RSS {:.0f} MB".format(
+                          num_games, time.perf_counter() - start, max_rss()))
+    print("{} games, {:.1f} sec, {:.2f} MB/s".format(
+              num_games, time.perf_counter() - start,
+              os.path.getsize(filename) / (1024 * 1024) / (time.perf_counter() - start)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-games",
+                        type=int,
+                        metavar="<int>",
+                        default=20000,
+                        help="The number of games in the archive.")
+    parser.add_argument("-m", "--num-moves",
+                        type=int,
+                        metavar="<int>",
+                        default=250,
+                        help="The number of moves for each game.")
+    parser.add_argument("-b", "--boardsize",
+                        type=int,
+                        metavar="<int>",
+                        default=19,
+                        help="The board size of the games.")
+    parser.add_argument("-f", "--file",
+                        type=str,
+                        metavar="<string>",
+                        default=None,
+                        help="Only stream this SGF collection.")
+    args = parser.parse_args()
+
+    if args.file is not None:
+        bench_big_file(args.file)
+        sys.exit(0)
+
+    text = make_archive(args.num_games, args.boardsize, args.num_moves)
+    size = len(text.encode()) / (1024 * 1024)
+    print("Archive size: {:.2f} MB, {} games.".format(size, args.num_games))
+    for name, fn in [("char loop", bench_loop),
+                     ("tokenizer", bench_tokenizer),
+                     ("stream", bench_stream)]:
+        elapsed, num_moves = fn(text)
+        print("{:>10}: {:.3f} sec, {:.2f} MB/s, {} moves, peak memory {:.1f} MB".format(
+                  name, elapsed, size / elapsed, num_moves, peak_memory(fn, text)))
@@ -0,0 +1,74 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from core.writer import BackgroundWriter
+
+SGF = "(;GM[1]FF[4]SZ[19]KM[7.5]" + ";B[pd];W[dp]" * 120 + ")"
+PGN = "[White \"A\"]\n[Black \"B\"]\n[Result \"1-0\"]\n\n1-0\n\n"
+RESULT = "[ name ] : [ Elo ] -> [ black (W/D/L) ] [ white (W/D/L) ]\n" * 8
+
+def save_sync(save_dir, i, fsync):
+    # The former way, every file is opened and written on the game thread.
+    def write(path, mode, data):
+        with open(path, mode) as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+    write(os.path.join(save_dir, "game-{}.sgf".format(i)), "w", SGF)
+    write(os.path.join(save_dir, "result.pgn"), "a", PGN)
+    write(os.path.join(save_dir, "result.txt"), "w", RESULT)
+
+def bench(num_games, fsync, background, batch_size):
+    save_dir = tempfile.mkdtemp()
+    try:
+        writer = None
+        if background:
+            writer = BackgroundWriter(fsync_interval=0 if fsync else None, batch_size=batch_size)
+        waits = list()
+        start = time.perf_counter()
+        for i in range(num_games):
+            t = time.perf_counter()
+            if writer is None:
+                save_sync(save_dir, i, fsync)
+            else:
+                writer.create(os.path.join(save_dir, "game-{}.sgf".format(i)), SGF)
+                writer.append(os.path.join(save_dir, "result.pgn"), PGN)
+                writer.replace(os.path.join(save_dir, "result.txt"), RESULT)
+            waits.append(time.perf_counter() - t)
+        caller = time.perf_counter() - start
+        if writer is not None:
+            writer.close()
+        total = time.perf_counter() - start
+        waits.sort()
+        return caller, waits[int(len(waits) * 0.99)], waits[-1], total
+    finally:
+        shutil.rmtree(save_dir)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--num-games",
+                        type=int,
+                        metavar="<int>",
+                        default=5000,
+                        help="The number of saved games.")
+    parser.add_argument("--fsync",
+                        default=False,
+                        action="store_true",
+                        help="Fsync the files.")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        metavar="<int>",
+                        default=32,
+                        help="The batch size of the background writer.")
+    args = parser.parse_args()
+
+    for name, background in [("sync", False), ("background", True)]:
+        caller, p99, worst, total = bench(args.num_games, args.fsync, background, args.batch_size)
+        print("{:>10}: game thread {:.1f} us/game (p99 {:.2f} ms, worst {:.2f} ms), total {:.0f} games/sec".format(
+                  name, caller / args.num_games * 1e6, p99 * 1e3, worst * 1e3, args.num_games / total))
@@ -0,0 +1,210 @@
+import json
+from array import array
+from .gtp import GtpVertex
+
+def _build_vertex_table():
+    # Map every vertex string to its compact index once. Parsing a long
+    # pv should not create a GtpVertex for each move.
+    table = dict()
+    size = GtpVertex.MAX_BOARD_SIZE
+    for y in range(size):
+        for x in range(size):
+            vtx = GtpVertex((x, y))
+            vstr = str(vtx)
+            table[vstr] = vtx.to_index()
+            table[vstr.lower()] = vtx.to_index()
+    for vstr in [GtpVertex.PASS_STR, GtpVertex.RESIGN_STR, GtpVertex.NULL_STR]:
+        index = GtpVertex(vstr).to_index()
+        table[vstr] = index
+        table[vstr.upper()] = index
+    return table
+
+VERTEX_INDEX = _build_vertex_table()
+
+class AnalysisInfo:
+    __slots__ = ["move", "visits", "winrate", "score_lead", "prior", "lcb", "order", "pv"]
+
+    def __init__(self):
+        self.move = GtpVertex.NULL_INDEX
+        self.visits = 0
+        self.winrate = None # 0 ~ 1, the side to move
+        self.score_lead = None
+        self.prior = None
+        self.lcb = None
+        self.order = None
+        self.pv = array("H")
+
+    def get_move(self):
+        return GtpVertex.from_index(self.move)
+
+    def get_pv(self):
+        return [ GtpVertex.from_index(i) for i in self.pv ]
+
+    def __str__(self):
+        out = "move {} visits {}".format(self.get_move(), self.visits)
+        if self.winrate is not None:
+            out += " winrate {:.4f}".format(self.winrate)
+        if self.score_lead is not None:
+            out += " scoreLead {:.2f}".format(self.score_lead)
+        out += " pv {}".format(" ".join([ str(v) for v in self.get_pv() ]))
+        return out
+
+class AnalysisParser:
+    # Parse the lz-analyze, kata-analyze and cgos-analyze output into the
+    # AnalysisInfo records. The mode is the command prefix, e.g. "lz".
+    # The winrate of lz-analyze is 0 ~ 10000. If the mode is unknown, the
+    # line is kata-analyze if it has any KataGo-only key.
+    LIST_KEYS = {
+        "pv",
+        "pvVisits",
+        "pvEdgeVisits",
+        "ownership",
+        "ownershipStdev",
+        "movesOwnership",
+        "movesOwnershipStdev"
+    }
+    # The sections which don't belong to the move, e.g. the rootInfo of
+    # kata-analyze. Skip them until the next "info".
+    SKIP_SECTIONS = {
+        "rootInfo"
+    }
+
+    KATA_KEYS = {
+        "utility",
+        "scoreMean",
+        "scoreLead",
+        "scoreStdev",
+        "scoreSelfplay"
+    }
+
+    def __init__(self, mode=None):
+        self.mode = mode
+
+    def _line_mode(self, tokens):
+        if self.mode is not None:
+            return self.mode
+        for token in tokens:
+            if token in self.KATA_KEYS:
+                return "kata"
+        return "lz"
+
+    def parse(self, line):
+        if isinstance(line, bytes):
+            line = line.decode(errors="replace")
+        line = line.strip()
+        if line.startswith("{"):
+            return self._parse_json(line)
+        return self._parse_tokens(line.split())
+
+    @staticmethod
+    def _is_number(token):
+        try:
+            float(token)
+        except ValueError:
+            return False
+        return True
+
+    def _parse_tokens(self, tokens):
+        infos = list()
+        info = None
+        idx = 0
+        size = len(tokens)
+        scale = 10000. if self._line_mode(tokens) == "lz" else 1.
+
+        while idx < size:
+            key = tokens[idx]
+            idx += 1
+            if key == "info":
+                info = AnalysisInfo()
+                infos.append(info)
+                continue
+            if key in self.SKIP_SECTIONS:
+                info = None
+                continue
+
+            if key in self.LIST_KEYS:
+                # The pv ends at the first token which is not a vertex,
+                # the other lists at the first one which is not a number.
+                end = idx
+                if key == "pv":
+                    while end < size and tokens[end] in VERTEX_INDEX:
+                        end += 1
+                else:
+                    while end < size and self._is_number(tokens[end]):
+                        end += 1
+                if key == "pv" and info is not None:
+                    info.pv = array("H", [ VERTEX_INDEX[v] for v in tokens[idx:end] ])
+                idx = end
+                continue
+
+            if idx >= size or info is None:
+                continue
+            val = tokens[idx]
+            idx += 1
+
+            if key == "move":
+                info.move = VERTEX_INDEX.get(val, GtpVertex.NULL_INDEX)
+            elif key == "visits":
+                info.visits = int(val)
+            elif key == "winrate":
+                info.winrate = float(val) / scale
+            elif key == "scoreLead" or key == "score":
+                info.score_lead = float(val)
+            elif key == "prior":
+                info.prior = float(val) / scale
+            elif key == "lcb":
+                info.lcb = float(val) / scale
+            elif key == "order":
+                info.order = int(val)
+        return infos
+
+    def _parse_json(self, line):
+        # The cgos analysis is one JSON object with the candidate moves.
+        data = json.loads(line)
+        infos = list()
+        for order, m in enumerate(data.get("moves", list())):
+            info = AnalysisInfo()
+            info.move = VERTEX_INDEX[m["move"]]
+            info.visits = int(m.get("visits", 0))
+            if "winrate" in m:
+                info.winrate = float(m["winrate"])
+            if "score" in m:
+                info.score_lead = float(m["score"])
+            if "prior" in m:
+                info.prior = float(m["prior"])
+            info.order = order
+            info.pv = array("H", [ VERTEX_INDEX[v] for v in m.get("pv", str()).split() ])
+            infos.append(info)
+        return infos
+
+def read_analysis(engine, parser):
+    # Block until the next analysis output. The "info" data is the list
+    # of AnalysisInfo, the "play" data is the move string.
+    analysis_out = engine.get_analysis_line()
+    if analysis_out["type"] == "info":
+        return analysis_out["type"], parser.parse(analysis_out["data"])
+    elif analysis_out["type"] == "play":
+        return analysis_out["type"], analysis_out["data"].split()[-1]
+    return analysis_out["type"], None
+
+def analysis_mode(gtp_command):
+    # lz-analyze -> lz, kata-analyze -> kata
+    main_command = gtp_command.strip().split()[0]
+    if "-" in main_command:
+        return main_command.split("-")[0]
+    return None
+
+if __name__ == '__main__':
+    parser = AnalysisParser("lz")
+    for info in parser.parse("info move D4 visits 10 winrate 5123 prior 1000 lcb 4900 order 0 pv D4 Q16"):
+        print(info)
+    parser = AnalysisParser("kata")
+    for info in parser.parse("info move Q16 visits 8 utility 0.1 winrate 0.49 scoreLead -1.5 prior 0.2 order 0 pv Q16 pass ownership 0.1 -0.2"):
+        print(info)
+    for info in parser.parse("info move D4 visits 5 winrate 0.6 pv D4 Q16 rootInfo visits 999 winrate 0.1 info move Q4 visits 3 winrate 0.4 pv Q4"):
+        print(info)
+    parser = AnalysisParser()
+    for info in parser.parse("info move D4 visits 10 winrate 5123 prior 1000 lcb 4900 order 0 pv D4 Q16"):
+        print(info)
+    for info in parser.parse("info move D4 visits 10 utility 0.2 winrate 1 scoreMean 3 scoreLead 2.5 prior 1e-05 order 0 pv D4"):
+        print(info)
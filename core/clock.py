@@ -0,0 +1,101 @@
+import math
+
+class TimeControl:
+    # The GTP time settings, main time plus Canadian byo-yomi. The player
+    # must play the byo-yomi stones in each byo-yomi period.
+    #   absolute: main time only.
+    #   byo-yomi: main time and the byo-yomi periods.
+    #   per move: no main time, one stone per byo-yomi period.
+    def __init__(self, main_time=0., byoyomi=0., stones=0):
+        self.main_time = float(main_time)
+        self.byoyomi = float(byoyomi)
+        self.stones = int(stones)
+        if self.main_time < 0. or self.byoyomi < 0.:
+            raise Exception("The time must not be negative.")
+        if self.main_time <= 0. and self.byoyomi <= 0.:
+            raise Exception("Need the main time or the byo-yomi time.")
+        if self.byoyomi > 0. and self.stones <= 0:
+            raise Exception("Need one byo-yomi stone at least.")
+
+    @staticmethod
+    def parse(value):
+        # Accept the seconds per move, or a dict like
+        # { "main" : 600, "byoyomi" : 30, "stones" : 1 } or { "move" : 5 }.
+        if value is None:
+            return None
+        if not isinstance(value, dict):
+            return TimeControl(0., float(value), 1)
+        if "move" in value:
+            return TimeControl(0., float(value["move"]), 1)
+        byoyomi = float(value.get("byoyomi", 0.))
+        return TimeControl(
+                   float(value.get("main", 0.)), byoyomi,
+                   int(value.get("stones", 1 if byoyomi > 0. else 0)))
+
+    def gtp_args(self):
+        # The arguments of time_settings. GTP only accepts the integer
+        # seconds. Zero byo-yomi time means the absolute time.
+        return "{} {} {}".format(
+                   to_gtp_seconds(self.main_time), to_gtp_seconds(self.byoyomi), self.stones)
+
+    def __str__(self):
+        if self.main_time <= 0.:
+            return "{:g} sec/{} stones".format(self.byoyomi, self.stones)
+        if self.byoyomi <= 0.:
+            return "{:g} sec".format(self.main_time)
+        return "{:g} sec + {:g} sec/{} stones".format(self.main_time, self.byoyomi, self.stones)
+
+def to_gtp_seconds(sec):
+    # Round down, but never send the zero for the positive time. The
+    # zero byo-yomi time has a special meaning.
+    if sec <= 0.:
+        return 0
+    return max(int(math.floor(sec)), 1)
+
+class GameClock:
+    # The clock of one player in one game.
+    def __init__(self, time_control):
+        self.time_control = time_control
+        self.main_left = time_control.main_time
+        self.period_left = time_control.byoyomi
+        self.stones_left = time_control.stones
+        self.used = 0.
+        self.flagged = False
+
+    def in_byoyomi(self):
+        return self.main_left <= 0.
+
+    def available(self):
+        # The longest time of the next move.
+        if self.in_byoyomi():
+            return self.period_left
+        return self.main_left + self.time_control.byoyomi
+
+    def time_left(self):
+        # The arguments of time_left, the seconds and the stones. The
+        # stones are zero in the main time.
+        if self.in_byoyomi():
+            return to_gtp_seconds(self.period_left), self.stones_left
+        return to_gtp_seconds(self.main_left), 0
+
+    def spend(self, sec, margin=0.):
+        # Charge the time of one move. The margin covers the pipe and the
+        # process overhead. Return False if the player lost on time.
+        self.used += sec
+        sec = max(sec - margin, 0.)
+        if not self.in_byoyomi():
+            if sec <= self.main_left:
+                self.main_left -= sec
+                return True
+            sec -= self.main_left
+            self.main_left = 0.
+        if self.time_control.byoyomi <= 0. or sec > self.period_left:
+            self.flagged = True
+            return False
+        self.period_left -= sec
+        self.stones_left -= 1
+        if self.stones_left <= 0:
+            # Start a new byo-yomi period.
+            self.period_left = self.time_control.byoyomi
+            self.stones_left = self.time_control.stones
+        return True
@@ -1,4 +1,5 @@
 import copy
+import random
 
 class Stone:
     BLACK = 0
@@ -131,28 +132,102 @@ class GoLikeGame(MailBoxGame):
         return board
 
 class GoGame(GoLikeGame):
+    # The Zobrist keys of each mailbox size, { num_locations : keys }.
+    _ZOBRIST = dict()
+
     def __init__(self, board_size):
         super(GoGame, self).__init__(board_size)
         self.allow_capture = True
         self.pass_is_legal = True
+        self.superko = True # positional superko, also covers the basic ko
         self.num_passes = 0
+        self._zobrist = self._get_zobrist(self.num_locations)
+        self.hash = 0
+        self._hash_history = { self.hash }
+
+    @classmethod
+    def _get_zobrist(cls, num_locations):
+        keys = cls._ZOBRIST.get(num_locations)
+        if keys is None:
+            rng = random.Random(num_locations)
+            keys = [ [ rng.getrandbits(64) for _ in range(num_locations) ] for _ in Stone.COLORS ]
+            cls._ZOBRIST[num_locations] = keys
+        return keys
 
-    def play(self, x, y, color):
-        super(GoGame, self).play(x, y, color)
+    def set_stone(self, x, y, c):
+        loc = self.get_loc(x, y)
+        old = self.mailbox[loc]
+        super(GoGame, self).set_stone(x, y, c)
+        if old in Stone.COLORS:
+            self.hash ^= self._zobrist[old][loc]
+        if c in Stone.COLORS:
+            self.hash ^= self._zobrist[c][loc]
+
+    def reset(self):
+        super(GoGame, self).reset()
+        self.num_passes = 0
+        self.last_move = None
+        self.hash = 0
+        self._hash_history = { self.hash }
 
+    def _check_play(self, x, y, color):
+        # Raise if the move is illegal. Otherwise return the captured
+        # strings. Don't change the board, so it is cheap to validate a
+        # move.
+        if not color in Stone.COLORS:
+            raise Exception("Invalid play color.")
+        if self.get_stone(x, y) != Stone.EMPTY:
+            raise Exception("Play on the existed stone.")
+
+        opp_color = Stone.invert_color(color)
+        captured = list()
+        captured_locs = set()
+        has_libs = False
         for dx, dy in self.dir1:
             xx = x + dx
             yy = y + dy
-
-            string, libs = self._get_string(xx, yy)
-            if self.get_stone(xx, yy) == Stone.invert_color(color):
-                if libs == 0:
+            c = self.get_stone(xx, yy)
+
+            if c == Stone.EMPTY:
+                has_libs = True
+            elif c == color:
+                # The (x, y) is one of the liberties.
+                _, libs = self._get_string(xx, yy)
+                if libs > 1:
+                    has_libs = True
+            elif c == opp_color and not self.get_loc(xx, yy) in captured_locs:
+                string, libs = self._get_string(xx, yy)
+                if libs == 1:
                     if not self.allow_capture:
                         raise Exception("Don't allow the capture move.")
-                    self._remove(string)
-        _, libs = self._get_string(x, y)
-        if libs == 0:
+                    captured.append(string)
+                    captured_locs.update([ self.get_loc(sx, sy) for sx, sy in string ])
+                    has_libs = True
+        if not has_libs:
             raise Exception("Don't allow the suicide move.")
+
+        if self.superko:
+            h = self.hash ^ self._zobrist[color][self.get_loc(x, y)]
+            for loc in captured_locs:
+                h ^= self._zobrist[opp_color][loc]
+            if h in self._hash_history:
+                raise Exception("Don't allow the superko move.")
+        return captured
+
+    def legal(self, x, y, color):
+        try:
+            self._check_play(x, y, color)
+            return True
+        except:
+            pass
+        return False
+
+    def play(self, x, y, color):
+        captured = self._check_play(x, y, color)
+        super(GoGame, self).play(x, y, color)
+        for string in captured:
+            self._remove(string)
+        self._hash_history.add(self.hash)
         self.num_passes = 0
 
     def play_pass(self):
@@ -166,6 +241,60 @@ class GoGame(GoLikeGame):
             return True
         raise Exception("Pass is not a valid move.")
 
+    def area_score(self, komi=0., dead=None):
+        # The area score, black minus white minus komi. Remove the dead
+        # stones first if the dead list is given (Chinese rules). Without
+        # it, every stone is alive (Tromp-Taylor rules). An empty region
+        # counts for the color only if it reaches the stones of that color
+        # only.
+        mailbox = list(self.mailbox)
+        if dead is not None:
+            for x, y in dead:
+                if self.get_stone(x, y) in Stone.COLORS:
+                    mailbox[self.get_loc(x, y)] = Stone.EMPTY
+
+        scores = [0, 0]
+        reached = set()
+        for y in range(self.board_size):
+            for x in range(self.board_size):
+                loc = self.get_loc(x, y)
+                c = mailbox[loc]
+                if c in Stone.COLORS:
+                    scores[c] += 1
+                    continue
+                if c != Stone.EMPTY or loc in reached:
+                    continue
+
+                # Flood fill the empty region.
+                region_size = 0
+                borders = set()
+                reached.add(loc)
+                que = [ loc ]
+                while len(que) != 0:
+                    v = que.pop()
+                    region_size += 1
+                    for dx, dy in self.dir1:
+                        vv = v + dx + dy * self.mailbox_size
+                        cc = mailbox[vv]
+                        if cc == Stone.EMPTY:
+                            if not vv in reached:
+                                reached.add(vv)
+                                que.append(vv)
+                        elif cc in Stone.COLORS:
+                            borders.add(cc)
+                if len(borders) == 1:
+                    scores[borders.pop()] += region_size
+        return scores[Stone.BLACK] - scores[Stone.WHITE] - komi
+
+    def final_score(self, komi=0., dead=None):
+        # The result string like GTP final_score, e.g. B+3.5, W+0.5 or 0.
+        score = self.area_score(komi, dead)
+        if score > 0:
+            return "B+{:g}".format(score)
+        elif score < 0:
+            return "W+{:g}".format(-score)
+        return "0"
+
     def _get_string(self, x, y):
         color = self.get_stone(x, y)
         if not color in Stone.COLORS:
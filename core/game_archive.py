@@ -0,0 +1,198 @@
+from array import array
+import json
+import math
+import mmap
+import os
+import random
+import struct
+import sys
+from .gtp import GtpVertex
+from .sgf_parser import SgfGame, SgfError
+
+# The packed game archive. All numbers are little-endian.
+#
+#   header  : magic, version, reserved
+#   records : one record for each game
+#     board size (u8), komi (f32, NaN if none), moves (u32),
+#     metadata size (u16), metadata (UTF-8 JSON), move codes (u16 each)
+#   index   : the record offsets (u64 each), then the board sizes (u8 each)
+#   trailer : index offset (u64), number of games (u64), magic
+#
+# The move code is vertex index * 2 + color (1 is white), the same as
+# SgfGame. The index is at the end, so the archive is written in one
+# pass. Reading one game is one mmap slice.
+MAGIC = b"GOAR"
+VERSION = 1
+_HEADER = struct.Struct("<4sHH")
+_RECORD = struct.Struct("<BfIH")
+_TRAILER = struct.Struct("<QQ4s")
+
+def _to_little(a):
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+class GameArchiveWriter:
+    # Write the games into a new archive. The file appears under its name
+    # only after close(), so a failed conversion leaves no broken archive.
+    def __init__(self, filename):
+        self.filename = filename
+        self._tmp_name = filename + ".tmp"
+        self._file = open(self._tmp_name, "wb")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, 0))
+        self._offsets = array("Q")
+        self._board_sizes = array("B")
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, game, name=None):
+        # Add one SgfGame. The archive keeps the main line only, so the
+        # setup stones are rejected.
+        if game.has_setup():
+            raise SgfError("Do not support the setup stones.")
+        if game.board_size < 1 or game.board_size > GtpVertex.MAX_BOARD_SIZE:
+            raise SgfError("Invalid board size {}.".format(game.board_size))
+        meta = dict()
+        for key, value in [("name", name),
+                           ("black", game.black_player),
+                           ("white", game.white_player),
+                           ("result", game.result)]:
+            if value:
+                meta[key] = value
+        meta = json.dumps(meta, separators=(",", ":")).encode("utf-8") if len(meta) > 0 else b""
+        if len(meta) > 0xffff:
+            raise SgfError("The metadata is too long.")
+        komi = float("nan") if game.komi is None else game.komi
+
+        self._offsets.append(self._file.tell())
+        self._board_sizes.append(game.board_size)
+        self._file.write(_RECORD.pack(game.board_size, komi, len(game.moves), len(meta)))
+        self._file.write(meta)
+        self._file.write(_to_little(array("H", game.moves)).tobytes())
+
+    def close(self):
+        if self._file is None:
+            return
+        index_offset = self._file.tell()
+        self._file.write(_to_little(array("Q", self._offsets)).tobytes())
+        self._file.write(self._board_sizes.tobytes())
+        self._file.write(_TRAILER.pack(index_offset, len(self._offsets), MAGIC))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_name, self.filename)
+
+    def abort(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._tmp_name)
+
+class GameArchive:
+    # Read the games of an archive by the index. Only the index is loaded,
+    # the records stay in the memory mapped file.
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._read_index()
+        except (ValueError, struct.error, OSError) as err:
+            self.close()
+            raise SgfError("{} is not a game archive: {}".format(filename, err))
+
+    def _read_index(self):
+        mm = self._map
+        magic, version, _ = _HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError("bad magic")
+        if version != VERSION:
+            raise ValueError("unsupported version {}".format(version))
+        index_offset, count, magic = _TRAILER.unpack_from(mm, len(mm) - _TRAILER.size)
+        if magic != MAGIC or index_offset + count * 9 + _TRAILER.size != len(mm):
+            raise ValueError("broken index")
+        self._offsets = array("Q")
+        self._offsets.frombytes(mm[index_offset:index_offset + count * 8])
+        _to_little(self._offsets)
+        self.board_sizes = array("B")
+        self.board_sizes.frombytes(mm[index_offset + count * 8:index_offset + count * 9])
+        self._indices = dict() # { board size : indices }
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _header(self, index):
+        # Return the record header and the offset of the metadata.
+        offset = self._offsets[index]
+        return _RECORD.unpack_from(self._map, offset), offset + _RECORD.size
+
+    def moves(self, index):
+        # The packed move codes of the game.
+        (_, _, num_moves, meta_size), start = self._header(index)
+        start += meta_size
+        moves = array("H")
+        moves.frombytes(self._map[start:start + num_moves * 2])
+        return _to_little(moves)
+
+    def metadata(self, index):
+        (_, _, _, meta_size), start = self._header(index)
+        if meta_size == 0:
+            return dict()
+        return json.loads(self._map[start:start + meta_size].decode("utf-8"))
+
+    def game(self, index):
+        # Return the game as SgfGame.
+        (board_size, komi, _, _), _ = self._header(index)
+        meta = self.metadata(index)
+        game = SgfGame()
+        game.board_size = board_size
+        game.komi = None if math.isnan(komi) else round(komi, 4)
+        game.black_player = meta.get("black", str())
+        game.white_player = meta.get("white", str())
+        game.result = meta.get("result")
+        game.moves = self.moves(index)
+        return game
+
+    def indices(self, board_size):
+        # The indices of the games of the board size.
+        indices = self._indices.get(board_size)
+        if indices is None:
+            indices = array("L", [ i for i, s in enumerate(self.board_sizes) if s == board_size ])
+            self._indices[board_size] = indices
+        return indices
+
+    def sample(self, board_size=None, rng=random):
+        # Return the index of a random game, None if there is no game.
+        if board_size is None:
+            return rng.randrange(len(self)) if len(self) > 0 else None
+        indices = self.indices(board_size)
+        if len(indices) == 0:
+            return None
+        return indices[rng.randrange(len(indices))]
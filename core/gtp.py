@@ -1,8 +1,25 @@
+import collections
+import os
+import selectors
 import subprocess
 import threading
 import queue
 import sys
 import time
+from .latency import LatencyStats
+
+class GtpEngineError(Exception):
+    def __init__(self, msg, engine=None):
+        super().__init__(msg)
+        self.engine = engine
+
+class GtpTimeout(GtpEngineError):
+    # The engine does not answer before the deadline.
+    pass
+
+class GtpEngineDead(GtpEngineError):
+    # The engine process is closed or crashed.
+    pass
 
 class GtpColor:
     BLACK = "b"
@@ -66,6 +83,12 @@ class GtpVertex:
     RESIGN_VERTEX = 100 * 100 + 1
     NULL_VERTEX = 100 * 100 + 2
 
+    # The compact integer form, x + y * MAX_BOARD_SIZE. It fits in 16 bits.
+    MAX_BOARD_SIZE = 25
+    PASS_INDEX = MAX_BOARD_SIZE * MAX_BOARD_SIZE
+    RESIGN_INDEX = PASS_INDEX + 1
+    NULL_INDEX = PASS_INDEX + 2
+
     def __init__(self, val=None):
         self._vertex = None
         self.set(val)
@@ -134,6 +157,33 @@ class GtpVertex:
                    not self.is_resign() and \
                    not self.is_null()
 
+    def to_index(self):
+        if self._vertex is None:
+            raise Exception("Invalid vertex.")
+
+        if isinstance(self._vertex, int):
+            if self._vertex == self.PASS_VERTEX:
+                return self.PASS_INDEX
+            elif self._vertex == self.RESIGN_VERTEX:
+                return self.RESIGN_INDEX
+            return self.NULL_INDEX
+
+        x, y = self._vertex
+        return x + y * self.MAX_BOARD_SIZE
+
+    @staticmethod
+    def from_index(index):
+        if index == GtpVertex.PASS_INDEX:
+            return GtpVertex(GtpVertex.PASS_VERTEX)
+        elif index == GtpVertex.RESIGN_INDEX:
+            return GtpVertex(GtpVertex.RESIGN_VERTEX)
+        elif index == GtpVertex.NULL_INDEX:
+            return GtpVertex(GtpVertex.NULL_VERTEX)
+        elif index < 0 or index > GtpVertex.NULL_INDEX:
+            raise Exception("Invalid vertex index.")
+        return GtpVertex((index % GtpVertex.MAX_BOARD_SIZE,
+                          index // GtpVertex.MAX_BOARD_SIZE))
+
     def to_str(self):
         if self._vertex is None:
             raise Exception("Invalid vertex.")
@@ -153,17 +203,56 @@ class GtpVertex:
         return self.to_str()
 
 class Query:
-    def __init__(self, gtp_command):
+    def __init__(self, gtp_command, query_id=None):
         self.gtp_command = gtp_command
+        self.query_id = query_id
         self.result = None # = or ?
-        self.response = list()
+        self.response_id = None
+        self._raw = list()
+        self._response = None
+        self._finished = threading.Event()
+
+        # The timestamps for the latency stats.
+        self.push_time = time.perf_counter()
+        self.write_time = None
+        self.first_byte_time = None
+        self.finish_time = None
+
+    @property
+    def response(self):
+        # The engine output is kept as bytes. Only decode it when the
+        # consumer asks for it.
+        if self._response is None:
+            self._response = list()
+            if len(self._raw) > 0:
+                text = b"\n".join(self._raw).decode(errors="replace")
+                self._response = [ line.strip() for line in text.split("\n") ]
+        return self._response
+
+    def append_raw(self, data):
+        self._raw.append(data)
+        self._response = None
 
     def get_response(self):
         return self.response
 
+    def finish(self):
+        self.finish_time = time.perf_counter()
+        self._finished.set()
+
+    def is_finished(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        # Block until the engine answers this query.
+        return self._finished.wait(timeout)
+
     def get_main_command(self):
         buf = self.gtp_command.strip().split()
-        if buf is not None:
+        if len(buf) > 1 and buf[0].isdigit():
+            # Skip the numeric id, e.g. "12 play b D4".
+            return buf[1]
+        if len(buf) > 0:
             return buf[0]
         return None
 
@@ -176,23 +265,202 @@ class Query:
     def __str__(self):
         return self.to_str()
 
+def decode_analysis(analysis_out):
+    # The analysis data stays as bytes in the queue.
+    if analysis_out is not None and \
+           isinstance(analysis_out["data"], bytes):
+        analysis_out["data"] = analysis_out["data"].decode(errors="replace")
+    return analysis_out
+
+class AnalysisQueue:
+    # The queue of analysis outputs. It is a plain FIFO by default. In the
+    # coalescing mode, a new "info" output replaces the pending "info"
+    # output, so a slow consumer only sees the newest snapshot and the
+    # memory stays flat. The "play" and "end" outputs are always kept.
+    def __init__(self, coalesce=False):
+        self.coalesce = coalesce
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        with self._cond:
+            if self.coalesce and \
+                   item["type"] == "info" and \
+                   len(self._items) > 0 and \
+                   self._items[-1]["type"] == "info":
+                self._items[-1] = item
+            else:
+                self._items.append(item)
+            self._cond.notify()
+
+    def get(self, block=True, timeout=None):
+        with self._cond:
+            if block:
+                self._cond.wait_for(lambda: len(self._items) > 0, timeout)
+            if len(self._items) == 0:
+                raise queue.Empty
+            return self._items.popleft()
+
+    def empty(self):
+        with self._cond:
+            return len(self._items) == 0
+
+    def qsize(self):
+        with self._cond:
+            return len(self._items)
+
+class GtpResponseHandler:
+    # Assemble the engine output into the handling query. It is shared
+    # by every transport so they all parse responses the same way. The
+    # input is bytes. In the coalescing mode the "info" lines only go to
+    # the analysis queue, the query doesn't keep them, so a long analysis
+    # doesn't grow the memory.
+    def __init__(self, finish_fn, analysis_fn):
+        self._finish_fn = finish_fn
+        self._analysis_fn = analysis_fn
+        self._handling_query = None
+        self._receiving_analysis = False
+        self.coalesce = False
+
+    def is_idle(self):
+        return self._handling_query is None
+
+    def is_receiving_analysis(self):
+        return self._receiving_analysis
+
+    def begin(self, query):
+        # The reader begins the query when its response arrives.
+        query.first_byte_time = time.perf_counter()
+        self._handling_query = query
+
+        main_command = query.get_main_command()
+        if len(main_command.split("-")) <= 2 and \
+               main_command.split("-")[-1] in ["analyze", "analyze_genmove"]:
+            self._receiving_analysis = True
+
+    def _finish(self):
+        handling_query = self._handling_query
+        if self._receiving_analysis:
+            self._analysis_fn({"type" : "end", "data" : None})
+            self._receiving_analysis = False
+        self._handling_query = None
+        handling_query.finish()
+        self._finish_fn(handling_query)
+
+    def _parse_status(self, line):
+        handling_query = self._handling_query
+        if handling_query.result is not None:
+            return line
+
+        head = line.split(None, 1)[0]
+        if head[:1] in [b"=", b"?"] and \
+               (len(head) == 1 or head[1:].isdigit()):
+            # The status may carry the numeric id, e.g. "=12".
+            handling_query.result = head[:1].decode()
+            if len(head) > 1:
+                handling_query.response_id = int(head[1:])
+            line = line[len(head):].strip()
+        return line
+
+    def feed(self, line):
+        # Feed one stripped line. The empty line is the terminator.
+        if not line:
+            self._finish()
+            return
+
+        line = self._parse_status(line)
+        if self._receiving_analysis and len(line) > 0:
+            analysis_out = {"type" : "info", "data" : line}
+            if line.startswith(b"play"):
+                # The final move of analyze_genmove. Do not match the
+                # keys like "scoreSelfplay".
+                analysis_out["type"] = "play"
+            self._analysis_fn(analysis_out)
+            if self.coalesce and analysis_out["type"] == "info":
+                return
+        self._handling_query.append_raw(line)
+
+    def feed_block(self, block):
+        # Feed the whole response without the terminator at once.
+        end = block.find(b"\n")
+        if end < 0:
+            line, rest = block.strip(), None
+        else:
+            line, rest = block[:end].strip(), block[end+1:]
+        if line:
+            line = self._parse_status(line)
+        self._handling_query.append_raw(line)
+        if rest is not None:
+            self._handling_query.append_raw(rest)
+        self._finish()
+
+class GtpStreamReader:
+    # Read the engine stdout in large chunks. A normal response is split
+    # on the "\n\n" boundary without looking at its lines. Only the
+    # analysis response is handled line by line.
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, handler, next_query_fn):
+        self._handler = handler
+        self._next_query_fn = next_query_fn
+        self._buffer = bytes()
+
+    def feed(self, data):
+        if b"\r" in data:
+            data = data.replace(b"\r", b"")
+        if len(self._buffer) > 0:
+            data = self._buffer + data
+        handler = self._handler
+        pos = 0
+        size = len(data)
+
+        while pos < size:
+            if handler.is_idle():
+                query = self._next_query_fn()
+                if query is None:
+                    break
+                handler.begin(query)
+
+            if handler.is_receiving_analysis():
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    break
+                handler.feed(data[pos:end].strip())
+                pos = end + 1
+            else:
+                end = data.find(b"\n\n", pos)
+                if end < 0:
+                    break
+                handler.feed_block(data[pos:end])
+                pos = end + 2
+        self._buffer = data[pos:]
+
+    def close(self):
+        # EOF, finish the handling query so nobody waits for it forever.
+        if not self._handler.is_idle():
+            self._handler.feed(b"")
+
 class GTPEnginePipe:
-    def __init__(self, command):
+    def __init__(self, command, latency=None):
         self._engine = subprocess.Popen(
             command.split(),
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+            stderr=subprocess.PIPE
         )
 
         self._remaining = 0
+        self._latency = latency
         self._query_queue = queue.Queue()
         self._wait_queue = queue.Queue()
         self._finish_queue = queue.Queue()
-        self._analysis_queue = queue.Queue()
+        self._analysis_queue = AnalysisQueue()
+        self._handler = GtpResponseHandler(
+            self._finish_query, self._analysis_queue.put
+        )
 
         self._running = True
+        self._eof = False
         self._send_query_thread = threading.Thread(
             target=self._send_query_loop, daemon=True
         )
@@ -210,7 +478,7 @@ class GTPEnginePipe:
         return [self._send_query_thread, self._handle_gtp_thread, self._read_err_thread]
 
     def is_running(self):
-        return self._running
+        return self._running and not self._eof
 
     def query_empty(self):
         return self._finish_queue.empty()
@@ -218,88 +486,111 @@ class GTPEnginePipe:
     def analysis_empty(self):
         return self._analysis_queue.empty()
 
+    def set_analysis_coalesce(self, coalesce):
+        self._analysis_queue.coalesce = coalesce
+        self._handler.coalesce = coalesce
+
+    def set_latency(self, latency):
+        # Record the finished queries into these stats, None for no stats.
+        self._latency = latency
+
     def push_query(self, query):
         self._remaining += 1
+        if not self.is_running():
+            self._abort_query(query)
+            return
         try:
             self._query_queue.put(query)
         except queue.Full:
             self._remaining -= 1
 
+    def _abort_query(self, query):
+        # Nobody is going to answer it. Finish it without result.
+        query.finish()
+        self._finish_queue.put(query)
+
+    def _finish_query(self, query):
+        if self._latency is not None:
+            self._latency.record(query)
+        self._finish_queue.put(query)
+
+    def _abort_all_queries(self):
+        for q in [self._wait_queue, self._query_queue]:
+            stopped = False
+            while True:
+                try:
+                    query = q.get(block=False)
+                except queue.Empty:
+                    break
+                if query is None:
+                    stopped = True
+                else:
+                    self._abort_query(query)
+            if stopped:
+                # Keep the stop signal of wait_to_join() for the
+                # sending loop.
+                q.put(None)
+
     def push_gtp_command(self, cmd):
         query = Query(
             gtp_command="{}\n".format(cmd.strip())
         )
         self.push_query(query)
+        return query
 
     def _read_err_loop(self):
         while self._running:
             try:
                 line = self._engine.stderr.readline()
-            except OSError as e:
+            except (OSError, ValueError) as e:
                 break
-            sys.stderr.write(line)
+            if not line:
+                break # EOF
+            sys.stderr.write(line.decode(errors="replace"))
             sys.stderr.flush()
 
     def _send_query_loop(self):
         while self._running:
-            try:
-                query = self._query_queue.get(block=True, timeout=0.1)
-            except queue.Empty:
-                continue
+            query = self._query_queue.get(block=True)
+            if query is None:
+                break # Stop by wait_to_join().
 
-            cmd = query.gtp_command
+            cmd = query.gtp_command.encode()
 
+            # Push it before writing, so the query is always ready when
+            # its response arrives.
+            self._wait_queue.put(query)
             try:
                 self._engine.stdin.write(cmd)
                 self._engine.stdin.flush()
-                self._wait_queue.put(query)
+                query.write_time = time.perf_counter()
             except OSError as e:
                 break
 
+    def _next_waiting_query(self):
+        try:
+            return self._wait_queue.get(block=False)
+        except queue.Empty:
+            return None
+
     def _handle_gtp_loop(self):
-        handling_query = None
-        receiving_analysis = False
+        reader = GtpStreamReader(self._handler, self._next_waiting_query)
         while self._running:
-            if handling_query is None:
-                try:
-                    query = self._wait_queue.get(block=True, timeout=0.1)
-                    handling_query = query
-
-                    main_command = handling_query.get_main_command()
-                    if len(main_command.split("-")) <= 2 and \
-                           main_command.split("-")[-1] in ["analyze", "analyze_genmove"]:
-                        receiving_analysis = True
-                except queue.Empty:
-                    continue
-
             try:
-                line = self._engine.stdout.readline().strip()
-            except OSError as e:
+                data = self._engine.stdout.read1(GtpStreamReader.READ_SIZE)
+            except (OSError, ValueError) as e:
+                break
+            if not data:
+                # EOF, the engine is closed.
+                self._eof = True
+                reader.close()
+                self._abort_all_queries()
                 break
+            reader.feed(data)
 
-            if not line:
-                if receiving_analysis:
-                    self._analysis_queue.put({"type" : "end", "data" : None})
-                    receiving_analysis = False
-                self._finish_queue.put(handling_query)
-                handling_query = None
-                continue
-
-            if line.split()[0] in ["=", "?"] and \
-                   handling_query.result is None:
-                handling_query.result = line.split()[0]
-                line = line[1:].strip()
-
-            if receiving_analysis and len(line) > 0:
-                analysis_out = {"type" : "info", "data" : line}
-                if "play" in line:
-                    analysis_out["type"] = "play"
-                self._analysis_queue.put(analysis_out)
-            handling_query.response.append(line)
-
-    def try_get_query(self, block=False):
+    def try_get_query(self, block=False, timeout=None):
         try:
-            query = self._finish_queue.get(block=block, timeout=9999)
+            query = self._finish_queue.get(block=block, timeout=timeout)
         except queue.Empty:
             return None
         self._remaining -= 1
@@ -316,7 +607,7 @@ class GTPEnginePipe:
             line = self._analysis_queue.get(block=block, timeout=9999)
         except queue.Empty:
             return None
-        return line
+        return decode_analysis(line)
 
     def pop_query(self):
         while not self.query_empty():
@@ -325,8 +616,11 @@ class GTPEnginePipe:
     def alive(self):
         return self._engine.poll() is None
 
-    def wait(self):
-        return self._engine.wait()
+    def pid(self):
+        return self._engine.pid
+
+    def wait(self, timeout=None):
+        return self._engine.wait(timeout)
 
     def kill(self):
         return self._engine.kill()
@@ -336,17 +630,341 @@ class GTPEnginePipe:
             return
 
         self._running = False
+
+        # Wake up the blocking loops. The reading loops finish when the
+        # engine closes its pipes.
+        self._query_queue.put(None)
+        self._wait_queue.put(None)
         for t in self._gather_threads():
             t.join()
 
+class GtpReactor:
+    # One thread multiplexes the pipes of all registered engines with
+    # the selectors module. It performs non-blocking reads and writes, so
+    # the number of threads does not grow with the number of engines.
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending_calls = list()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(
+                target=self._reactor_loop, daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        self._wakeup()
+        self._thread.join()
+        self._thread = None
+
+    def is_running(self):
+        return self._running
+
+    def num_pipes(self):
+        # The wakeup pipe is always registered.
+        return len(self._selector.get_map()) - 1
+
+    def call_soon(self, fn):
+        # The selector is not thread-safe. Other threads ask the reactor
+        # thread to modify it.
+        with self._lock:
+            self._pending_calls.append(fn)
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            pass # The reactor will wake up anyway.
+
+    def add_reader(self, fd, callback):
+        self._selector.register(fd, selectors.EVENT_READ, callback)
+
+    def add_writer(self, fd, callback):
+        try:
+            self._selector.register(fd, selectors.EVENT_WRITE, callback)
+        except KeyError:
+            pass # Already waiting for writing.
+
+    def remove(self, fd):
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def _run_pending_calls(self):
+        with self._lock:
+            calls, self._pending_calls = self._pending_calls, list()
+        for fn in calls:
+            fn()
+
+    def _reactor_loop(self):
+        while self._running:
+            self._run_pending_calls()
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    try:
+                        while os.read(self._wakeup_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                key.data()
+        self._run_pending_calls()
+
+class ReactorGTPEnginePipe:
+    # Same interface as GTPEnginePipe, but the I/O is done by the shared
+    # GtpReactor instead of three threads per engine.
+    def __init__(self, command, reactor, latency=None):
+        self._engine = subprocess.Popen(
+            command.split(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        self._reactor = reactor
+        self._stdin_fd = self._engine.stdin.fileno()
+        self._stdout_fd = self._engine.stdout.fileno()
+        self._stderr_fd = self._engine.stderr.fileno()
+        for fd in [self._stdin_fd, self._stdout_fd, self._stderr_fd]:
+            os.set_blocking(fd, False)
+
+        self._remaining = 0
+        self._latency = latency
+        self._lock = threading.Lock()
+        self._write_buffer = bytearray()
+        self._unwritten = list()
+        self._wait_queue = collections.deque()
+        self._finish_queue = queue.Queue()
+        self._analysis_queue = AnalysisQueue()
+        self._handler = GtpResponseHandler(
+            self._finish_query, self._analysis_queue.put
+        )
+        self._reader = GtpStreamReader(self._handler, self._next_waiting_query)
+        self._closed = threading.Event()
+        self._num_opened = 2 # stdout and stderr
+
+        self._running = True
+        self._reactor.call_soon(self._register)
+        self._reactor.start()
+
+    def _register(self):
+        self._reactor.add_reader(self._stdout_fd, self._on_stdout_readable)
+        self._reactor.add_reader(self._stderr_fd, self._on_stderr_readable)
+
+    def is_running(self):
+        return self._running
+
+    def query_empty(self):
+        return self._finish_queue.empty()
+
+    def analysis_empty(self):
+        return self._analysis_queue.empty()
+
+    def set_analysis_coalesce(self, coalesce):
+        self._analysis_queue.coalesce = coalesce
+        self._handler.coalesce = coalesce
+
+    def set_latency(self, latency):
+        # Record the finished queries into these stats, None for no stats.
+        self._latency = latency
+
+    def push_query(self, query):
+        self._remaining += 1
+        if not self._running:
+            self._abort_query(query)
+            return
+        with self._lock:
+            self._wait_queue.append(query)
+            self._unwritten.append(query)
+            pending = len(self._write_buffer) > 0
+            self._write_buffer.extend(query.gtp_command.encode())
+            if not pending:
+                # Try to write it right now. Only wake up the reactor if
+                # the pipe is full.
+                self._write_some()
+            if len(self._write_buffer) > 0:
+                self._reactor.call_soon(
+                    lambda: self._reactor.add_writer(
+                        self._stdin_fd, self._on_stdin_writable))
+
+    def push_gtp_command(self, cmd):
+        query = Query(
+            gtp_command="{}\n".format(cmd.strip())
+        )
+        self.push_query(query)
+        return query
+
+    def _write_some(self):
+        try:
+            size = os.write(self._stdin_fd, self._write_buffer)
+            del self._write_buffer[:size]
+            if len(self._write_buffer) == 0:
+                write_time = time.perf_counter()
+                for query in self._unwritten:
+                    query.write_time = write_time
+                self._unwritten.clear()
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._write_buffer.clear()
+            self._unwritten.clear()
+            self._running = False
+
+    def _on_stdin_writable(self):
+        with self._lock:
+            self._write_some()
+            if len(self._write_buffer) == 0:
+                self._reactor.remove(self._stdin_fd)
+
+    def _read_some(self, fd):
+        try:
+            data = os.read(fd, GtpStreamReader.READ_SIZE)
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            data = b""
+        if not data:
+            self._reactor.remove(fd)
+            self._num_opened -= 1
+            if self._num_opened == 0:
+                self._reactor.remove(self._stdin_fd)
+                self._closed.set()
+        return data
+
+    def _on_stderr_readable(self):
+        data = self._read_some(self._stderr_fd)
+        if data:
+            sys.stderr.write(data.decode(errors="replace"))
+            sys.stderr.flush()
+
+    def _next_waiting_query(self):
+        with self._lock:
+            if len(self._wait_queue) == 0:
+                return None
+            return self._wait_queue.popleft()
+
+    def _abort_query(self, query):
+        # Nobody is going to answer it. Finish it without result.
+        query.finish()
+        self._finish_queue.put(query)
+
+    def _finish_query(self, query):
+        if self._latency is not None:
+            self._latency.record(query)
+        self._finish_queue.put(query)
+
+    def _on_stdout_readable(self):
+        data = self._read_some(self._stdout_fd)
+        if data is None:
+            return
+        if not data:
+            # EOF, the engine is closed.
+            self._running = False
+            self._reader.close()
+            while True:
+                query = self._next_waiting_query()
+                if query is None:
+                    break
+                self._abort_query(query)
+            return
+        self._reader.feed(data)
+
+    def try_get_query(self, block=False, timeout=None):
+        try:
+            query = self._finish_queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            return None
+        self._remaining -= 1
+        return query
+
+    def try_get_response(self, block=False):
+        query = self.try_get_query(block)
+        if query is None:
+            return None, None
+        return query.result, str(query)
+
+    def try_get_analysis(self, block=False):
+        try:
+            line = self._analysis_queue.get(block=block, timeout=9999)
+        except queue.Empty:
+            return None
+        return decode_analysis(line)
+
+    def pop_query(self):
+        while not self.query_empty():
+            self.try_get_query(True)
+
+    def alive(self):
+        return self._engine.poll() is None
+
+    def pid(self):
+        return self._engine.pid
+
+    def wait(self, timeout=None):
+        return self._engine.wait(timeout)
+
+    def kill(self):
+        return self._engine.kill()
+
+    def wait_to_join(self):
+        if not self._running and self._closed.is_set():
+            return
+
+        self._running = False
+        if self._reactor.is_running():
+            # The process is dead, so the reactor reads EOF very soon.
+            self._closed.wait()
+        for f in [self._engine.stdin, self._engine.stdout, self._engine.stderr]:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+class GtpPosition:
+    # The target position for GtpEngine.sync_to(). The moves are the
+    # (color, vertex) pairs.
+    def __init__(self, board_size, komi, moves=None):
+        self.board_size = board_size
+        self.komi = komi
+        self.moves = list() if moves is None else moves
+
 class GtpEngineBase:
-    def __init__(self, command):
+    # The deadline of the list_commands handshake at startup, unless the
+    # "startup" timeout is given. A hung engine must not stall the caller.
+    STARTUP_TIMEOUT = 60.
+
+    def __init__(self, command, reactor=None, timeouts=None):
         self.command = command
-        self._pipe = GTPEnginePipe(command)
+        self._reactor = reactor
+        self._pipe = None
+        self._next_id = 0
         self._supported_list = [
             "list_commands"
         ]
-        self._get_supported_commands()
+        self.startup_time = None
+        self._analysis_coalesce = False
+        self._timeouts = dict()
+        if timeouts is not None:
+            self.set_timeouts(timeouts)
+        self._last_command = None
+        self.latency = LatencyStats()
+        self.setup()
 
     def __del__(self):
         self.shutdown()
@@ -354,16 +972,15 @@ class GtpEngineBase:
     def _get_supported_commands(self):
         self._send_base("list_commands")
 
-        while not self.query_empty():
-            self.idle(0.1)
-        res, val = self.get_last_response_raw()
-
-        if res == "=":
-            self._supported_list = val.strip().split()
+        # Block until the engine answers. It is ready after that.
+        query = self._wait_query(
+                    "list_commands", self._timeouts.get("startup", self.STARTUP_TIMEOUT))
+        if query.result == "=":
+            self._supported_list = str(query).strip().split()
 
-    def _send_base(self, gtp_command):
-        if not self._pipe.is_running():
-            raise Exception("Engine is stop.")
+    def _check_command(self, gtp_command):
+        if self._pipe is None or not self._pipe.is_running():
+            raise GtpEngineDead("Engine is stop.", self)
 
         if not isinstance(gtp_command, str):
             raise Exception("Not string type.")
@@ -375,7 +992,86 @@ class GtpEngineBase:
         if cmd_list[0] not in self._supported_list:
             raise Exception("Current command is not supported.")
 
-        self._pipe.push_gtp_command(gtp_command)
+    def _send_base(self, gtp_command):
+        self._check_command(gtp_command)
+        self._last_command = gtp_command.split()[0]
+        return self._pipe.push_gtp_command(gtp_command)
+
+    def set_timeout(self, sec, command=None):
+        # The deadline of the command response. The None command sets
+        # the default deadline. The None sec means waiting forever.
+        if command is None:
+            command = "default"
+        self._timeouts[command] = sec
+
+    def set_timeouts(self, timeouts):
+        # Accept one number for all commands, or a dict like
+        # { "genmove" : 60, "default" : 10 }.
+        if isinstance(timeouts, dict):
+            for command, sec in timeouts.items():
+                self.set_timeout(sec, command)
+        else:
+            self.set_timeout(timeouts)
+
+    def get_timeout(self, command):
+        return self._timeouts.get(
+                   command, self._timeouts.get("default", None))
+
+    def _wait_query(self, command, timeout=None):
+        # Wait for the command until its deadline, or the given timeout.
+        if not self._pipe.is_running() and self._pipe.query_empty():
+            raise GtpEngineDead("Engine is stop.", self)
+
+        if timeout is None:
+            timeout = self.get_timeout(command)
+        query = self._pipe.try_get_query(block=True, timeout=timeout)
+        if query is None:
+            raise GtpTimeout(
+                      "No response for {} in {} sec.".format(command, timeout), self)
+        if query.result is None and not self._pipe.is_running():
+            raise GtpEngineDead("Engine is stop.", self)
+        return query
+
+    def alive(self):
+        return self._pipe is not None and self._pipe.alive()
+
+    def get_latency(self):
+        # The latency stats survive the restart and the lazy sleep.
+        return self.latency
+
+    def push_batch(self, gtp_commands):
+        # Write all commands at once without waiting for the responses.
+        # Every command carries a GTP numeric id so that we can match
+        # the "=id" response back to its query.
+        for gtp_command in gtp_commands:
+            self._check_command(gtp_command)
+
+        queries = list()
+        for gtp_command in gtp_commands:
+            self._next_id += 1
+            query = Query(
+                gtp_command="{} {}\n".format(self._next_id, gtp_command.strip()),
+                query_id=self._next_id
+            )
+            queries.append(query)
+            self._pipe.push_query(query)
+        return queries
+
+    def wait_batch(self, queries):
+        # Collect the responses of push_batch(). The engine answers in
+        # order, so the finished queries are the pushed ones.
+        finished = list()
+        for query in queries:
+            finished.append(self._wait_query(query.get_main_command()))
+        for query in finished:
+            if query.response_id is not None and \
+                   query.response_id != query.query_id:
+                raise Exception("Mismatched response id: {} for query {}.".format(
+                                    query.response_id, query.query_id))
+        return finished
+
+    def send_batch(self, gtp_commands):
+        return self.wait_batch(self.push_batch(gtp_commands))
 
     def idle(self, sec=1.0):
         # The queue/pipe may not update their status right now. Should
@@ -399,6 +1095,12 @@ class GtpEngineBase:
     def analysis_empty(self):
         return self._pipe.analysis_empty()
 
+    def set_analysis_coalesce(self, coalesce):
+        # Only keep the latest analysis snapshot for the slow consumer.
+        self._analysis_coalesce = coalesce
+        if self._pipe is not None:
+            self._pipe.set_analysis_coalesce(coalesce)
+
     def get_analysis_line(self):
         return self._pipe.try_get_analysis(block=True)
 
@@ -406,7 +1108,8 @@ class GtpEngineBase:
         return self._pipe.query_empty()
 
     def get_last_response_raw(self):
-        return self._pipe.try_get_response(block=True)
+        query = self._wait_query(self._last_command)
+        return query.result, str(query)
 
     def get_last_response(self, raise_err=False):
         res, rep = self.get_last_response_raw()
@@ -415,21 +1118,59 @@ class GtpEngineBase:
         return rep
 
     def get_last_query(self):
-        return self._pipe.try_get_query(block=True)
+        return self._wait_query(self._last_command)
+
+    def _make_pipe(self):
+        if self._reactor is not None:
+            return ReactorGTPEnginePipe(self.command, self._reactor, self.latency)
+        return GTPEnginePipe(self.command, self.latency)
+
+    def adopt_pipe(self, pipe):
+        # Take over a ready pipe, e.g. the warm one from GtpPipePool.
+        if self._pipe is not None:
+            raise Exception("The engine is running.")
+        self._pipe = pipe
+        self._pipe.set_analysis_coalesce(self._analysis_coalesce)
+        self._pipe.set_latency(self.latency)
+        self.startup_time = 0.
+
+    def release_pipe(self):
+        pipe, self._pipe = self._pipe, None
+        return pipe
 
     def setup(self):
         if self._pipe is None:
-            self._pipe = GTPEnginePipe(self.command)
+            start = time.perf_counter()
+            self._pipe = self._make_pipe()
+            self._pipe.set_analysis_coalesce(self._analysis_coalesce)
+            try:
+                self._get_supported_commands()
+            except GtpEngineError as err:
+                # Don't leave the hung process behind.
+                self._close_pipe()
+                raise err
+            # The spawn-to-ready latency of the engine.
+            self.startup_time = time.perf_counter() - start
+
+    def _close_pipe(self):
+        if self._pipe.alive():
+            self._pipe.kill()
+            self._pipe.wait()
+        self._pipe.wait_to_join()
+        self._pipe = None
+
+    def restart(self):
+        # Kill the hung or crashed engine and start a new one.
+        if self._pipe is not None:
+            self._close_pipe()
+        self.setup()
 
     def shutdown(self):
         if self._pipe is None:
             return
         if self._pipe.alive():
             sys.stderr.write("Kill the GTP engine process. It is not the recommend way. Please enter \"quit\" before closing it.\n")
-            self._pipe.kill()
-            self._pipe.wait()
-        self._pipe.wait_to_join()
-        self._pipe = None
+        self._close_pipe()
 
 class GtpEngine(GtpEngineBase):
     SUPPORTED_LIST = [
@@ -446,8 +1187,8 @@ class GtpEngine(GtpEngineBase):
         "quit"
     ]
 
-    def __init__(self, command):
-        super().__init__(command)
+    def __init__(self, command, reactor=None, timeouts=None):
+        super().__init__(command, reactor, timeouts)
         self.raise_err = True
         self._self_check()
 
@@ -456,8 +1197,66 @@ class GtpEngine(GtpEngineBase):
             if not self.support(c) and self.raise_err:
                 raise Exception("Need to support for GTP command: {}.".format(c))
 
+    def setup(self):
+        super().setup()
+        self._forget_state()
+
+    def adopt_pipe(self, pipe):
+        super().adopt_pipe(pipe)
+        self._forget_state()
+
+    def release_pipe(self):
+        self._forget_state()
+        return super().release_pipe()
+
+    def _forget_state(self):
+        # The known board size, komi and move list of the engine. None
+        # is unknown.
+        self._board_size = None
+        self._komi = None
+        self._moves = None
+
+    def _track_state(self, query):
+        tokens = query.gtp_command.split()
+        if len(tokens) > 0 and tokens[0].isdigit():
+            tokens = tokens[1:]
+        if len(tokens) == 0:
+            return
+        main_command, args = tokens[0], tokens[1:]
+
+        if query.result != "=":
+            if main_command in ["clear_board", "boardsize", "komi", "play", "genmove", "undo"]:
+                # We don't know what the engine did.
+                self._forget_state()
+            return
+
+        if main_command == "clear_board":
+            self._moves = list()
+        elif main_command == "boardsize":
+            # The board is arbitrary after boardsize. Need clear_board.
+            self._board_size = int(args[0])
+            self._moves = None
+        elif main_command == "komi":
+            self._komi = float(args[0])
+        elif main_command == "play" and self._moves is not None:
+            self._moves.append((args[0].lower(), args[1].lower()))
+        elif main_command == "genmove" and self._moves is not None:
+            vertex = str(query).lower()
+            if vertex != GtpVertex.RESIGN_STR:
+                self._moves.append((args[0].lower(), vertex))
+        elif main_command == "undo" and self._moves is not None:
+            if len(self._moves) > 0:
+                self._moves.pop()
+
+    def get_known_moves(self):
+        return self._moves
+
     def return_response(self):
-        return self.get_last_response(self.raise_err)
+        query = self.get_last_query()
+        self._track_state(query)
+        if self.raise_err and query.result == "?":
+            raise Exception("Invalid command: ({}).".format(str(query)))
+        return str(query)
 
     def name(self):
         self.send_command("name")
@@ -495,14 +1294,95 @@ class GtpEngine(GtpEngineBase):
         self.send_command("play {} {}".format(color, vertex))
         return self.return_response()
 
-    def quit(self):
-        self.send_command("quit")
-        self.idle(0.2) # Wait for handling the quit command.
+    def finish_batch(self, queries):
+        # Return the finished queries of push_batch(). The failures are
+        # left to the caller.
+        finished = self.wait_batch(queries)
+        for query in finished:
+            self._track_state(query)
+        return finished
+
+    def return_batch_response(self, queries):
+        # Return all responses together. Raise the first failure if
+        # needed.
+        finished = self.finish_batch(queries)
+        if self.raise_err:
+            for query in finished:
+                if query.result == "?":
+                    raise Exception("Invalid command: ({}) {}.".format(
+                                        query.gtp_command.strip(), str(query)))
+        return [ str(query) for query in finished ]
+
+    def batch(self, gtp_commands):
+        return self.return_batch_response(self.push_batch(gtp_commands))
+
+    def play_batch(self, moves):
+        return self.batch(
+            [ "play {} {}".format(color, vertex) for color, vertex in moves ]
+        )
+
+    def sync_commands(self, position):
+        # The minimal commands which bring the engine to the position. Skip
+        # the known board size and komi, and undo the diverged moves if it
+        # is cheaper than replaying the game.
+        target = [ (str(c).lower(), str(v).lower()) for c, v in position.moves ]
+        commands = list()
+        moves = self._moves
+
+        if self._board_size != position.board_size:
+            commands.append("boardsize {}".format(position.board_size))
+            moves = None
+        if self._komi is None or \
+               self._komi != float(position.komi):
+            commands.append("komi {}".format(position.komi))
+        if moves is None:
+            commands.append("clear_board")
+            moves = list()
+
+        num_common = 0
+        for m, t in zip(moves, target):
+            if m != t:
+                break
+            num_common += 1
+        num_undo = len(moves) - num_common
+        if num_undo > 0:
+            if self.support("undo") and num_undo <= num_common:
+                commands.extend([ "undo" ] * num_undo)
+            else:
+                commands.append("clear_board")
+                num_common = 0
+        commands.extend(
+            [ "play {} {}".format(c, v) for c, v in target[num_common:] ]
+        )
+        return commands
+
+    def sync_to(self, position):
+        return self.batch(self.sync_commands(position))
+
+    def quit(self, timeout=5.0):
+        try:
+            query = self._send_base("quit")
+        except Exception as err:
+            sys.stderr.write("{}\n".format(str(err)))
+            return
+        query.wait(timeout)
+
+        # The engine exits after answering the quit command. Give it a
+        # chance to exit by itself. The shutdown() kills it otherwise.
+        try:
+            self._pipe.wait(timeout)
+        except subprocess.TimeoutExpired:
+            pass
 
     def genmove(self, color):
         self.send_command("genmove {}".format(color))
         return self.return_response()
 
+    def final_status_list(self, status):
+        # Return the list of GtpVertex, e.g. the dead stones.
+        self.send_command("final_status_list {}".format(status))
+        return [ GtpVertex(v) for v in self.return_response().split() ]
+
 if __name__ == '__main__':
     try:
         gnugo = GtpEngine("gnugo --mode gtp")
@@ -0,0 +1,294 @@
+import asyncio
+import collections
+import sys
+from .gtp import Query, GtpResponseHandler, GtpStreamReader, GtpColor, GtpEngineError, GtpEngineDead, decode_analysis
+
+class AsyncGTPEnginePipe:
+    def __init__(self, command):
+        self.command = command
+        self._engine = None
+        self._running = False
+        self._pending = collections.deque()
+        self._waiters = collections.deque()
+        self._analysis_queue = asyncio.Queue()
+        self._reader = GtpStreamReader(
+            GtpResponseHandler(
+                self._finish_query, self._analysis_queue.put_nowait
+            ),
+            self._next_pending_query
+        )
+        self._tasks = list()
+
+    async def start(self):
+        self._engine = await asyncio.create_subprocess_exec(
+            *self.command.split(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        self._running = True
+        self._tasks = [
+            asyncio.create_task(self._handle_gtp_loop()),
+            asyncio.create_task(self._read_err_loop())
+        ]
+
+    def is_running(self):
+        return self._running
+
+    def analysis_empty(self):
+        return self._analysis_queue.empty()
+
+    def _finish_query(self, query):
+        waiter = self._waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(query)
+
+    async def send_query(self, query):
+        if not self._running:
+            raise GtpEngineDead("Engine is stop.")
+
+        waiter = asyncio.get_running_loop().create_future()
+
+        # Push the query and write it without yielding, so the order of
+        # pending queries always matches the order on the engine stdin.
+        self._pending.append(query)
+        self._waiters.append(waiter)
+        try:
+            self._engine.stdin.write(query.gtp_command.encode())
+            await self._engine.stdin.drain()
+        except (OSError, ConnectionResetError) as e:
+            # The query is not on the engine stdin. Take it back, or the
+            # later responses would resolve the wrong waiters.
+            self._running = False
+            if query in self._pending:
+                self._pending.remove(query)
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise GtpEngineDead("Engine is stop.")
+        return await waiter
+
+    async def send_gtp_command(self, cmd):
+        query = Query(
+            gtp_command="{}\n".format(cmd.strip())
+        )
+        return await self.send_query(query)
+
+    async def _read_err_loop(self):
+        while True:
+            line = await self._engine.stderr.readline()
+            if not line:
+                break
+            sys.stderr.write(line.decode(errors="replace"))
+            sys.stderr.flush()
+
+    def _next_pending_query(self):
+        if len(self._pending) == 0:
+            return None
+        return self._pending.popleft()
+
+    async def _handle_gtp_loop(self):
+        while True:
+            try:
+                data = await self._engine.stdout.read(GtpStreamReader.READ_SIZE)
+            except OSError as e:
+                break
+            if not data:
+                break
+            self._reader.feed(data)
+
+        # The engine closed its stdout. Nobody is going to answer the
+        # remaining queries.
+        self._running = False
+        self._pending.clear()
+        while len(self._waiters) > 0:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(GtpEngineDead("Engine is stop."))
+
+    async def get_analysis(self):
+        return decode_analysis(await self._analysis_queue.get())
+
+    def alive(self):
+        return self._engine is not None and \
+                   self._engine.returncode is None
+
+    async def wait(self):
+        return await self._engine.wait()
+
+    def kill(self):
+        return self._engine.kill()
+
+    async def wait_to_join(self):
+        self._running = False
+        for t in self._tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._tasks.clear()
+
+class AsyncGtpEngineBase:
+    def __init__(self, command):
+        self.command = command
+        self._pipe = None
+        self._supported_list = [
+            "list_commands"
+        ]
+
+    async def setup(self):
+        if self._pipe is None:
+            pipe = AsyncGTPEnginePipe(self.command)
+            await pipe.start()
+            self._pipe = pipe
+            await self._get_supported_commands()
+
+    async def _get_supported_commands(self):
+        query = await self._send_base("list_commands")
+        if query.result == "=":
+            self._supported_list = str(query).strip().split()
+
+    async def _send_base(self, gtp_command):
+        if self._pipe is None or not self._pipe.is_running():
+            raise GtpEngineDead("Engine is stop.", self)
+
+        if not isinstance(gtp_command, str):
+            raise Exception("Not string type.")
+
+        cmd_list = gtp_command.split()
+        if len(cmd_list) == 0:
+            raise Exception("String can not be empty.")
+
+        if cmd_list[0] not in self._supported_list:
+            raise Exception("Current command is not supported.")
+
+        try:
+            return await self._pipe.send_gtp_command(gtp_command)
+        except GtpEngineError as err:
+            err.engine = self
+            raise err
+
+    async def send_command(self, val):
+        # The dead engine is raised to the caller. Only the invalid
+        # command is None.
+        try:
+            query = await self._send_base(val)
+        except GtpEngineError:
+            raise
+        except Exception as err:
+            sys.stderr.write("{}\n".format(str(err)))
+            return None
+        return query
+
+    def support(self, val):
+        return val in self._supported_list
+
+    def analysis_empty(self):
+        return self._pipe.analysis_empty()
+
+    async def get_analysis_line(self):
+        return await self._pipe.get_analysis()
+
+    async def shutdown(self):
+        if self._pipe is None:
+            return
+        if self._pipe.alive():
+            sys.stderr.write("Kill the GTP engine process. It is not the recommend way. Please enter \"quit\" before closing it.\n")
+            self._pipe.kill()
+        await self._pipe.wait()
+        await self._pipe.wait_to_join()
+        self._pipe = None
+
+class AsyncGtpEngine(AsyncGtpEngineBase):
+    SUPPORTED_LIST = [
+        "name",
+        "version",
+        "protocol_version",
+        "list_commands",
+        "clear_board",
+        "boardsize",
+        "showboard",
+        "komi",
+        "play",
+        "genmove",
+        "quit"
+    ]
+
+    def __init__(self, command):
+        super().__init__(command)
+        self.raise_err = True
+
+    async def setup(self):
+        await super().setup()
+        self._self_check()
+
+    def _self_check(self):
+        for c in self.SUPPORTED_LIST:
+            if not self.support(c) and self.raise_err:
+                raise Exception("Need to support for GTP command: {}.".format(c))
+
+    async def return_response(self, val):
+        query = await self.send_command(val)
+        if query is None:
+            return None
+        if self.raise_err and query.result == "?":
+            raise Exception("Invalid command: ({}).".format(str(query)))
+        return str(query)
+
+    async def name(self):
+        return await self.return_response("name")
+
+    async def version(self):
+        return await self.return_response("version")
+
+    async def protocol_version(self):
+        return await self.return_response("protocol_version")
+
+    async def list_commands(self):
+        return await self.return_response("list_commands")
+
+    async def clear_board(self):
+        return await self.return_response("clear_board")
+
+    async def boardsize(self, bsize):
+        return await self.return_response("boardsize {}".format(bsize))
+
+    async def showboard(self):
+        return await self.return_response("showboard")
+
+    async def komi(self, komi):
+        return await self.return_response("komi {}".format(komi))
+
+    async def play(self, color, vertex):
+        return await self.return_response("play {} {}".format(color, vertex))
+
+    async def genmove(self, color):
+        return await self.return_response("genmove {}".format(color))
+
+    async def final_score(self):
+        return await self.return_response("final_score")
+
+    async def is_legal(self, color, vertex):
+        return await self.return_response("is_legal {} {}".format(color, vertex))
+
+    async def quit(self):
+        # The engine exits after answering the quit command.
+        await self.send_command("quit")
+        await self._pipe.wait()
+
+if __name__ == '__main__':
+    async def main():
+        engines = [ AsyncGtpEngine("gnugo --mode gtp") for _ in range(4) ]
+        await asyncio.gather(*[ e.setup() for e in engines ])
+
+        moves = await asyncio.gather(
+            *[ e.genmove(GtpColor(GtpColor.BLACK)) for e in engines ]
+        )
+        print(moves)
+
+        await asyncio.gather(*[ e.quit() for e in engines ])
+        await asyncio.gather(*[ e.shutdown() for e in engines ])
+
+    try:
+        asyncio.run(main())
+    except Exception as err:
+        sys.stderr.write("{}\n".format(str(err)))
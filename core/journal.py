@@ -0,0 +1,73 @@
+import json
+import os
+import sys
+
+class MatchJournal:
+    # The append-only journal of the finished games, one JSON line for
+    # each record. Every record is flushed and fsync'd before append()
+    # returns, so a crash loses at most the record being written. The
+    # torn last line of a crashed run is cut off when the journal is
+    # opened again. The records are not kept in memory; read_records()
+    # streams them from the file.
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self.num_skipped = 0
+        size = self._valid_size(path)
+        self._file = open(path, "ab")
+        if self._file.tell() != size:
+            self._file.truncate(size)
+            self._file.seek(size)
+            self._sync()
+
+    @classmethod
+    def _valid_size(cls, path):
+        # The size up to the last line break. Only the bytes after it
+        # are the torn record.
+        if not os.path.isfile(path):
+            return 0
+        with open(path, "rb") as f:
+            end = f.seek(0, os.SEEK_END)
+            pos = end
+            while pos > 0:
+                step = min(cls.READ_SIZE, pos)
+                f.seek(pos - step)
+                idx = f.read(step).rfind(b"\n")
+                if idx >= 0:
+                    return pos - step + idx + 1
+                pos -= step
+        return 0
+
+    def read_records(self):
+        # Yield the records one at a time. A broken line in the middle is
+        # skipped and reported, the records after it are kept.
+        self.num_skipped = 0
+        with open(self.path, "rb") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.endswith(b"\n"):
+                    break # Being written now.
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    self.num_skipped += 1
+                    sys.stderr.write("Skip the broken line {} of the journal {}.\n".format(
+                                         lineno, self.path))
+                    continue
+                yield record
+
+    def _sync(self):
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+    def append(self, record):
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        self._file.write(line.encode("utf-8"))
+        self._sync()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,142 @@
+import json
+import os
+import threading
+
+class LatencyHistogram:
+    # The upper bounds of the buckets in seconds. The last one is +Inf.
+    BOUNDS = [
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0,
+        10.0, 30.0, 60.0,
+        120.0, 300.0, float("inf")
+    ]
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+        self.buckets = [0] * len(self.BOUNDS)
+
+    def observe(self, val):
+        self.count += 1
+        self.sum += val
+        self.max = max(self.max, val)
+        for i, bound in enumerate(self.BOUNDS):
+            if val <= bound:
+                self.buckets[i] += 1
+                break
+
+    def quantile(self, q):
+        # The upper bound of the bucket which holds the quantile.
+        if self.count == 0:
+            return None
+        target = q * self.count
+        accm = 0
+        for bound, cnt in zip(self.BOUNDS, self.buckets):
+            accm += cnt
+            if accm >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count" : self.count,
+            "sum"   : self.sum,
+            "mean"  : self.sum / self.count if self.count > 0 else None,
+            "max"   : self.max,
+            "p50"   : self.quantile(0.5),
+            "p90"   : self.quantile(0.9),
+            "p99"   : self.quantile(0.99),
+            "buckets" : [ [ str(b), c ] for b, c in zip(self.BOUNDS, self.buckets) ]
+        }
+
+class LatencyStats:
+    # The latency of every GTP command of one engine.
+    #   write: from pushing the query to writing it into the engine stdin.
+    #   first_byte: from writing to the first byte of the response.
+    #   completion: from writing to the end of the response.
+    PHASES = ["write", "first_byte", "completion"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = dict()
+
+    def record(self, query):
+        if query.result is None or \
+               query.write_time is None or \
+               query.first_byte_time is None or \
+               query.finish_time is None:
+            return # The query is aborted.
+
+        values = [
+            query.write_time - query.push_time,
+            query.first_byte_time - query.write_time,
+            query.finish_time - query.write_time
+        ]
+        command = query.get_main_command()
+        with self._lock:
+            for phase, val in zip(self.PHASES, values):
+                key = (command, phase)
+                hist = self._histograms.get(key)
+                if hist is None:
+                    hist = LatencyHistogram()
+                    self._histograms[key] = hist
+                hist.observe(max(val, 0.))
+
+    def get(self, command, phase):
+        with self._lock:
+            return self._histograms.get((command, phase))
+
+    def items(self):
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def to_dict(self):
+        out = dict()
+        for (command, phase), hist in self.items():
+            out.setdefault(command, dict())[phase] = hist.to_dict()
+        return out
+
+def latency_to_json(stats_map):
+    # The stats_map is { (role, engine name) : LatencyStats }. The role is
+    # "engine" or "judge", so an engine named "judge" stays apart.
+    out = dict()
+    for (role, name), stats in stats_map.items():
+        out.setdefault(role, dict())[name] = stats.to_dict()
+    return json.dumps(out, indent=2)
+
+def latency_to_prometheus(stats_map):
+    def escape(val):
+        return val.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    out = list()
+    out.append("# HELP gtp_latency_seconds The GTP command latency.")
+    out.append("# TYPE gtp_latency_seconds histogram")
+    for (role, name), stats in stats_map.items():
+        for (command, phase), hist in stats.items():
+            labels = "role=\"{}\",engine=\"{}\",command=\"{}\",phase=\"{}\"".format(
+                         role, escape(name), escape(command), phase)
+            accm = 0
+            for bound, cnt in zip(hist.BOUNDS, hist.buckets):
+                accm += cnt
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append("gtp_latency_seconds_bucket{{{},le=\"{}\"}} {}".format(labels, le, accm))
+            out.append("gtp_latency_seconds_sum{{{}}} {}".format(labels, hist.sum))
+            out.append("gtp_latency_seconds_count{{{}}} {}".format(labels, hist.count))
+    return "\n".join(out) + "\n"
+
+def format_latency(stats_map, path):
+    # Use the Prometheus text format for .prom file, JSON otherwise.
+    if path.endswith(".prom"):
+        return latency_to_prometheus(stats_map)
+    return latency_to_json(stats_map)
+
+def dump_latency(stats_map, path):
+    data = format_latency(stats_map, path)
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -0,0 +1,189 @@
+from array import array
+import random
+from .gtp import GtpVertex, GtpColor
+from .sgf_parser import iter_named_games
+from .game_archive import GameArchive
+
+class OpeningBook:
+    # All openings are loaded and validated once. Each opening is one
+    # packed array of move codes, vertex index * 2 + color (1 is white),
+    # grouped by the board size. Sample an opening in O(1) with one of
+    # the 8 symmetries, without the file I/O. The games of an archive
+    # stay in the file, only their indices are kept.
+    NUM_SYMMETRIES = 8
+
+    def __init__(self):
+        self._openings = dict() # { board size : [ (name, codes) ] }
+        self._index = dict() # { name : (board size, position) }
+        self._symm_tables = dict() # { board size : [ table ] }
+        self._archives = dict() # { path : (GameArchive, { board size : indices }) }
+        self.errors = list() # [ (name, error) ]
+
+    def load(self, filenames):
+        # Every game of the SGF collection is one opening, named
+        # "<file>#<byte offset>" if the file has more than one game.
+        # The collection is streamed, so a huge archive is fine too.
+        for filename in filenames:
+            errors = list()
+            try:
+                for _, name, game in iter_named_games(filename, errors):
+                    self._add_game(name, game)
+            except Exception as err:
+                self.errors.append((filename, str(err)))
+            for offset, err in errors:
+                self.errors.append(("{}#{}".format(filename, offset), err))
+
+    def load_archive(self, filename):
+        # The games of the archive are named "<archive>#<index>". They
+        # were checked when the archive was packed.
+        try:
+            self._archives[filename] = (GameArchive(filename), dict())
+        except Exception as err:
+            self.errors.append((filename, str(err)))
+
+    def close(self):
+        for archive, _ in self._archives.values():
+            archive.close()
+        self._archives.clear()
+
+    def _archive_indices(self, path, board_size):
+        archive, pools = self._archives[path]
+        indices = pools.get(board_size)
+        if indices is None:
+            indices = array("L", archive.indices(board_size))
+            pools[board_size] = indices
+        return indices
+
+    def _find_archived(self, name):
+        # Return the path and the index of the archived opening, None if
+        # it is not one.
+        path, _, index = name.rpartition("#")
+        if not path in self._archives or not index.isdigit():
+            return None
+        index = int(index)
+        if index >= len(self._archives[path][0]):
+            return None
+        return path, index
+
+    def _add_game(self, name, game):
+        try:
+            if game.has_setup():
+                raise Exception("Do not support the setup stones.")
+            self.add(name, game.board_size, game.history())
+        except Exception as err:
+            self.errors.append((name, str(err)))
+
+    def add(self, name, board_size, history):
+        if board_size is None:
+            raise Exception("Miss the board size.")
+        if name in self._index:
+            raise Exception("Duplicate opening.")
+        codes = array("H")
+        for color, vtx in history:
+            if vtx.is_move():
+                x, y = vtx.get()
+                if x < 0 or x >= board_size or y < 0 or y >= board_size:
+                    raise Exception("The move {} is out of the board.".format(vtx))
+            elif not vtx.is_pass():
+                raise Exception("Invalid move {}.".format(vtx))
+            codes.append(vtx.to_index() * 2 + (1 if color.is_white() else 0))
+
+        openings = self._openings.setdefault(board_size, list())
+        self._index[name] = (board_size, len(openings))
+        openings.append((name, codes))
+
+    def size(self, board_size=None):
+        if board_size is not None:
+            return len(self._openings.get(board_size, list())) + \
+                       sum([ len(self._archive_indices(path, board_size)) for path in self._archives ])
+        total = len(self._index)
+        for archive, _ in self._archives.values():
+            for s in set(archive.board_sizes):
+                total += len(self._archive_indices(archive.filename, s))
+        return total
+
+    def remove(self, name):
+        # Swap with the last one, so the removal is O(1) too. Only the
+        # archived opening needs a search, which is rare.
+        if not name in self._index:
+            archived = self._find_archived(name)
+            if archived is None:
+                return
+            path, index = archived
+            archive = self._archives[path][0]
+            indices = self._archive_indices(path, archive.board_sizes[index])
+            try:
+                pos = indices.index(index)
+            except ValueError:
+                return
+            last = indices.pop()
+            if pos < len(indices):
+                indices[pos] = last
+            return
+        board_size, pos = self._index.pop(name)
+        openings = self._openings[board_size]
+        last = openings.pop()
+        if pos < len(openings):
+            openings[pos] = last
+            self._index[last[0]] = (board_size, pos)
+
+    def _symm_table(self, board_size, symm):
+        tables = self._symm_tables.get(board_size)
+        if tables is None:
+            tables = list()
+            for s in range(self.NUM_SYMMETRIES):
+                table = array("H", range(GtpVertex.NULL_INDEX + 1))
+                for y in range(board_size):
+                    for x in range(board_size):
+                        sx, sy = x, y
+                        if s & 1:
+                            sx, sy = sy, sx
+                        if s & 2:
+                            sx = board_size - 1 - sx
+                        if s & 4:
+                            sy = board_size - 1 - sy
+                        table[x + y * GtpVertex.MAX_BOARD_SIZE] = \
+                            sx + sy * GtpVertex.MAX_BOARD_SIZE
+                tables.append(table)
+            self._symm_tables[board_size] = tables
+        return tables[symm]
+
+    def get(self, name, symm=0):
+        # Return the moves of the opening, [ (GtpColor, GtpVertex) ].
+        if name in self._index:
+            board_size, pos = self._index[name]
+            codes = self._openings[board_size][pos][1]
+        else:
+            archived = self._find_archived(name)
+            if archived is None:
+                raise KeyError(name)
+            path, index = archived
+            archive = self._archives[path][0]
+            board_size, codes = archive.board_sizes[index], archive.moves(index)
+        table = self._symm_table(board_size, symm)
+        moves = list()
+        for code in codes:
+            color = GtpColor(GtpColor.WHITE if code & 1 else GtpColor.BLACK)
+            moves.append((color, GtpVertex.from_index(table[code >> 1])))
+        return moves
+
+    def sample(self, board_size, rng=random):
+        # Return the name, the symmetry and the moves. None if there is
+        # no opening of this board size.
+        openings = self._openings.get(board_size, list())
+        pools = [ (path, self._archive_indices(path, board_size)) for path in self._archives ]
+        total = len(openings) + sum([ len(indices) for _, indices in pools ])
+        if total == 0:
+            return None
+        r = rng.randrange(total)
+        if r < len(openings):
+            name = openings[r][0]
+        else:
+            r -= len(openings)
+            for path, indices in pools:
+                if r < len(indices):
+                    name = "{}#{}".format(path, indices[r])
+                    break
+                r -= len(indices)
+        symm = rng.randrange(self.NUM_SYMMETRIES)
+        return name, symm, self.get(name, symm)
@@ -0,0 +1,182 @@
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from .gtp import GtpEngineBase
+
+def process_rss(pid):
+    # The resident memory in bytes. Only support the /proc file system.
+    try:
+        with open("/proc/{}/statm".format(pid), "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+class GtpPipePool:
+    # Keep some pre-started warm engine pipes for each command, so the
+    # lazy engine does not spawn the process and load the network at the
+    # start of the game. A background thread refills the pool. The memory
+    # cap decides how many spare engines stay resident.
+    def __init__(self, num_spares=1, memory_cap=None, startup_timeout=GtpEngineBase.STARTUP_TIMEOUT):
+        self.num_spares = max(num_spares, 0)
+        self.memory_cap = memory_cap # in bytes
+        self.startup_timeout = startup_timeout # the default one
+        self._lock = threading.Lock()
+        self._spares = dict()
+        self._make_pipe_fns = dict()
+        self._startup_timeouts = dict()
+        self._rss_record = list()
+        self._refill_queue = queue.Queue()
+        self._running = True
+        self._refill_thread = threading.Thread(
+            target=self._refill_loop, daemon=True
+        )
+        self._refill_thread.start()
+
+    def register(self, command, make_pipe_fn, startup_timeout=None):
+        # The spare is killed if it is not ready before the startup
+        # timeout, the pool's default one if None.
+        with self._lock:
+            if command in self._make_pipe_fns:
+                return
+            self._make_pipe_fns[command] = make_pipe_fn
+            if startup_timeout is None:
+                startup_timeout = self.startup_timeout
+            self._startup_timeouts[command] = startup_timeout
+            self._spares[command] = list()
+        self._refill_queue.put(command)
+
+    def num_resident(self, command=None):
+        with self._lock:
+            if command is not None:
+                return len(self._spares.get(command, list()))
+            return sum([ len(v) for v in self._spares.values() ])
+
+    def resident_memory(self):
+        with self._lock:
+            pipes = [ p for v in self._spares.values() for p in v ]
+        return sum([ process_rss(p.pid()) for p in pipes ])
+
+    def _estimate_rss(self):
+        with self._lock:
+            if len(self._rss_record) == 0:
+                return 0
+            return sum(self._rss_record) / len(self._rss_record)
+
+    def _memory_allow(self):
+        if self.memory_cap is None:
+            return True
+        return self.resident_memory() + self._estimate_rss() <= self.memory_cap
+
+    def acquire(self, command):
+        # Return a warm pipe or None if there is no spare one.
+        pipe = None
+        dead_pipes = list()
+        with self._lock:
+            spares = self._spares.get(command)
+            while spares is not None and len(spares) > 0:
+                p = spares.pop()
+                if p.is_running() and p.alive():
+                    pipe = p
+                    break
+                dead_pipes.append(p)
+        for p in dead_pipes:
+            self._close_pipe(p)
+        if command in self._make_pipe_fns:
+            self._refill_queue.put(command)
+        return pipe
+
+    def release(self, command, pipe):
+        # Keep the used pipe as a spare one if the pool needs it. Return
+        # False if the caller should quit it.
+        if not self._running or \
+               not pipe.is_running() or \
+               not pipe.alive():
+            return False
+        with self._lock:
+            spares = self._spares.get(command)
+            if spares is None or len(spares) >= self.num_spares:
+                return False
+        if not self._memory_allow():
+            return False
+        pipe.pop_query()
+        pipe.set_latency(None)
+        with self._lock:
+            spares.append(pipe)
+        return True
+
+    def _spawn(self, command):
+        pipe = self._make_pipe_fns[command]()
+
+        # The spare pipe belongs to no engine yet. The engine which adopts
+        # it hooks its own latency stats.
+        pipe.set_latency(None)
+
+        # Wait for the engine being ready. Wake up now and then, so the
+        # shutdown() does not wait for a hung spare.
+        pipe.push_gtp_command("list_commands")
+        timeout = self._startup_timeouts[command]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        query = None
+        while query is None and self._running and pipe.is_running():
+            wait = 0.5
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    break
+            query = pipe.try_get_query(block=True, timeout=wait)
+        if query is None or query.result != "=":
+            self._close_pipe(pipe, force=query is None)
+            raise Exception("Fail to start the spare engine: {}.".format(command))
+        rss = process_rss(pipe.pid())
+        with self._lock:
+            self._rss_record.append(rss)
+            self._rss_record = self._rss_record[-16:]
+        return pipe
+
+    def _refill_loop(self):
+        while self._running:
+            command = self._refill_queue.get(block=True)
+            if command is None:
+                break # Stop by shutdown().
+
+            while self._running and \
+                      self.num_resident(command) < self.num_spares and \
+                      self._memory_allow():
+                try:
+                    pipe = self._spawn(command)
+                except Exception as err:
+                    sys.stderr.write("{}\n".format(err))
+                    break
+                with self._lock:
+                    self._spares[command].append(pipe)
+
+    def _close_pipe(self, pipe, force=False):
+        # Kill it at once if forced, e.g. the spare is hung.
+        if not force and pipe.is_running():
+            query = pipe.push_gtp_command("quit")
+            query.wait(5.0)
+            try:
+                pipe.wait(5.0)
+            except subprocess.TimeoutExpired:
+                pass
+        if pipe.alive():
+            pipe.kill()
+            pipe.wait()
+        pipe.wait_to_join()
+
+    def shutdown(self):
+        if not self._running:
+            return
+        self._running = False
+        self._refill_queue.put(None)
+        self._refill_thread.join()
+        with self._lock:
+            pipes = [ p for v in self._spares.values() for p in v ]
+            for v in self._spares.values():
+                v.clear()
+        for p in pipes:
+            self._close_pipe(p)
@@ -0,0 +1,163 @@
+import sqlite3
+import time
+
+# The schema of the results database. Every finished game is one row of
+# games. The pair index serves both colors of a pair, and the engine
+# indexes keep the games of each color in id order. The
+# pair_stats table is kept by the trigger, so the W/D/L summaries read a
+# few small rows however many games there are.
+SCHEMA_VERSION = 1
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    id            INTEGER PRIMARY KEY,
+    run           TEXT,
+    finished      REAL,
+    black         TEXT NOT NULL,
+    white         TEXT NOT NULL,
+    winner        TEXT,
+    result        TEXT,
+    opening       TEXT,
+    symmetry      INTEGER,
+    opening_moves INTEGER,
+    moves         INTEGER,
+    duration      REAL,
+    black_time    REAL,
+    white_time    REAL
+);
+CREATE INDEX IF NOT EXISTS games_pair ON games(black, white);
+CREATE INDEX IF NOT EXISTS games_black ON games(black);
+CREATE INDEX IF NOT EXISTS games_white ON games(white);
+CREATE TABLE IF NOT EXISTS pair_stats (
+    black      TEXT NOT NULL,
+    white      TEXT NOT NULL,
+    games      INTEGER NOT NULL,
+    black_wins INTEGER NOT NULL,
+    white_wins INTEGER NOT NULL,
+    draws      INTEGER NOT NULL,
+    moves      INTEGER NOT NULL,
+    duration   REAL NOT NULL,
+    PRIMARY KEY (black, white)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS games_stats AFTER INSERT ON games
+BEGIN
+    INSERT INTO pair_stats VALUES (
+        NEW.black, NEW.white, 1,
+        NEW.winner IS NEW.black,
+        NEW.winner IS NEW.white,
+        NEW.winner IS NULL,
+        IFNULL(NEW.moves, 0), IFNULL(NEW.duration, 0.))
+    ON CONFLICT (black, white) DO UPDATE SET
+        games = games + 1,
+        black_wins = black_wins + excluded.black_wins,
+        white_wins = white_wins + excluded.white_wins,
+        draws = draws + excluded.draws,
+        moves = moves + excluded.moves,
+        duration = duration + excluded.duration;
+END;
+"""
+
+GAME_COLUMNS = [ "id", "run", "finished", "black", "white", "winner", "result",
+                 "opening", "symmetry", "opening_moves", "moves",
+                 "duration", "black_time", "white_time" ]
+
+class ResultsDB:
+    # The SQLite store of the finished games. The database is in the WAL
+    # mode, so every record is one cheap commit and the query tool may
+    # read it while the match is running. It is not thread-safe, the
+    # caller holds the lock.
+    def __init__(self, path, run=None, readonly=False):
+        self.path = path
+        self.run = run
+        if readonly:
+            self._conn = sqlite3.connect(
+                             "file:{}?mode=ro".format(path), uri=True, check_same_thread=False)
+            return
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            self._conn.close()
+            raise Exception("Do not support the results database version {}.".format(version))
+        self._conn.executescript(_SCHEMA)
+        self._conn.execute("PRAGMA user_version={}".format(SCHEMA_VERSION))
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def record(self, black, white, winner, result, opening=None, symmetry=None,
+               opening_moves=None, moves=None, duration=None, black_time=None, white_time=None):
+        # Add one finished game. The winner is the engine name, None if
+        # draw. Return the row id.
+        with self._conn:
+            cur = self._conn.execute(
+                      "INSERT INTO games (run, finished, black, white, winner, result, "
+                      "opening, symmetry, opening_moves, moves, duration, black_time, white_time) "
+                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                      (self.run, time.time(), black, white, winner, result,
+                       opening, symmetry, opening_moves, moves, duration, black_time, white_time))
+        return cur.lastrowid
+
+    def num_games(self):
+        return self._conn.execute("SELECT IFNULL(SUM(games), 0) FROM pair_stats").fetchone()[0]
+
+    def engine_stats(self, name=None):
+        # Return [ (engine, games, wins, draws, losses, black games, black
+        # wins, white games, white wins) ] from the pair stats. All engines
+        # if the name is None.
+        rows = self._conn.execute(
+                   "SELECT engine, SUM(games), SUM(wins), SUM(draws), SUM(games) - SUM(wins) - SUM(draws), "
+                   "SUM(black_games), SUM(black_wins), SUM(games) - SUM(black_games), SUM(wins) - SUM(black_wins) "
+                   "FROM ("
+                   "  SELECT black AS engine, games, black_wins AS wins, draws, "
+                   "         games AS black_games, black_wins FROM pair_stats "
+                   "  UNION ALL "
+                   "  SELECT white AS engine, games, white_wins AS wins, draws, "
+                   "         0 AS black_games, 0 AS black_wins FROM pair_stats"
+                   ") WHERE ? IS NULL OR engine = ? "
+                   "GROUP BY engine ORDER BY engine", (name, name))
+        return rows.fetchall()
+
+    def pair_stats(self, name, opponent=None):
+        # Return [ (opponent, games, wins, draws, losses, average moves,
+        # average duration) ] of the engine against each opponent, or
+        # only the given one.
+        rows = self._conn.execute(
+                   "SELECT opponent, SUM(games), SUM(wins), SUM(draws), SUM(games) - SUM(wins) - SUM(draws), "
+                   "1.0 * SUM(moves) / SUM(games), SUM(duration) / SUM(games) "
+                   "FROM ("
+                   "  SELECT white AS opponent, games, black_wins AS wins, draws, moves, duration "
+                   "  FROM pair_stats WHERE black = ? "
+                   "  UNION ALL "
+                   "  SELECT black AS opponent, games, white_wins AS wins, draws, moves, duration "
+                   "  FROM pair_stats WHERE white = ? "
+                   ") WHERE ? IS NULL OR opponent = ? "
+                   "GROUP BY opponent ORDER BY opponent", (name, name, opponent, opponent))
+        return rows.fetchall()
+
+    def games(self, name=None, opponent=None, limit=20):
+        # Return the latest games as dicts, of the engine (against the
+        # opponent) if given. Each color is read backwards from its own
+        # index, so no sort is needed.
+        columns = ", ".join(GAME_COLUMNS)
+        if name is None:
+            sql = "SELECT {} FROM games ORDER BY id DESC LIMIT ?".format(columns)
+            params = (limit,)
+        elif opponent is None:
+            sql = ("SELECT {0} FROM ("
+                   "  SELECT * FROM (SELECT * FROM games WHERE black = ? ORDER BY id DESC LIMIT ?) "
+                   "  UNION ALL "
+                   "  SELECT * FROM (SELECT * FROM games WHERE white = ? ORDER BY id DESC LIMIT ?)"
+                   ") ORDER BY id DESC LIMIT ?").format(columns)
+            params = (name, limit, name, limit, limit)
+        else:
+            sql = ("SELECT {0} FROM ("
+                   "  SELECT * FROM (SELECT * FROM games WHERE black = ? AND white = ? ORDER BY id DESC LIMIT ?) "
+                   "  UNION ALL "
+                   "  SELECT * FROM (SELECT * FROM games WHERE black = ? AND white = ? ORDER BY id DESC LIMIT ?)"
+                   ") ORDER BY id DESC LIMIT ?").format(columns)
+            params = (name, opponent, limit, opponent, name, limit, limit)
+        return [ dict(zip(GAME_COLUMNS, row)) for row in self._conn.execute(sql, params) ]
@@ -0,0 +1,181 @@
+import heapq
+import random
+
+class AliasTable:
+    # Vose's alias method. Build in O(N), sample in O(1).
+    def __init__(self, weights):
+        size = len(weights)
+        total = sum(weights)
+        self.size = size
+        self.prob = [0.] * size
+        self.alias = [0] * size
+        if size == 0 or total <= 0.:
+            raise Exception("The weights must be positive.")
+
+        scaled = [ w * size / total for w in weights ]
+        small = [ i for i, p in enumerate(scaled) if p < 1. ]
+        large = [ i for i, p in enumerate(scaled) if p >= 1. ]
+        while len(small) > 0 and len(large) > 0:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.
+            if scaled[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
+        for i in large + small:
+            self.prob[i] = 1.
+
+    def sample(self, rng=random):
+        i = rng.randrange(self.size)
+        if rng.random() < self.prob[i]:
+            return i
+        return self.alias[i]
+
+class PairingScheduler:
+    # Pick the engine pair of the next game. The first engine is the one
+    # with the fewest finished plus running games, kept in a heap. The
+    # second engine is sampled by the Elo difference,
+    #     weight = 1 / (1 + 10 ^ (diff / factor)).
+    # The weights come from a table of the Elo difference quantized by
+    # elo_step. Try the rejection sampling first, pick one engine
+    # uniformly and accept it with weight / max weight, so no table is
+    # rebuilt after the ratings change. Fall back to the cached alias
+    # table if the weights are too small. The result is exactly
+    # proportional to the weights either way.
+    #
+    # In the "info-gain" mode, the second engine is the one which most
+    # reduces the rating uncertainty, p * (1 - p) * (1/(n1+1) + 1/(n2+1)),
+    # where p is the expected score and n is the number of games.
+    ELO = "elo"
+    INFO_GAIN = "info-gain"
+    REJECTION_TRIALS = 16
+
+    def __init__(self, factor=400., mode=ELO, elo_step=1.):
+        if not mode in [self.ELO, self.INFO_GAIN]:
+            raise Exception("Invalid pairing mode.")
+        self.factor = factor
+        self.mode = mode
+        self.elo_step = elo_step
+        self._elo = list()
+        self._qelo = list()
+        self._games = list()
+        self._playing = list()
+        self._heap = list()
+        self._weights = list()
+        self._version = 0
+        self._alias_cache = dict() # { idx : (version, AliasTable) }
+
+    def add(self, elo, games=0):
+        # Return the index of the new player.
+        idx = len(self._elo)
+        self._elo.append(elo)
+        self._qelo.append(self._quantize(elo))
+        self._games.append(games)
+        self._playing.append(0)
+        self._version += 1
+        self._push(idx)
+        return idx
+
+    def size(self):
+        return len(self._elo)
+
+    def _quantize(self, elo):
+        return int(round(elo / self.elo_step))
+
+    def _load(self, idx):
+        return self._games[idx] + self._playing[idx]
+
+    def _push(self, idx):
+        # Lazy deletion. The entry is stale if its load is not current.
+        heapq.heappush(self._heap, (self._load(idx), random.random(), idx))
+        if len(self._heap) > 4 * len(self._elo) + 16:
+            self._heap = [ (self._load(i), random.random(), i) for i in range(len(self._elo)) ]
+            heapq.heapify(self._heap)
+
+    def update(self, idx, elo=None, games=None, playing=None):
+        load = self._load(idx)
+        if elo is not None:
+            self._elo[idx] = elo
+            qelo = self._quantize(elo)
+            if qelo != self._qelo[idx]:
+                self._qelo[idx] = qelo
+                self._version += 1
+        if games is not None:
+            self._games[idx] = games
+        if playing is not None:
+            self._playing[idx] = playing
+        if self._load(idx) != load:
+            self._push(idx)
+
+    def _weight(self, diff):
+        # diff is the quantized Elo difference.
+        diff = abs(diff)
+        while diff >= len(self._weights):
+            d = len(self._weights) * self.elo_step
+            self._weights.append(1. / (1. + pow(10., d / self.factor)))
+        return self._weights[diff]
+
+    def _first(self):
+        while True:
+            load, _, idx = self._heap[0]
+            if load == self._load(idx):
+                return idx
+            heapq.heappop(self._heap)
+
+    def _alias_table(self, first):
+        version, table = self._alias_cache.get(first, (None, None))
+        if version != self._version:
+            qelo = self._qelo[first]
+            weights = [ self._weight(q - qelo) if i != first else 0.
+                            for i, q in enumerate(self._qelo) ]
+            table = AliasTable(weights)
+            self._alias_cache[first] = (self._version, table)
+        return table
+
+    def _info_gain(self, first, other):
+        p = 1. / (1. + pow(10., (self._elo[other] - self._elo[first]) / 400.))
+        return p * (1. - p) * (1. / (self._games[first] + 1) + 1. / (self._games[other] + 1))
+
+    def sample(self):
+        # Return the indices of two different players.
+        if len(self._elo) < 2:
+            raise Exception("Need two players at least.")
+        first = self._first()
+        if self.mode == self.INFO_GAIN:
+            best, second = None, None
+            for i in range(len(self._elo)):
+                if i == first:
+                    continue
+                gain = self._info_gain(first, i) * (1. + 1e-6 * random.random())
+                if best is None or gain > best:
+                    best, second = gain, i
+        else:
+            second = self._sample_second(first)
+        return first, second
+
+    def _sample_second(self, first):
+        size = len(self._qelo)
+        qelo = self._qelo[first]
+        max_weight = self._weight(0)
+        for _ in range(self.REJECTION_TRIALS):
+            i = random.randrange(size)
+            if i != first and \
+                   random.random() * max_weight < self._weight(self._qelo[i] - qelo):
+                return i
+        return self._alias_table(first).sample()
+
+if __name__ == '__main__':
+    scheduler = PairingScheduler(400.)
+    for elo in [1000, 1200, 1400, 1600]:
+        scheduler.add(elo)
+    counts = dict()
+    for _ in range(1000):
+        first, second = scheduler.sample()
+        counts[(first, second)] = counts.get((first, second), 0) + 1
+        scheduler.update(first, games=scheduler._games[first] + 1)
+        scheduler.update(second, games=scheduler._games[second] + 1)
+    for k in sorted(counts.keys()):
+        print(k, counts[k])
@@ -1,14 +1,34 @@
 from .gtp import GtpVertex, GtpColor
+from .sgf_parser import SgfError
 import random
 
 class SgfLoader:
-    def __init__(self, filename):
+    def __init__(self, filename=None):
         self.history = list()
         self.black_player = str()
         self.white_player = str()
         self.board_size = None
         self.komi = None
-        self._load(filename)
+        if filename is not None:
+            self._load(filename)
+
+    @staticmethod
+    def from_archive(archive, index=None):
+        # Load the game of the GameArchive by the index, or a random game
+        # if the index is None. Reading the moves is one mmap slice.
+        loader = SgfLoader()
+        if index is None:
+            index = archive.sample()
+            if index is None:
+                raise SgfError("The archive has no game.")
+        game = archive.game(index)
+        loader.board_size = game.board_size
+        loader.komi = game.komi
+        loader.black_player = game.black_player
+        loader.white_player = game.white_player
+        loader.history = game.history()
+        loader._apply_symm()
+        return loader
 
     def _process_key_value(self, key, val):
         def as_gtp_move(m, bsize=self.board_size):
@@ -74,9 +94,10 @@ class SgfLoader:
         def move_symm(vtx, symm, bsize=self.board_size):
             if vtx.is_move():
                 x, y = vtx.get()
-                if symm & 4:
+                # The same bits as the OpeningBook symmetry table.
+                if symm & 1:
                     x, y = y, x
-                if symm & 4:
+                if symm & 2:
                     x = bsize - 1 - x
                 if symm & 4:
                     y = bsize - 1 - y
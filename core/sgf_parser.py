@@ -0,0 +1,565 @@
+from array import array
+import mmap
+import os
+import re
+from .gtp import GtpVertex, GtpColor
+
+# The property value uses the unrolled loop, so the regex engine does
+# not try the alternation for every character.
+_VALUE = r"\[[^\\\]]*(?:\\.[^\\\]]*)*\]"
+_PROP = r"[A-Z]+\s*(?:" + _VALUE + r"\s*)+"
+
+# One regex match for each token.
+_TOKEN_RE = re.compile(
+    r"\s*(?:(;)|(\()|(\))|([A-Za-z]+)\s*((?:" + _VALUE + r"\s*)+))",
+    re.S
+)
+_VALUE_RE = re.compile(r"\[([^\\\]]*(?:\\.[^\\\]]*)*)\]", re.S)
+_ESCAPE_RE = re.compile(r"\\(\r\n|\n\r|\n|\r|.)", re.S)
+
+# The fast path. One findall over the game without variations, which
+# splits it into the tokens and checks the structure on the way. The
+# plain move node, e.g. ";B[pd]", is one token of (color, point). The
+# other tokens are (ident, values) or one character. A character which
+# is not ";", "(" or ")" is the syntax error.
+_GAME_TOKEN_RE = re.compile(
+    r"\s*(?:;\s*([BW])\[([a-z]{0,2})\]|([A-Z]+)\s*((?:" + _VALUE + r"\s*)+)|(.))",
+    re.S
+)
+_END_RE = re.compile(r"\s*\Z")
+_MOVE_IDENTS = { "B", "W" }
+_SETUP_IDENTS = { "AB", "AW", "AE" }
+
+# The same fast path on the raw bytes of the memory mapped file. The
+# index only needs the game boundaries, one match for each game.
+_GAME_TOKEN_RE_B = re.compile(_GAME_TOKEN_RE.pattern.encode(), re.S)
+_VALUE_RE_B = re.compile(_VALUE_RE.pattern.encode(), re.S)
+_SIMPLE_GAME_RE_B = re.compile(
+    (r"\s*\(\s*;\s*(?:" + _PROP + r")*(?:;\s*(?:" + _PROP + r")*)*\)").encode(),
+    re.S
+)
+_SPACE_RE_B = re.compile(rb"\s*")
+_EXTENT_RE_B = re.compile(rb"\[[^\\\]]*(?:\\.[^\\\]]*)*\]|[()]", re.S)
+_MOVE_IDENTS_B = { b"B", b"W" }
+_SETUP_IDENTS_B = { b"AB", b"AW", b"AE" }
+
+def _unescape_char(m):
+    # The escaped line break is the soft line break. Remove it.
+    c = m.group(1)
+    if c in ["\r\n", "\n\r", "\n", "\r"]:
+        return ""
+    return c
+
+def unescape(value):
+    if "\\" not in value:
+        return value
+    return _ESCAPE_RE.sub(_unescape_char, value)
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("]", "\\]")
+
+class SgfError(Exception):
+    pass
+
+class SgfTree:
+    # One game tree. The nodes are the main sequence, and every child is
+    # one variation after it. A node is a dict, { ident : [ values ] }.
+    __slots__ = ["nodes", "children"]
+
+    def __init__(self):
+        self.nodes = list()
+        self.children = list()
+
+    def main_line(self):
+        # Yield the nodes of the first variation.
+        tree = self
+        while tree is not None:
+            for node in tree.nodes:
+                yield node
+            tree = tree.children[0] if len(tree.children) > 0 else None
+
+def _error(text, pos, msg):
+    line = text.count("\n", 0, pos) + 1
+    return SgfError("{} at line {}.".format(msg, line))
+
+def _parse_trees(text, pos=0, max_trees=None):
+    # Return the game trees and the end position. Stop after max_trees
+    # trees if it is not None.
+    trees = list()
+    stack = list()
+    curr = None
+    node = None
+    start = pos
+
+    for m in _TOKEN_RE.finditer(text, pos):
+        if m.start() != pos:
+            break
+        pos = m.end()
+        kind = m.lastindex
+
+        if kind == 5:
+            if node is None:
+                raise _error(text, m.start(), "The property is out of the node")
+            ident = m.group(4)
+            if not ident.isupper():
+                # FF[3] allows the lowercase letters, e.g. "AddBlack".
+                ident = "".join([ c for c in ident if c.isupper() ])
+            values = m.group(5)
+            if "\\" not in values and values.count("]") == 1:
+                # The common single value without any escape.
+                values = [ values.strip()[1:-1] ]
+            else:
+                values = [ unescape(v) for v in _VALUE_RE.findall(values) ]
+            if ident in node:
+                node[ident].extend(values)
+            else:
+                node[ident] = values
+        elif kind == 1:
+            if curr is None or len(curr.children) > 0:
+                raise _error(text, m.start(), "The node is out of the sequence")
+            node = dict()
+            curr.nodes.append(node)
+        elif kind == 2:
+            tree = SgfTree()
+            if curr is None:
+                trees.append(tree)
+            else:
+                curr.children.append(tree)
+            stack.append(curr)
+            curr = tree
+            node = None
+        else:
+            if curr is None:
+                raise _error(text, m.start(), "Unbalanced parenthesis")
+            if len(curr.nodes) == 0:
+                raise _error(text, m.start(), "Empty game tree")
+            curr = stack.pop()
+            node = None
+            if curr is None and max_trees is not None and len(trees) >= max_trees:
+                return trees, pos
+
+    if curr is not None:
+        raise _error(text, pos, "Unterminated game tree")
+    if _END_RE.match(text, pos) is None or len(trees) == 0 and pos == start and max_trees is not None:
+        raise _error(text, pos, "Invalid SGF data")
+    return trees, pos
+
+def parse_sgf(text):
+    # Parse the whole collection in a single pass. Return the list of
+    # SgfTree, one for each game.
+    if text.startswith("\ufeff"):
+        text = text[1:]
+    trees, _ = _parse_trees(text)
+    return trees
+
+_POINT_TABLES = dict()
+_BINARY_POINT_TABLES = dict()
+
+def _point_table(board_size, binary=False):
+    # { SGF point : vertex index } of the board size. The empty point is
+    # the pass, and so is "tt" on the board up to 19x19. The keys are
+    # bytes if binary is True.
+    if binary:
+        table = _BINARY_POINT_TABLES.get(board_size)
+        if table is None:
+            table = { k.encode() : v for k, v in _point_table(board_size).items() }
+            _BINARY_POINT_TABLES[board_size] = table
+        return table
+    table = _POINT_TABLES.get(board_size)
+    if table is None:
+        letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        table = dict()
+        for y in range(board_size):
+            for x in range(board_size):
+                point = letters[x] + letters[y]
+                table[point] = GtpVertex((x, board_size - 1 - y)).to_index()
+        table[""] = GtpVertex.PASS_INDEX
+        if board_size <= 19:
+            table["tt"] = GtpVertex.PASS_INDEX
+        _POINT_TABLES[board_size] = table
+    return table
+
+class SgfGame:
+    # The main line of one game. The moves are packed, vertex index * 2 +
+    # color (1 is white). The setup stones are the vertex indices of the
+    # root node.
+    def __init__(self):
+        self.board_size = 19
+        self.komi = None
+        self.black_player = str()
+        self.white_player = str()
+        self.result = None
+        self.setup_black = array("H")
+        self.setup_white = array("H")
+        self.moves = array("H")
+
+    @staticmethod
+    def from_tree(tree):
+        game = SgfGame()
+        nodes = tree.main_line()
+        root = next(nodes)
+        game._read_root(root)
+        table = _point_table(game.board_size)
+        moves = game.moves
+        try:
+            for node in nodes:
+                if "B" in node:
+                    moves.append(table[node["B"][0]] * 2)
+                if "W" in node:
+                    moves.append(table[node["W"][0]] * 2 + 1)
+                if "AB" in node or "AW" in node or "AE" in node:
+                    raise SgfError("Do not support the setup stones after the root node.")
+        except KeyError as err:
+            raise SgfError("Invalid move {}.".format(err))
+        return game
+
+    def _read_root(self, root):
+        if "SZ" in root:
+            size = root["SZ"][0].split(":")
+            if len(size) != 1 and size[0] != size[1]:
+                raise SgfError("Do not support the rectangular board.")
+            try:
+                self.board_size = int(size[0])
+            except ValueError:
+                raise SgfError("Invalid board size {}.".format(root["SZ"][0]))
+            if self.board_size < 2 or self.board_size > GtpVertex.MAX_BOARD_SIZE:
+                raise SgfError("Invalid board size {}.".format(self.board_size))
+        if "KM" in root:
+            try:
+                self.komi = float(root["KM"][0])
+            except ValueError:
+                raise SgfError("Invalid komi {}.".format(root["KM"][0]))
+        self.black_player = root.get("PB", [str()])[0]
+        self.white_player = root.get("PW", [str()])[0]
+        self.result = root.get("RE", [None])[0]
+
+        table = _point_table(self.board_size)
+        self.setup_black = self._read_points(root.get("AB", list()), table)
+        self.setup_white = self._read_points(root.get("AW", list()), table)
+        # The root node may carry the first move too.
+        if "B" in root or "W" in root:
+            try:
+                if "B" in root:
+                    self.moves.append(table[root["B"][0]] * 2)
+                if "W" in root:
+                    self.moves.append(table[root["W"][0]] * 2 + 1)
+            except KeyError as err:
+                raise SgfError("Invalid move {}.".format(err))
+
+    def _read_points(self, values, table):
+        # Expand the compressed point list, e.g. "aa:cc".
+        points = array("H")
+        try:
+            for v in values:
+                if ":" in v:
+                    first, last = v.split(":")
+                    x0, y0 = table[first] % GtpVertex.MAX_BOARD_SIZE, table[first] // GtpVertex.MAX_BOARD_SIZE
+                    x1, y1 = table[last] % GtpVertex.MAX_BOARD_SIZE, table[last] // GtpVertex.MAX_BOARD_SIZE
+                    for y in range(min(y0, y1), max(y0, y1) + 1):
+                        for x in range(min(x0, x1), max(x0, x1) + 1):
+                            points.append(x + y * GtpVertex.MAX_BOARD_SIZE)
+                elif table[v] != GtpVertex.PASS_INDEX:
+                    points.append(table[v])
+        except (KeyError, ValueError):
+            raise SgfError("Invalid point list {}.".format(values))
+        return points
+
+    def has_setup(self):
+        return len(self.setup_black) > 0 or len(self.setup_white) > 0
+
+    def history(self):
+        # Return the moves as [ (GtpColor, GtpVertex) ].
+        black = GtpColor(GtpColor.BLACK)
+        white = GtpColor(GtpColor.WHITE)
+        return [ (white if code & 1 else black, GtpVertex.from_index(code >> 1))
+                     for code in self.moves ]
+
+    def _point(self, index):
+        if index == GtpVertex.PASS_INDEX:
+            return "tt" if self.board_size <= 19 else ""
+        letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+        x = index % GtpVertex.MAX_BOARD_SIZE
+        y = index // GtpVertex.MAX_BOARD_SIZE
+        return letters[x] + letters[self.board_size - 1 - y]
+
+    def to_sgf(self):
+        # Write the game back as one SGF game tree.
+        buf = [ "(;GM[1]FF[4]SZ[{}]".format(self.board_size) ]
+        if self.komi is not None:
+            buf.append("KM[{:g}]".format(self.komi))
+        for ident, value in [("PB", self.black_player),
+                             ("PW", self.white_player),
+                             ("RE", self.result)]:
+            if value:
+                buf.append("{}[{}]".format(ident, escape(value)))
+        for ident, points in [("AB", self.setup_black),
+                              ("AW", self.setup_white)]:
+            if len(points) > 0:
+                buf.append(ident + "".join([ "[{}]".format(self._point(p)) for p in points ]))
+        for code in self.moves:
+            buf.append(";{}[{}]".format("W" if code & 1 else "B", self._point(code >> 1)))
+        buf.append(")\n")
+        return "".join(buf)
+
+def _parse_simple_game(buf, pos, binary=False):
+    # The fast path of the game at pos. Return the SgfGame and the end,
+    # or None if the game needs the full parser, e.g. it has variations
+    # or errors. The full parser reports the errors.
+    if binary:
+        token_re, value_re, move_idents, setup_idents = \
+            _GAME_TOKEN_RE_B, _VALUE_RE_B, _MOVE_IDENTS_B, _SETUP_IDENTS_B
+        lparen, rparen, semi, white = b"(", b")", b";", b"W"
+    else:
+        token_re, value_re, move_idents, setup_idents = \
+            _GAME_TOKEN_RE, _VALUE_RE, _MOVE_IDENTS, _SETUP_IDENTS
+        lparen, rparen, semi, white = "(", ")", ";", "W"
+    def decode(v):
+        return v.decode("utf-8", errors="replace") if binary else v
+
+    # The first ")" ends the game without variations. If it is in a
+    # comment, the value is cut and the token is a syntax error.
+    end = buf.find(rparen, pos) + 1
+    if end == 0:
+        return None
+    tokens = token_re.findall(buf, pos, end)
+    if len(tokens) < 3 or tokens[0][4] != lparen or tokens[-1][4] != rparen:
+        return None
+
+    root = dict()
+    game = None
+    nodes = 0
+    for color, point, ident, values, other in tokens[1:-1]:
+        if not color and not ident:
+            if other != semi:
+                return None
+            nodes += 1
+            continue
+        if color:
+            nodes += 1
+            if nodes == 1:
+                root.setdefault(decode(color), list()).append(decode(point))
+                continue
+        elif nodes == 0:
+            return None
+        elif nodes == 1:
+            values = [ unescape(decode(v)) for v in value_re.findall(values) ]
+            root.setdefault(decode(ident), list()).extend(values)
+            continue
+        elif ident in setup_idents:
+            return None
+        elif ident in move_idents:
+            color, point = ident, value_re.match(values).group(1)
+        else:
+            continue
+
+        if game is None:
+            game = SgfGame()
+            try:
+                game._read_root(root)
+            except SgfError:
+                return None
+            table = _point_table(game.board_size, binary)
+            append = game.moves.append
+        code = table.get(point)
+        if code is None:
+            return None
+        append(code * 2 + (color == white))
+
+    if nodes == 0:
+        return None
+    if game is None:
+        game = SgfGame()
+        try:
+            game._read_root(root)
+        except SgfError:
+            return None
+    return game, end
+
+def parse_sgf_games(text):
+    # Return the main line of every game in the collection. The game
+    # without variations takes the fast path.
+    if text.startswith("\ufeff"):
+        text = text[1:]
+    games = list()
+    pos = 0
+    while _END_RE.match(text, pos) is None:
+        simple = _parse_simple_game(text, pos)
+        if simple is not None:
+            game, pos = simple
+            games.append(game)
+            continue
+        trees, pos = _parse_trees(text, pos, 1)
+        games.append(SgfGame.from_tree(trees[0]))
+    return games
+
+def load_sgf(filename):
+    # Return the list of SgfGame in the file.
+    with open(filename, "rb") as f:
+        data = f.read()
+    return parse_sgf_games(data.decode("utf-8", errors="replace"))
+
+class SgfCollection:
+    # Stream the games of a huge SGF collection file. The file is memory
+    # mapped and the games are parsed one at a time, so the memory stays
+    # flat however large the archive is. Every game comes with its byte
+    # offset and length, so the caller can build an index and read the
+    # game again later with game_at().
+    BOM = b"\xef\xbb\xbf"
+    RELEASE_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._map = None
+        if self.size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return self.iter_games()
+
+    def _find_end(self, pos):
+        # The end of the game tree at pos. Skip the values, so the
+        # parentheses in the comments don't count.
+        mm = self._map
+        if mm[pos:pos+1] != b"(":
+            raise SgfError("Invalid SGF data at byte {}.".format(pos))
+        depth = 0
+        for m in _EXTENT_RE_B.finditer(mm, pos):
+            c = mm[m.start()]
+            if c == ord("("):
+                depth += 1
+            elif c == ord(")"):
+                depth -= 1
+                if depth == 0:
+                    return m.end()
+        raise SgfError("Unterminated game tree at byte {}.".format(pos))
+
+    def _iter_extents(self, start=0, parse=True):
+        # Yield the offset, the end and the game of the fast path (None if
+        # it needs the full parser) of every game. Only find the ends if
+        # parse is False.
+        mm = self._map
+        if mm is None:
+            return
+        pos = start
+        if pos == 0 and mm[:3] == self.BOM:
+            pos = 3
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        released = 0
+        while True:
+            pos = _SPACE_RE_B.match(mm, pos).end()
+            if pos >= self.size:
+                break
+            game = None
+            if parse:
+                simple = _parse_simple_game(mm, pos, True)
+                if simple is not None:
+                    game, end = simple
+                else:
+                    end = self._find_end(pos)
+            else:
+                m = _SIMPLE_GAME_RE_B.match(mm, pos)
+                end = m.end() if m is not None else self._find_end(pos)
+            yield pos, end, game
+            pos = end
+            if pos - released >= self.RELEASE_BYTES:
+                released = self._release(released, pos)
+
+    def _release(self, start, end):
+        # Give the pages we have read back to the kernel, so the resident
+        # size doesn't grow with the file. They are read again from the
+        # file if needed.
+        end -= end % mmap.PAGESIZE
+        if hasattr(self._map, "madvise") and hasattr(mmap, "MADV_DONTNEED") and end > start:
+            self._map.madvise(mmap.MADV_DONTNEED, start, end - start)
+        return end
+
+    def iter_games(self, start=0, errors=None):
+        # Yield (offset, length, SgfGame). Raise SgfError on a bad game,
+        # or append (offset, error) to the errors list and skip it.
+        for pos, end, game in self._iter_extents(start):
+            try:
+                if game is None:
+                    game = self._parse_slice(pos, end)
+            except SgfError as err:
+                if errors is None:
+                    raise SgfError("{} (the game at byte {})".format(err, pos))
+                errors.append((pos, str(err)))
+                continue
+            yield pos, end - pos, game
+
+    def _parse_slice(self, pos, end):
+        text = self._map[pos:end].decode("utf-8", errors="replace")
+        trees, _ = _parse_trees(text, 0, 1)
+        return SgfGame.from_tree(trees[0])
+
+    def game_at(self, offset, length):
+        # Read one game of the index.
+        if self._map is None or offset + length > self.size:
+            raise SgfError("The game is out of the file.")
+        return self._parse_slice(offset, offset + length)
+
+    def build_index(self):
+        # Return the offsets and the lengths of all games. Only find
+        # the game boundaries, don't build the games.
+        offsets = array("Q")
+        lengths = array("Q")
+        for pos, end, _ in self._iter_extents(parse=False):
+            offsets.append(pos)
+            lengths.append(end - pos)
+        return offsets, lengths
+
+def iter_sgf_file(filename, errors=None):
+    # Yield (offset, length, SgfGame) of every game in the file.
+    with SgfCollection(filename) as collection:
+        for item in collection.iter_games(errors=errors):
+            yield item
+
+def iter_named_games(filename, errors, name=None):
+    # Yield (offset, name, SgfGame) of every game in the file. The game
+    # is named "<name>#<byte offset>" if the file has more than one game
+    # or a bad game, or just the name. The name is the file name by
+    # default. Append (offset, error) to the errors list.
+    if name is None:
+        name = filename
+    first = None
+    count = 0
+    try:
+        with SgfCollection(filename) as collection:
+            for offset, _, game in collection.iter_games(errors=errors):
+                count += 1
+                if count == 1:
+                    # Wait for the second game to name the first one.
+                    first = (offset, game)
+                    continue
+                if count == 2:
+                    yield first[0], "{}#{}".format(name, first[0]), first[1]
+                yield offset, "{}#{}".format(name, offset), game
+    except (SgfError, OSError) as err:
+        errors.append((0, str(err)))
+    if count == 1:
+        offset, game = first
+        yield offset, name if len(errors) == 0 else "{}#{}".format(name, offset), game
+
+if __name__ == '__main__':
+    games = parse_sgf_games(
+        "(;GM[1]FF[4]SZ[9]KM[7]AB[aa:bb]C[a \\] b];B[ee](;W[dd];B[])(;W[cc]))(;SZ[9];B[ab])")
+    for game in games:
+        print(game.board_size, game.komi, list(game.setup_black),
+              [ "{} {}".format(c, v) for c, v in game.history() ])
@@ -0,0 +1,99 @@
+import math
+
+class Sprt:
+    # The sequential probability ratio test of the Elo difference between
+    # two engines, H0: elo = elo0 and H1: elo = elo1. Use the normal
+    # approximation of the generalized SPRT.
+    #   trinomial: count the loss/draw/win of every single game.
+    #   pentanomial: count the score (0, 0.5, ..., 2) of every game pair
+    #                which plays the same opening with swapped colors.
+    TRINOMIAL = "trinomial"
+    PENTANOMIAL = "pentanomial"
+
+    def __init__(self, elo0=0., elo1=5., alpha=0.05, beta=0.05, model=TRINOMIAL):
+        if not model in [self.TRINOMIAL, self.PENTANOMIAL]:
+            raise Exception("Invalid SPRT model.")
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.alpha = alpha
+        self.beta = beta
+        self.model = model
+        self.lower = math.log(beta / (1. - alpha))
+        self.upper = math.log((1. - beta) / alpha)
+
+        size = 3 if model == self.TRINOMIAL else 5
+        self.counts = [0] * size
+
+    @staticmethod
+    def elo_to_score(elo):
+        return 1. / (1. + pow(10., -elo / 400.))
+
+    @staticmethod
+    def score_to_elo(score):
+        score = min(max(score, 1e-6), 1. - 1e-6)
+        return -400. * math.log10(1. / score - 1.)
+
+    def add(self, score):
+        # The score of the first engine, 0/0.5/1 for one game or 0 ~ 2 for
+        # one game pair.
+        self.counts[int(round(score * 2))] += 1
+
+    def num_samples(self):
+        return sum(self.counts)
+
+    def _mean_var(self):
+        # Add a half pseudo count to every bucket. The variance is never
+        # zero and a few lucky games can't finish the test.
+        counts = [ c + 0.5 for c in self.counts ]
+        n = sum(counts)
+        scale = len(counts) - 1
+        mean = sum([ c * i / scale for i, c in enumerate(counts) ]) / n
+        var = sum([ c * (i / scale) ** 2 for i, c in enumerate(counts) ]) / n - mean ** 2
+        return mean, max(var, 1e-12)
+
+    def llr(self):
+        n = self.num_samples()
+        if n == 0:
+            return 0.
+        mean, var = self._mean_var()
+        s0 = self.elo_to_score(self.elo0)
+        s1 = self.elo_to_score(self.elo1)
+        return n * (s1 - s0) * (2. * mean - s0 - s1) / (2. * var)
+
+    def elo(self):
+        if self.num_samples() == 0:
+            return 0.
+        mean, _ = self._mean_var()
+        return self.score_to_elo(mean)
+
+    def result(self):
+        # Return "H1" or "H0" if the test finishes, None otherwise.
+        llr = self.llr()
+        if llr >= self.upper:
+            return "H1"
+        elif llr <= self.lower:
+            return "H0"
+        return None
+
+    def is_finished(self):
+        return self.result() is not None
+
+    def __str__(self):
+        out = "SPRT ({}) elo0: {} elo1: {} alpha: {} beta: {}\n".format(
+                  self.model, self.elo0, self.elo1, self.alpha, self.beta)
+        out += "LLR: {:.3f} [{:.3f}, {:.3f}], Elo: {:.1f}, {}: {}".format(
+                   self.llr(), self.lower, self.upper, self.elo(),
+                   "L/D/W" if self.model == self.TRINOMIAL else "pairs",
+                   "/".join([ str(c) for c in self.counts ]))
+        result = self.result()
+        if result is not None:
+            out += "\n{} is accepted.".format(result)
+        return out
+
+if __name__ == '__main__':
+    sprt = Sprt(0, 10, 0.05, 0.05)
+    for i in range(1000):
+        sprt.add([1, 0.5, 0, 1][i % 4])
+        if sprt.is_finished():
+            break
+    print(sprt)
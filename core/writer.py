@@ -0,0 +1,165 @@
+import os
+import queue
+import sys
+import threading
+import time
+
+class BackgroundWriter:
+    # Write the result files on one background thread. The callers only
+    # put the data into a bounded queue. The writer takes all pending
+    # writes at once, joins the appends of the same file into one write,
+    # keeps only the last content of a replaced file, and keeps the append
+    # files open. The queue bound caps the memory; the callers wait only
+    # if the disk falls that far behind. Then a caller waits until the
+    # writer takes the next batch, so the batch size bounds that wait.
+    #
+    # The fsync policy:
+    #   None : never, leave it to the OS.
+    #   0    : after every batch.
+    #   N    : at most every N seconds.
+    STOP = "stop"
+
+    def __init__(self, max_pending=4096, fsync_interval=None, batch_size=32):
+        self.fsync_interval = fsync_interval
+        self.batch_size = max(batch_size, 1)
+        self.num_errors = 0
+        self._queue = queue.Queue(max(max_pending, 1))
+        self._files = dict() # { path : file } the open append files
+        self._dirty = set() # the paths written after the last fsync
+        self._last_sync = time.monotonic()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def append(self, path, data):
+        self._put("append", path, data)
+
+    def replace(self, path, data):
+        # Overwrite the whole file. Readers see the old or the new content.
+        self._put("replace", path, data)
+
+    def create(self, path, data):
+        # Write a new file. Add the suffix "-N" to the name if the file
+        # exists.
+        self._put("create", path, data)
+
+    def _put(self, op, path, data):
+        if self._thread is None:
+            raise Exception("The writer is closed.")
+        self._queue.put((op, path, data))
+
+    def flush(self):
+        # Wait until all pending writes are done.
+        self._queue.join()
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._queue.put((self.STOP, None, None))
+        self._thread.join()
+        self._thread = None
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def _next_batch(self):
+        timeout = None
+        if self.fsync_interval is not None and len(self._dirty) > 0:
+            timeout = max(self._last_sync + self.fsync_interval - time.monotonic(), 0.)
+        batch = list()
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+            while len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _loop(self):
+        stop = False
+        while not stop:
+            batch = self._next_batch()
+            try:
+                stop = self._write_batch(batch)
+            except Exception as err:
+                self._error("the batch", err)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_batch(self, batch):
+        appends = dict() # { path : [ data ] }
+        replaces = dict() # { path : data }
+        stop = False
+        for op, path, data in batch:
+            if op == self.STOP:
+                stop = True
+            elif op == "append":
+                appends.setdefault(path, list()).append(data)
+            elif op == "replace":
+                replaces[path] = data
+            elif op == "create":
+                self._create(path, data)
+
+        for path, chunks in appends.items():
+            try:
+                f = self._files.get(path)
+                if f is None:
+                    f = open(path, "a")
+                    self._files[path] = f
+                f.write("".join(chunks))
+                f.flush()
+                self._dirty.add(path)
+            except OSError as err:
+                self._error(path, err)
+        for path, data in replaces.items():
+            try:
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+                self._dirty.add(path)
+            except OSError as err:
+                self._error(path, err)
+        self._sync(stop)
+        return stop
+
+    def _create(self, path, data):
+        name, ext = os.path.splitext(path)
+        idx = 1
+        while True:
+            try:
+                with open(path, "x") as f:
+                    f.write(data)
+                self._dirty.add(path)
+                return
+            except FileExistsError:
+                path = "{}-{}{}".format(name, idx, ext)
+                idx += 1
+            except OSError as err:
+                self._error(path, err)
+                return
+
+    def _sync(self, force=False):
+        if self.fsync_interval is None or len(self._dirty) == 0:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_sync < self.fsync_interval:
+            return
+        for path in self._dirty:
+            try:
+                f = self._files.get(path)
+                if f is not None:
+                    os.fsync(f.fileno())
+                    continue
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as err:
+                self._error(path, err)
+        self._dirty.clear()
+        self._last_sync = now
+
+    def _error(self, path, err):
+        self.num_errors += 1
+        sys.stderr.write("Fail to write {}: {}\n".format(path, err))
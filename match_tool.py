@@ -5,10 +5,22 @@ import hashlib
 import glob, os
 import math
 import select, sys
+import socket
+import threading
+import time
 from datetime import datetime
-from core.gtp import GtpVertex, GtpColor, GtpEngine
-from core.sgf_loader import SgfLoader
+from core.gtp import GtpVertex, GtpColor, GtpEngine, GtpReactor, GtpEngineError, GtpTimeout, GtpPosition
+from core.opening_book import OpeningBook
 from core.elo import Elo
+from core.latency import format_latency
+from core.pool import GtpPipePool
+from core.game import GoGame, Stone
+from core.sprt import Sprt
+from core.scheduler import PairingScheduler
+from core.journal import MatchJournal
+from core.writer import BackgroundWriter
+from core.results_db import ResultsDB
+from core.clock import TimeControl, GameClock
 
 class JudgeGtpEngine(GtpEngine):
     EXTENDED_SUPPORTED_LIST = [
@@ -16,8 +28,8 @@ class JudgeGtpEngine(GtpEngine):
         "is_legal"
     ]
 
-    def __init__(self, command):
-        super().__init__(command)
+    def __init__(self, command, reactor=None, timeouts=None):
+        super().__init__(command, reactor, timeouts)
         self._judge_check()
 
     def _judge_check(self):
@@ -38,42 +50,549 @@ class JudgeGtpEngine(GtpEngine):
         self.shutdown()
 
 class LazyGtpEngine(GtpEngine):
-    def __init__(self, command):
-        super().__init__(command)
+    def __init__(self, command, reactor=None, timeouts=None):
+        super().__init__(command, reactor, timeouts)
         self._ready = True
+        self._pool = None
+
+    def set_pool(self, pool):
+        self._pool = pool
+        pool.register(self.command, self._make_pipe,
+                      self._timeouts.get("startup", self.STARTUP_TIMEOUT))
 
     def wakeup(self):
         if self._ready:
             return
-        self.setup()
+        pipe = None
+        if self._pool is not None:
+            pipe = self._pool.acquire(self.command)
+        if pipe is not None:
+            self.adopt_pipe(pipe)
+        else:
+            self.setup()
         self._ready = True
 
     def sleep(self):
         if not self._ready:
             return
-        self.quit()
-        self.shutdown()
+        if self._pool is not None and \
+               self._pool.release(self.command, self._pipe):
+            # Keep the process as a warm spare one.
+            self.release_pipe()
+        else:
+            self.quit()
+            self.shutdown()
         self._ready = False
 
     def quit_and_shutdown(self):
         self.sleep()
 
 class DefaultGtpEngine(GtpEngine):
-    def __init__(self, command):
-        super().__init__(command)
+    def __init__(self, command, reactor=None, timeouts=None):
+        super().__init__(command, reactor, timeouts)
 
     def quit_and_shutdown(self):
         self.quit()
         self.shutdown()
 
+class OpeningError(Exception):
+    # The engines reject the opening moves.
+    pass
+
+def make_engine(setting, reactor=None, pool=None):
+    engine_types = setting["type"].split('-')
+    # The timeouts are set before the startup handshake, so a hung engine
+    # fails on time too.
+    if "lazy" in engine_types:
+        e = LazyGtpEngine(setting["command"], reactor, setting.get("timeout"))
+        if pool is not None:
+            e.set_pool(pool)
+    else:
+        e = DefaultGtpEngine(setting["command"], reactor, setting.get("timeout"))
+    e.raise_err = True
+    e.time_control = TimeControl.parse(setting.get("time"))
+    e.protocol_version()
+    return e
+
+def make_judge(setting, reactor=None):
+    return JudgeGtpEngine(setting["command"], reactor, setting.get("timeout"))
+
+def wakeup_engines(engines):
+    for e in engines:
+        if type(e) == LazyGtpEngine:
+            e.wakeup()
+
+def sleep_engines(engines):
+    for e in engines:
+        if type(e) == LazyGtpEngine:
+            e.sleep()
+
+def sync_engines(engines, position):
+    # Pipeline the minimal sync commands to all engines. Collect every
+    # response before checking them, so no stale response is left in
+    # the pipes.
+    batches = [ e.push_batch(e.sync_commands(position)) for e in engines ]
+    error = None
+    for e, queries in zip(engines, batches):
+        try:
+            e.return_batch_response(queries)
+        except Exception as err:
+            if not isinstance(error, GtpEngineError):
+                error = err
+    if isinstance(error, GtpEngineError):
+        raise error
+    if error is not None:
+        raise OpeningError(str(error))
+
+class GameReferee:
+    # Validate the moves in-process with GoGame (positional superko)
+    # instead of the is_legal and play round-trips to the judge. Score
+    # the game too if the scoring is "tromp-taylor" or "chinese".
+    def __init__(self, board_size, scoring="judge"):
+        self.game = GoGame(board_size)
+        self.scoring = scoring
+
+    def can_score(self):
+        return self.scoring in ["tromp-taylor", "chinese"]
+
+    def final_score(self, komi, players):
+        dead = None
+        if self.scoring == "chinese":
+            # Only remove the stones which all players agree are dead.
+            dead = None
+            for p in players:
+                vertices = set()
+                if p.support("final_status_list"):
+                    try:
+                        vertices = { v.get() for v in p.final_status_list("dead") }
+                    except GtpEngineError as err:
+                        raise err
+                    except Exception:
+                        pass
+                dead = vertices if dead is None else dead & vertices
+        return self.game.final_score(komi, dead)
+
+    def _to_stone(self, color):
+        return Stone.BLACK if color.is_black() else Stone.WHITE
+
+    def setup(self, position):
+        self.game = GoGame(position.board_size)
+        for c, vtx in position.moves:
+            if not self.is_legal(c, vtx):
+                raise OpeningError("The opening move {} {} is illegal.".format(c, vtx))
+            self.play(c, vtx)
+
+    def is_legal(self, color, vtx):
+        if vtx.is_pass():
+            return True
+        x, y = vtx.get()
+        if x < 0 or x >= self.game.board_size or \
+               y < 0 or y >= self.game.board_size:
+            return False
+        return self.game.legal(x, y, self._to_stone(color))
+
+    def play(self, color, vtx):
+        if vtx.is_pass():
+            self.game.play_pass()
+        else:
+            x, y = vtx.get()
+            self.game.play(x, y, self._to_stone(color))
+
+def drop_time_control(engine, query):
+    # The engine rejects the time format. Play it without the time
+    # control from now on, instead of failing the match.
+    print("The engine ({}) rejects ({}): {}. Play it without the time control.".format(
+              engine.command, query.gtp_command.strip(), str(query)))
+    engine.time_control = None
+
+def timed_genmove(engine, color, clock, margin=0., max_timeout=None):
+    # Pipeline time_left with genmove and charge the clock. Return the
+    # vertex, and False if the engine lost on time. The deadline has a
+    # little more time, so a slightly late engine is not killed.
+    commands = list()
+    if engine.support("time_left"):
+        sec, stones = clock.time_left()
+        commands.append("time_left {} {} {}".format(color, sec, stones))
+    commands.append("genmove {}".format(color))
+
+    deadline = clock.available() + margin + 1.
+    if max_timeout is not None:
+        deadline = min(deadline, max_timeout)
+    engine.set_timeout(deadline, "genmove")
+    start = time.perf_counter()
+    finished = engine.finish_batch(engine.push_batch(commands))
+    in_time = clock.spend(time.perf_counter() - start, margin)
+    if len(finished) > 1 and finished[0].result == "?":
+        drop_time_control(engine, finished[0])
+    query = finished[-1]
+    if engine.raise_err and query.result == "?":
+        raise Exception("Invalid command: ({}) {}.".format(
+                            query.gtp_command.strip(), str(query)))
+    return GtpVertex(str(query)), in_time
+
+def winner_of(result):
+    # The winner color of the result string, None if draw.
+    if "b+" in result.lower():
+        return GtpColor(GtpColor.BLACK)
+    elif "w+" in result.lower():
+        return GtpColor(GtpColor.WHITE)
+    return None
+
+def parse_score(rep):
+    # The score of black from the "B+3.5", "W+2.0 (upper bound: ...)"
+    # or "0" response. None if unknown.
+    tokens = rep.split()
+    if len(tokens) == 0:
+        return None
+    head = tokens[0].upper()
+    try:
+        if head.startswith("B+"):
+            return float(head[2:])
+        elif head.startswith("W+"):
+            return -float(head[2:])
+        return float(head)
+    except ValueError:
+        return None
+
+def score_game(judge, position, history, referee=None, players=list()):
+    # Return the result string and the winner color of the game. With
+    # the referee, the judge gets the whole game now.
+    if referee is not None and referee.can_score():
+        result = referee.final_score(position.komi, players)
+        return result, winner_of(result)
+    if referee is not None:
+        try:
+            judge.sync_to(
+                GtpPosition(position.board_size, position.komi, history))
+        except GtpEngineError as err:
+            raise err
+        except Exception as err:
+            raise GtpEngineError(
+                      "The judge rejects the game: {}".format(err), judge)
+    result = judge.final_score()
+    return result, winner_of(result)
+
+class Adjudicator:
+    # End the long games early. The side whose score estimate stays
+    # behind by the score threshold for the given consecutive plies
+    # resigns. The game is a draw if the estimate stays within the draw
+    # threshold. The game is scored at the move cap. The estimate comes
+    # from the judge or the player who just received the move, so with
+    # the "engines" source both players must agree.
+    def __init__(self, score=None, draw=None, plies=10, max_moves=None, source="judge"):
+        self.score = score
+        self.draw = draw
+        self.plies = max(plies, 1)
+        self.max_moves = max_moves
+        self.source = source
+        self._lead = 0 # > 0 if black leads, < 0 if white leads
+        self._even = 0
+
+    def settings(self):
+        return {
+            "score"     : self.score,
+            "draw"      : self.draw,
+            "plies"     : self.plies,
+            "max_moves" : self.max_moves,
+            "source"    : self.source
+        }
+
+    def reach_move_cap(self, num_moves):
+        return self.max_moves is not None and num_moves >= self.max_moves
+
+    def estimate(self, judge, player, position, history, referee=None):
+        # Return the score estimate of black, None if unknown.
+        if self.score is None and self.draw is None:
+            return None
+        engine = player
+        if self.source == "judge" and judge is not None:
+            engine = judge
+        try:
+            if engine is judge and referee is not None:
+                # The judge doesn't follow the game with the referee.
+                judge.sync_to(
+                    GtpPosition(position.board_size, position.komi, history))
+            # The final_score of many engines is a plain area count in the
+            # middle game, e.g. about -komi in the opening. It is not an
+            # estimate.
+            if not engine.support("estimate_score"):
+                return None
+            engine.send_command("estimate_score")
+            return parse_score(engine.return_response())
+        except GtpEngineError as err:
+            raise err
+        except Exception:
+            return None
+
+    def update(self, score):
+        # Return the result string and the winner color if the game ends.
+        if score is None:
+            self._lead, self._even = 0, 0
+            return None
+        if self.score is not None and abs(score) >= self.score:
+            sign = 1 if score > 0 else -1
+            self._lead = self._lead + sign if self._lead * sign > 0 else sign
+        else:
+            self._lead = 0
+        if self.draw is not None and abs(score) <= self.draw:
+            self._even += 1
+        else:
+            self._even = 0
+
+        if abs(self._lead) >= self.plies:
+            winner = GtpColor(GtpColor.BLACK if self._lead > 0 else GtpColor.WHITE)
+            return "{}+Resign (adjudicated)".format(str(winner).upper()[:1]), winner
+        if self._even >= self.plies:
+            return "0 (adjudicated)", None
+        return None
+
+def play_engine_game(black, white, judge, position, referee=None, time_margin=0., adjudicator=None,
+                     think_times=None):
+    # Play one game from the position. Return the history, the result
+    # string and the winner color (None if draw). A hung or crashed player
+    # is restarted and loses the game. Raise the GtpEngineError if the
+    # judge failed, or the OpeningError if the engines reject the opening.
+    # With the referee, the judge only gets the game at the end to score
+    # it. The player with the time control loses on time if its clock
+    # runs out. The adjudicator may end the game early. The genmove time
+    # of each color is added to the think_times dict if given.
+    history = list(position.moves)
+    result, winner = None, None
+    gtp_players = {
+        str(GtpColor(GtpColor.BLACK)) : black,
+        str(GtpColor(GtpColor.WHITE)) : white
+    }
+    clocks = dict()
+    genmove_timeouts = dict()
+    for color, e in gtp_players.items():
+        if e.time_control is not None:
+            clocks[color] = GameClock(e.time_control)
+            genmove_timeouts[color] = e.get_timeout("genmove")
+
+    try:
+        if referee is not None:
+            referee.setup(position)
+            sync_engines([black, white], position)
+        else:
+            sync_engines([black, white, judge], position)
+        for color, clock in list(clocks.items()):
+            e = gtp_players[color]
+            if e.support("time_settings"):
+                query = e.finish_batch(e.push_batch(
+                            [ "time_settings {}".format(clock.time_control.gtp_args()) ]))[0]
+                if query.result == "?":
+                    drop_time_control(e, query)
+                    clocks.pop(color)
+        c = GtpColor(GtpColor.BLACK)
+        if len(history) > 0:
+            c = history[-1][0].next()
+        num_passes = 0;
+
+        while True:
+            curr_player = gtp_players[str(c)]
+            next_player = gtp_players[str(c.next())]
+
+            clock = clocks.get(str(c))
+            if clock is not None and curr_player.time_control is None:
+                # It rejected the time_left.
+                clocks.pop(str(c))
+                curr_player.set_timeout(genmove_timeouts[str(c)], "genmove")
+                clock = None
+            start = time.perf_counter()
+            in_time = True
+            if clock is None:
+                vtx = GtpVertex(curr_player.genmove(str(c)))
+            else:
+                vtx, in_time = timed_genmove(
+                    curr_player, str(c), clock, time_margin, genmove_timeouts[str(c)])
+            if think_times is not None:
+                think_times[str(c)] = think_times.get(str(c), 0.) + time.perf_counter() - start
+            if not in_time:
+                winner = c.next()
+                result = "{}+Time".format(str(c.next()).upper()[:1])
+                break
+
+            if vtx.is_resign():
+                winner = c.next()
+                result = "{}+Resign".format(str(c.next()).upper()[:1])
+                break
+
+            if referee is not None:
+                rep = 1 if referee.is_legal(c, vtx) else 0
+            else:
+                rep = judge.is_legal(str(c), str(vtx))
+            # 0 is illegal
+            # 1 is legal
+            if int(rep) == 0:
+                winner = c.next()
+                result = "{}+Illegal".format(str(c.next()).upper()[:1])
+                break
+
+            if vtx.is_pass():
+                num_passes += 1
+            else:
+                num_passes = 0
+
+            try:
+                next_player.play(str(c), str(vtx))
+            except GtpEngineError as err:
+                raise err
+            except Exception as err:
+                # The move is legal by the referee or the judge, but the
+                # opponent refuses it, e.g. by another ko rule. It loses.
+                print("The {} player refuses the legal move {}: {}".format(c.next(), vtx, err))
+                winner = c
+                result = "{}+Illegal".format(str(c).upper()[:1])
+                break
+            if referee is not None:
+                referee.play(c, vtx)
+            else:
+                try:
+                    judge.play(str(c), str(vtx))
+                except GtpEngineError as err:
+                    raise err
+                except Exception as err:
+                    # The judge refuses the move it accepted. Don't trust
+                    # the game.
+                    raise GtpEngineError(
+                              "The judge refuses the move {}: {}".format(vtx, err), judge)
+            history.append((c, vtx))
+
+            if num_passes >= 2:
+                result, winner = score_game(judge, position, history, referee, [black, white])
+                break
+            if adjudicator is not None:
+                if adjudicator.reach_move_cap(len(history)):
+                    result, winner = score_game(judge, position, history, referee, [black, white])
+                    result = "{} (move cap)".format(result)
+                    break
+                verdict = adjudicator.update(
+                              adjudicator.estimate(judge, next_player, position, history, referee))
+                if verdict is not None:
+                    result, winner = verdict
+                    break
+            c = c.next()
+    except GtpEngineError as err:
+        # The engine is hung or crashed. Restart it and adjudicate
+        # the game as a loss on time/crash.
+        print("{} Restart the GTP engine.".format(err))
+        err.engine.restart()
+        if err.engine is judge:
+            end_engine_game(gtp_players, genmove_timeouts)
+            raise err
+        for color, e in gtp_players.items():
+            if e is err.engine:
+                c = GtpColor(color)
+        winner = c.next()
+        reason = "Time" if isinstance(err, GtpTimeout) else "Crash"
+        result = "{}+{}".format(str(c.next()).upper()[:1], reason)
+
+    end_engine_game(gtp_players, genmove_timeouts)
+    return history, result, winner
+
+def end_engine_game(gtp_players, genmove_timeouts):
+    # Restore the genmove deadlines and interrupt the ponder. The player
+    # which doesn't answer is restarted, or its late reply would be taken
+    # as the answer of the next command. The result stands.
+    for color, sec in genmove_timeouts.items():
+        gtp_players[color].set_timeout(sec, "genmove")
+    for e in gtp_players.values():
+        try:
+            e.protocol_version() # interrupt ponder
+        except GtpEngineError as err:
+            print("{} Restart the GTP engine.".format(err))
+            err.engine.restart()
+
+def make_timing(duration, think_times):
+    # The wall time of the game and the genmove time of each color.
+    return {
+        "duration" : duration,
+        "black"    : think_times.get(str(GtpColor(GtpColor.BLACK))),
+        "white"    : think_times.get(str(GtpColor(GtpColor.WHITE)))
+    }
+
+def parse_address(address):
+    # The address is "unix:<path>" or "<host>:<port>".
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host, int(port))
+
+def listen_socket(address):
+    family, addr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen()
+    return sock
+
+def connect_socket(address):
+    family, addr = parse_address(address)
+    if family == socket.AF_INET and len(addr[0]) == 0:
+        addr = ("localhost", addr[1])
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(addr)
+    return sock
+
+def send_message(f, msg):
+    # One JSON object per line.
+    f.write("{}\n".format(json.dumps(msg)).encode())
+    f.flush()
+
+def recv_message(f):
+    line = f.readline()
+    if not line:
+        return None # The peer is closed.
+    return json.loads(line)
+
 class MatchTool:
     def __init__(self, args):
         existed_names = list()
         self._status = list()
-        self._game_history = list()
-        self._judge_gtp = None
+        self._judges = dict()
+        self._judge_setting = None
         self._fixed_elo = None
         self._fixed_name = None
+        self._reactor = None
+        self._pool = None
+        self._journal = None
+        self.opening_book = OpeningBook()
+        self._writer = None
+        self._results_db = None
+
+        # The game slots share the status, the Elo and the result files.
+        self._lock = threading.RLock()
+        self.concurrency = max(args.concurrency, 1)
+        # The built-in scoring needs the referee to track the board. The
+        # judge engine is not needed then.
+        self.scoring = args.scoring
+        self.use_referee = args.referee or self.scoring != "judge"
+        self.time_margin = max(args.time_margin, 0.)
+        self.adjudication = None
+        if args.adjudicate_score is not None or \
+               args.adjudicate_draw is not None or \
+               args.max_moves is not None:
+            self.adjudication = Adjudicator(
+                args.adjudicate_score, args.adjudicate_draw,
+                args.adjudicate_plies, args.max_moves, args.adjudicate_source).settings()
+        self._running_games = 0
+        self._stopped = False
+
+        # The workers play the games in the coordinator mode. Don't start
+        # any local engine.
+        self._remote = getattr(args, "coordinator", None) is not None
+
+        if args.reactor:
+            self._reactor = GtpReactor()
+        if args.pool_spares > 0:
+            memory_cap = None
+            if args.pool_memory_mb is not None:
+                memory_cap = args.pool_memory_mb * 1024 * 1024
+            self._pool = GtpPipePool(args.pool_spares, memory_cap)
 
         with open(args.engines, "r") as f:
             setting = json.load(f)
@@ -84,7 +603,12 @@ class MatchTool:
                 if "skip" in engine_types:
                     continue
                 if "judge" in engine_types:
-                    self._judge_gtp = JudgeGtpEngine(s["command"])
+                    if self.scoring != "judge":
+                        print("Skip the judge engine, {}. Use the built-in {} scoring.".format(s["name"], self.scoring))
+                        continue
+                    if not self._remote:
+                        self._judges[0] = self._make_judge(s)
+                    self._judge_setting = s
                     print("Setup the GTP engine, {}, as judge.".format(s["name"]))
                     continue
                 ori_name = s["name"]
@@ -100,12 +624,10 @@ class MatchTool:
                         self._fixed_elo = s["elo"]
                     else:
                         print("Only accept one fixed Elo engine. Please remove redundant \"fixed\" label.")
-                if "lazy" in engine_types:
-                    e = LazyGtpEngine(s["command"])
-                else:
-                    e = DefaultGtpEngine(s["command"])
-                e.raise_err = True
-                e.protocol_version()
+                TimeControl.parse(s.get("time")) # Check the time control.
+                e = None
+                if not self._remote:
+                    e = self._make_engine(s)
                 existed_names.append(s["name"])
 
                 self._status.append(
@@ -113,13 +635,18 @@ class MatchTool:
                         "name"      : s["name"],
                         "command"   : s["command"],
                         "elo"       : Elo(s["elo"], 40.),
-                        "engine"    : e,
+                        "setting"   : s,
+                        "engines"   : { 0 : e } if e is not None else dict(), # one engine for each slot
                         "black-WDL" : [0, 0, 0],
                         "white-WDL" : [0, 0, 0],
-                        "games"     : 0
+                        "games"     : 0,
+                        "playing"   : 0
                     }
                 )
-                print("Setup the GTP engine, {}.".format(s["name"]))
+                if e is None:
+                    print("Setup the GTP engine, {}, for the workers.".format(s["name"]))
+                    continue
+                print("Setup the GTP engine, {}, in {:.2f} sec.".format(s["name"], e.startup_time))
                 if type(e) == LazyGtpEngine:
                     e.sleep()
             except Exception as err:
@@ -128,94 +655,337 @@ class MatchTool:
         if len(self._status) <= 1:
             self.shutdown()
             raise Exception("Only one/zero GTP engine. Please setup more engines.")
-        if self._judge_gtp is None:
+        if self._judge_setting is None and self.scoring == "judge":
             self.shutdown()
             raise Exception("Need to setup judge engine.")
+        self._check_adjudication()
+
+        # Only play the engine pair in the SPRT mode. The pentanomial model
+        # plays every opening twice with swapped colors.
+        self._sprt = None
+        self._sprt_players = None
+        self._pending_games = list()
+        self._pair_scores = dict()
+        self._pair_openings = dict() # { pair : (rejected, opening, position) }
+        self._next_pair = 0
+        if args.sprt is not None:
+            names = args.sprt.split(",")
+            players = [ s for n in names for s in self._status if s["name"] == n ]
+            if len(names) != 2 or len(players) != 2:
+                self.shutdown()
+                raise Exception("The SPRT needs two engine names, e.g. --sprt A,B.")
+            self._sprt_players = players
+            self._sprt = Sprt(args.sprt_elo0, args.sprt_elo1,
+                              args.sprt_alpha, args.sprt_beta, args.sprt_model)
         self.played_games = 0
         self.max_games = args.max_games
         self.board_size = args.boardsize
         self.komi = args.komi
         self.sample_rate = min(max(args.sample_rate, 0.0), 1.0)
-        self.sgf_files = list()
         self.save_dir = args.save_dir
         self.k_decay_factor = max(args.k_decay_factor, 1.)
         self.sample_elo_factor = max(args.sample_elo_factor, 1.)
+
+        # The pairing scheduler refers to the players by the index.
+        self._scheduler = PairingScheduler(self.sample_elo_factor, args.pairing)
+        self._players = list(self._status)
+        for s in self._players:
+            s["id"] = self._scheduler.add(s["elo"].get(), s["games"])
         self.start_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        self.latency_dump = args.latency_dump
+        self.latency_interval = max(args.latency_interval, 1)
 
         if args.sgf_dir is not None:
-            self.sgf_files.extend(glob.glob(os.path.join(args.sgf_dir, "*.sgf")))
+            # Load and check every opening once.
+            self.opening_book.load(sorted(glob.glob(os.path.join(args.sgf_dir, "*.sgf"))))
+        if args.opening_archive is not None:
+            self.opening_book.load_archive(args.opening_archive)
+        for sgf, err in self.opening_book.errors:
+            sys.stderr.write("Skip the SGF file {}: {}\n".format(sgf, err))
         if self.save_dir is not None:
             path = self.save_dir
             if not os.path.isdir(path):
                 os.makedirs(path)    
+        if self.save_dir is not None or self.latency_dump is not None:
+            self._writer = BackgroundWriter(args.write_queue, args.fsync_interval)
+        if args.resume and self.save_dir is None:
+            self.shutdown()
+            raise Exception("Need the --save-dir with the journal to resume.")
+        if self.save_dir is not None:
+            self._open_journal(args.resume)
+        if args.results_db is not None:
+            self._results_db = ResultsDB(args.results_db, self.start_time)
 
         info = str()
         info += "Board Size: {}\n".format(self.board_size)
         info += "Komi: {}\n".format(self.komi)
-        if args.sgf_dir is not None and self.sample_rate > 0:
-            info += "Load the SGF files from {}.\n".format(
-                        args.sgf_dir)
+        if self.sample_rate > 0:
+            for path in [args.sgf_dir, args.opening_archive]:
+                if path is not None:
+                    info += "Load openings from {}.\n".format(path)
+            info += "{} openings of the board size.\n".format(
+                        self.opening_book.size(self.board_size))
         if self.save_dir is not None:
             info += "Save the SGF files to {}.\n".format(
                         self.save_dir)
             info += "Save the current result to {}.\n".format(
                         self._get_result_txt_name())
+        if self._results_db is not None:
+            info += "Record the games to {}.\n".format(self._results_db.path)
+        if self._journal is not None:
+            info += "Write the journal to {}.\n".format(self._journal.path)
+            if args.resume:
+                info += "Resume {} games from the journal.\n".format(self.played_games)
+        if self.concurrency > 1:
+            info += "Play {} games concurrently.\n".format(self.concurrency)
+        if self.adjudication is not None:
+            if self.adjudication["score"] is not None or \
+                   self.adjudication["draw"] is not None:
+                info += "Adjudicate the games by the {} score estimate.\n".format(
+                            self.adjudication["source"])
+            if self.adjudication["max_moves"] is not None:
+                info += "Score the games at {} moves.\n".format(self.adjudication["max_moves"])
+        if self.use_referee:
+            info += "Validate the moves with the built-in referee.\n"
+        for s in self._status:
+            time_control = TimeControl.parse(s["setting"].get("time"))
+            if time_control is not None:
+                info += "The time control of {}: {}.\n".format(s["name"], time_control)
+        if self._sprt is not None:
+            info += "Run the {} SPRT of {} vs {}.\n".format(
+                        self._sprt.model, self._sprt_players[0]["name"], self._sprt_players[1]["name"])
+        if self.latency_dump is not None:
+            info += "Dump the GTP latency to {} every {} games.\n".format(
+                        self.latency_dump, self.latency_interval)
         print(info, end="")
 
+    def _open_journal(self, resume):
+        path = os.path.join(self.save_dir, "journal.jsonl")
+        if not resume and os.path.isfile(path) and os.path.getsize(path) > 0:
+            # Keep the journal of the last run.
+            os.replace(path, os.path.join(self.save_dir, "journal-{}.jsonl".format(self.start_time)))
+        self._journal = MatchJournal(path)
+        if resume:
+            self._replay_journal(self._journal.read_records())
+
+    def _replay_journal(self, records):
+        # Rebuild the Elo, the K factors, the WDL counts and the history
+        # by playing back the finished games.
+        players = { s["name"] : s for s in self._status }
+        with self._lock:
+            for r in records:
+                black = players.get(r["black"])
+                white = players.get(r["white"])
+                if black is None or white is None:
+                    print("Skip the game {} of the removed engine.".format(r["id"]))
+                    continue
+                winner, loser = None, None
+                if r["winner"] == black["name"]:
+                    winner, loser = black, white
+                elif r["winner"] == white["name"]:
+                    winner, loser = white, black
+
+                self._running_games += 1
+                game = self._make_game(black, white, r.get("opening"), None, r["pair"])
+                self._finish_and_update(winner, loser, black, white)
+                if self._sprt is not None:
+                    self._update_sprt(game, winner)
+                    if game["pair"] is not None:
+                        self._next_pair = max(self._next_pair, game["pair"] + 1)
+            if len(self._pair_scores) > 0:
+                # The other games of these pairs are lost.
+                print("Drop {} unfinished game pairs.".format(len(self._pair_scores)))
+                self._pair_scores.clear()
+
+    def _write_journal(self, game, winner, result):
+        if self._journal is None:
+            return
+        self._journal.append(
+            {
+                "id"     : self.played_games,
+                "black"  : game["black"]["name"],
+                "white"  : game["white"]["name"],
+                "winner" : winner["name"] if winner is not None else None,
+                "result" : result,
+                "opening": game["opening"],
+                "pair"   : game["pair"]
+            }
+        )
+
+    def _record_result(self, game, history, winner, result):
+        if self._results_db is None:
+            return
+        opening = game["opening"] or dict()
+        timing = game.get("timing") or dict()
+        self._results_db.record(
+            game["black"]["name"], game["white"]["name"],
+            winner["name"] if winner is not None else None, result,
+            opening.get("sgf"), opening.get("symmetry"),
+            len(game["position"].moves), len(history),
+            timing.get("duration"), timing.get("black"), timing.get("white"))
+
+    def _make_engine(self, setting):
+        return make_engine(setting, self._reactor, self._pool)
+
+    def _make_judge(self, setting):
+        return make_judge(setting, self._reactor)
+
+    def _make_referee(self):
+        if not self.use_referee:
+            return None
+        return GameReferee(self.board_size, self.scoring)
+
+    def _check_adjudication(self):
+        # The score adjudication needs the estimate_score of the source
+        # engines. Disable it if they don't support it. The remote
+        # engines are not known here.
+        a = self.adjudication
+        if a is None or self._remote or \
+               (a["score"] is None and a["draw"] is None):
+            return
+        judge = self._judges.get(0)
+        if a["source"] == "judge" and judge is not None:
+            sources = [ ("judge", judge) ]
+        else:
+            sources = [ (s["name"], s["engines"].get(0)) for s in self._status ]
+        missing = [ name for name, e in sources if e is not None and not e.support("estimate_score") ]
+        if len(missing) == 0:
+            return
+        print("Warning: the engines ({}) do not support estimate_score. Disable the score adjudication.".format(
+                  ", ".join(missing)))
+        a["score"], a["draw"] = None, None
+
+    def _make_adjudicator(self):
+        # One adjudicator for each game. It counts the plies.
+        if self.adjudication is None:
+            return None
+        return Adjudicator(**self.adjudication)
+
+    def _get_engine(self, player, slot):
+        # Every slot owns its engine instances, so only this slot
+        # touches them. Start the instance at the first game.
+        with self._lock:
+            e = player["engines"].get(slot)
+        if e is None:
+            e = self._make_engine(player["setting"])
+            with self._lock:
+                player["engines"][slot] = e
+        return e
+
+    def _get_judge(self, slot):
+        if self._judge_setting is None:
+            return None
+        with self._lock:
+            judge = self._judges.get(slot)
+        if judge is None:
+            judge = self._make_judge(self._judge_setting)
+            with self._lock:
+                self._judges[slot] = judge
+        return judge
+
     def print_match_result(self):
-        print("Played {} games.".format(self.played_games))
-        print(self._get_match_result_str())
+        with self._lock:
+            print("Played {} games.".format(self.played_games))
+            print(self._get_match_result_str())
 
     def is_running(self):
-        if self.max_games is None:
+        with self._lock:
+            if self._stopped:
+                return False
+            if self._sprt is not None and self._sprt.is_finished():
+                return False
+            if self.max_games is None:
+                return True
+            return self.max_games > self.played_games
+
+    def running_games(self):
+        with self._lock:
+            return self._running_games
+
+    def get_judge_setting(self):
+        return self._judge_setting
+
+    def stop(self):
+        # The slots finish the current games and then leave.
+        with self._lock:
+            self._stopped = True
+
+    def claim_game(self):
+        # Reserve one game for a slot. Count the running games, so the
+        # slots don't play more than max_games.
+        with self._lock:
+            if self._stopped:
+                return False
+            if self._sprt is not None and self._sprt.is_finished():
+                return False
+            if self.max_games is not None and \
+                   self.played_games + self._running_games >= self.max_games:
+                return False
+            self._running_games += 1
             return True
-        return self.max_games > self.played_games
 
-    def _init_engines(self, black, white, judge):
-        def roulette(prob):
-            r = random.random()
-            return r < prob
+    def unclaim_game(self):
+        with self._lock:
+            self._running_games -= 1
 
-        for e in [black, white]:
-            if type(e) == LazyGtpEngine:
-                e.wakeup();
+    def run_slot(self, slot):
+        try:
+            while self.claim_game():
+                self.play_game(slot)
+        except Exception as err:
+            sys.stderr.write("The slot {} failed: {}\n".format(slot, err))
+            self.stop()
 
-        random.shuffle(self.sgf_files)
-        loader = None
+    def sample_opening(self):
+        # Return the opening and the start position. The opening is None
+        # if the game starts from the empty board, or the SGF path and the
+        # symmetry otherwise.
+        opening = None
         history = list()
-        curr_color = GtpColor(GtpColor.BLACK)
-        while len(self.sgf_files) > 0 and roulette(self.sample_rate):
-            try:
-                loader = SgfLoader(self.sgf_files[0])
-                if loader.board_size != self.board_size:
-                    raise Exception("The boardsize is incorrect.")
-                break
-            except Exception as err:
-                sgf = self.sgf_files.pop(0)
+        if random.random() < self.sample_rate:
+            with self._lock:
+                sample = self.opening_book.sample(self.board_size)
+            if sample is not None:
+                sgf, symm, history = sample
+                opening = { "sgf" : sgf, "symmetry" : symm }
+        return opening, GtpPosition(self.board_size, self.komi, history)
 
-        for e in [black, white, judge]:
-            e.clear_board()
-            e.boardsize(self.board_size)
-            e.komi(self.komi)
-            try:
-                if loader is not None:
-                    history = loader.history
-                    for c, vtx in loader.history:
-                        e.play(str(c), str(vtx))
-            except Exception as err:
-                sgf = self.sgf_files.pop(0)
-                return self._init_engines(black, white, judge)
-        if len(history) > 0:
-            c, _ = history[-1]
-            curr_color = c.next()
-        return history, curr_color
+    def remove_opening(self, opening):
+        # The engines reject it. Don't sample it again.
+        with self._lock:
+            self.opening_book.remove(opening["sgf"])
+
+    def resample_opening(self, game):
+        # The engines reject the opening of the game. Replace it, and
+        # keep both games of a pair on the same new opening.
+        rejected = game["opening"]
+        with self._lock:
+            self.remove_opening(rejected)
+            if game["pair"] is not None:
+                replaced = self._pair_openings.get(game["pair"])
+                if replaced is not None and replaced[0] == rejected:
+                    # The other game of the pair has replaced it.
+                    game["opening"], game["position"] = replaced[1], replaced[2]
+                    return
+            opening, position = self.sample_opening()
+            game["opening"], game["position"] = opening, position
+            if game["pair"] is None:
+                return
+            self._pair_openings[game["pair"]] = (rejected, opening, position)
+            for g in self._pending_games:
+                if g["pair"] == game["pair"]:
+                    g["opening"], g["position"] = opening, position
 
     def _save_sgf(self, black, white, history, result):
+        # The files are written by the background writer, so the game
+        # slot never waits for the disk.
+        if not self.save_dir:
+            return
         curr_time = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        sgf = "(;GM[1]FF[4]SZ[{}]KM[{}]RU[unknown]PB[{}]PW[{}]DT[{}]".format(
-                  self.board_size, self.komi, black["name"], white["name"], curr_time)
+        sgf = [ "(;GM[1]FF[4]SZ[{}]KM[{}]RU[unknown]PB[{}]PW[{}]DT[{}]".format(
+                    self.board_size, self.komi, black["name"], white["name"], curr_time) ]
         if result is not None:
-            sgf += "RE[{}]".format(result)
+            sgf.append("RE[{}]".format(result))
         for color, vertex in history:
             cstr = str(color).upper()[:1]
 
@@ -226,37 +996,32 @@ class MatchTool:
             else:
                 x, y = vertex.get()
                 y = self.board_size - 1 - y
-                vstr = str()
-                vstr += chr(x + ord('a'))
-                vstr += chr(y + ord('a'))
-            sgf += ";{}[{}]".format(cstr, vstr)
-        sgf += ")"
+                vstr = chr(x + ord('a')) + chr(y + ord('a'))
+            sgf.append(";{}[{}]".format(cstr, vstr))
+        sgf.append(")")
+
+        # Other slot may save the same players in the same second. The
+        # writer adds a suffix then.
+        sgf_name = "{}(B)_vs_{}(W)-{}".format(black["name"], white["name"], curr_time)
+        self._writer.create(os.path.join(self.save_dir, "{}.sgf".format(sgf_name)), "".join(sgf))
 
-        if self.save_dir:
-            sgf_name = "{}(B)_vs_{}(W)-{}.sgf".format(black["name"], white["name"], curr_time)
-            sgf_path = os.path.join(self.save_dir, sgf_name)
-            with open(sgf_path, "w") as f:
-                f.write(sgf)
         # save pgn file for BayesElo sysyem
-        pgn = str()
-        pgn += "[Event \"{}\"]\n".format("?")
-        pgn += "[Site \"{}\"]\n".format("?")
-        pgn += "[Date \"{}\"]\n".format(curr_time)
-        pgn += "[Round \"{}\"]\n".format("?")
-        pgn += "[White \"{}\"]\n".format(white["name"])
-        pgn += "[Black \"{}\"]\n".format(black["name"])
         if "b+" in result.lower():
             pgn_result = "0-1"
         elif "w+" in result.lower():
             pgn_result = "1-0"
         else:
             pgn_result = "1/2-1/2"
-        pgn += "[Result \"{}\"]\n\n".format(pgn_result)
-        pgn += "{}\n\n".format(pgn_result)
-        if self.save_dir:
-            pgn_path = os.path.join(self.save_dir, "result.pgn")
-            with open(pgn_path, "a") as f:
-                f.write(pgn)
+        pgn = "".join([
+                  "[Event \"{}\"]\n".format("?"),
+                  "[Site \"{}\"]\n".format("?"),
+                  "[Date \"{}\"]\n".format(curr_time),
+                  "[Round \"{}\"]\n".format("?"),
+                  "[White \"{}\"]\n".format(white["name"]),
+                  "[Black \"{}\"]\n".format(black["name"]),
+                  "[Result \"{}\"]\n\n".format(pgn_result),
+                  "{}\n\n".format(pgn_result) ])
+        self._writer.append(os.path.join(self.save_dir, "result.pgn"), pgn)
 
     def _get_result_txt_name(self):
         filename = "result-{}.txt".format(self.start_time)
@@ -264,43 +1029,114 @@ class MatchTool:
 
     def _save_match_result(self):
         if self.save_dir:
-            res = self._get_match_result_str()
-            with open(self._get_result_txt_name(), "w") as f:
-                f.write(res)
-
-    def _sample_engines(self):
-        def random_select_by_elo(status, key_fn):
-            status.sort(key=lambda s: s["elo"].get())
-            curr_elo = p1["elo"].get()
-            accm = 0
-
-            for s in status:
-                diff = abs(curr_elo - s["elo"].get())
-                accm += key_fn(diff)
-            select = random.random() * accm
-
-            accm = 0
-            for idx, s in enumerate(status):
-                diff = abs(curr_elo - s["elo"].get())
-                accm += key_fn(diff)
-                if accm > select:
-                    return idx
-            return -1
-
-        self._status.sort(key=lambda s: s["games"])
-        p1 = self._status.pop(0)
-        idx = random_select_by_elo(
-                  self._status,
-                  lambda v: 1.0 / (1.0 + pow(10.0, v / self.sample_elo_factor))
-              )
-        p2 = self._status.pop(idx)
-
-        shuflist = [p1, p2]
+            self._writer.replace(self._get_result_txt_name(), self._get_match_result_str())
+
+    def get_latency_stats(self):
+        # Return { (role, engine name) : LatencyStats } of all engines.
+        # The role is "engine" or "judge". The engine of slot N is named
+        # "name#N".
+        def slot_name(name, slot):
+            return name if slot == 0 else "{}#{}".format(name, slot)
+
+        stats_map = dict()
+        with self._lock:
+            for s in self._status:
+                for slot, e in s["engines"].items():
+                    stats_map[("engine", slot_name(s["name"], slot))] = e.get_latency()
+            for slot, judge in self._judges.items():
+                stats_map[("judge", slot_name("judge", slot))] = judge.get_latency()
+        return stats_map
+
+    def dump_latency(self, force=False):
+        if self.latency_dump is None:
+            return
+        # The file is written by the background writer, not under the
+        # lock.
+        with self._lock:
+            if not force and self.played_games % self.latency_interval != 0:
+                return
+        self._writer.replace(
+            self.latency_dump, format_latency(self.get_latency_stats(), self.latency_dump))
+
+    def sample_game(self):
+        # Return the game, the players and the start position. The players
+        # stay in the status, other slots may pick the same one with the
+        # other engine instance. Count the running games.
+        opening, position = self.sample_opening()
+        with self._lock:
+            if self._sprt is not None:
+                return self._sample_sprt_game(opening, position)
+            black, white = self._sample_players()
+            return self._make_game(black, white, opening, position)
+
+    def _make_game(self, black, white, opening, position, pair=None):
+        black["playing"] += 1
+        white["playing"] += 1
+        self._update_scheduler([black, white])
+        return {
+            "black"    : black,
+            "white"    : white,
+            "opening"  : opening,
+            "position" : position,
+            "pair"     : pair
+        }
+
+    def _sample_sprt_game(self, opening, position):
+        if len(self._pending_games) > 0:
+            game = self._pending_games.pop(0)
+            return self._make_game(
+                       game["black"], game["white"], game["opening"], game["position"], game["pair"])
+
+        black, white = self._sprt_players
+        if random.random() < 0.5:
+            black, white = white, black
+        pair = None
+        if self._sprt.model == Sprt.PENTANOMIAL:
+            pair = self._next_pair
+            self._next_pair += 1
+            # The other game of the pair swaps the colors.
+            self._pending_games.append(
+                {
+                    "black"    : white,
+                    "white"    : black,
+                    "opening"  : opening,
+                    "position" : position,
+                    "pair"     : pair
+                }
+            )
+        return self._make_game(black, white, opening, position, pair)
+
+    def _update_sprt(self, game, winner):
+        players = self._sprt_players
+        if not game["black"] in players or not game["white"] in players:
+            return
+        score = 0.5
+        if winner is players[0]:
+            score = 1.
+        elif winner is players[1]:
+            score = 0.
+        if game["pair"] is None:
+            self._sprt.add(score)
+            return
+        if game["pair"] in self._pair_scores:
+            self._sprt.add(self._pair_scores.pop(game["pair"]) + score)
+            self._pair_openings.pop(game["pair"], None)
+        else:
+            self._pair_scores[game["pair"]] = score
+
+    def _sample_players(self):
+        first, second = self._scheduler.sample()
+        shuflist = [self._players[first], self._players[second]]
         random.shuffle(shuflist)
         black = shuflist[0]
         white = shuflist[1]
         return black, white
 
+    def _update_scheduler(self, players):
+        for p in players:
+            self._scheduler.update(
+                p["id"], elo=p["elo"].get(), games=p["games"], playing=p["playing"])
+
     def _get_match_result_str(self):
         self._status.sort(key=lambda s: s["elo"].get(), reverse=True)
         out = str()
@@ -312,28 +1148,27 @@ class MatchTool:
             w_wdl = s["white-WDL"]
             out += "\n{} : {} -> ({}/{}/{}) ({}/{}/{})".format(
                        name, elo, b_wdl[0], b_wdl[1], b_wdl[2], w_wdl[0], w_wdl[1], w_wdl[2])
+        if self._sprt is not None:
+            out += "\n{}".format(self._sprt)
         return out
 
     def _finish_and_update(self, winner, loser, black, white):
-        result = str()
         if winner is not None:
             if winner["name"] == black["name"]:
                 winner["black-WDL"][0] += 1
                 loser["white-WDL"][2] += 1
-                result = "black won"
             else:
                 winner["white-WDL"][0] += 1
                 loser["black-WDL"][2] += 1
-                result = "white won"
             winner["elo"].beat(loser["elo"])
         else:
             black["black-WDL"][1] += 1
             white["white-WDL"][1] += 1
-            result = "draw"
             black["elo"].draw(white["elo"])
 
         for p in [black, white]:
             p["games"] += 1
+            p["playing"] -= 1
             k = p["elo"].get_k()
             if k != 0.:
                 k_lambda = 0.69314718056/self.k_decay_factor
@@ -342,10 +1177,8 @@ class MatchTool:
                 k = k * math.exp(-k_lambda)
                 k = max(k, 5)
                 p["elo"].set_k(k)
-            if type(p["engine"]) == LazyGtpEngine:
-                p["engine"].sleep()
-        self._status.extend([black, white])
         self.played_games += 1
+        self._running_games -= 1
 
         if self._fixed_name is not None:
             offset_elo = 0
@@ -355,97 +1188,402 @@ class MatchTool:
                    offset_elo = self._fixed_elo - s["elo"].get()
             for s in self._status:
                 s["elo"].set(s["elo"].get() + offset_elo)
+            if offset_elo != 0:
+                self._update_scheduler(self._status)
+        self._update_scheduler([black, white])
 
-        self._game_history.append(
-            {
-                "id" : self.played_games,
-                "black" : black["name"],
-                "white" : white["name"],
-                "result" : result
-            }
-        )
+        if self.played_games % 100 == 0:
+            print("Played {} games.".format(self.played_games))
 
-    def play_game(self):
-        black, white = self._sample_engines()
-        history, result = list(), None
-
-        players = {
-            str(GtpColor(GtpColor.BLACK)) : black,
-            str(GtpColor(GtpColor.WHITE)) : white
-        }
-        gtp_players = {
-            str(GtpColor(GtpColor.BLACK)) : black["engine"],
-            str(GtpColor(GtpColor.WHITE)) : white["engine"]
-        }
-        judge = self._judge_gtp
-        history, c = self._init_engines(black["engine"], white["engine"], judge)
+    def play_game(self, slot=0):
+        try:
+            game = self.sample_game()
+        except Exception as err:
+            # Give back the game reserved by claim_game().
+            self.unclaim_game()
+            raise err
+        try:
+            played = self._play_sampled_game(game, slot)
+        except Exception as err:
+            # Don't leave the failed game in the running ones.
+            self.discard_game(game, slot)
+            raise err
+        if played is None:
+            self.discard_game(game, slot)
+            return
+        history, result, winner = played
+        self.finish_game(game, history, result, winner)
 
-        num_passes = 0;
-        winner, loser = None, None
+    def _play_sampled_game(self, game, slot):
+        # Return the history, the result and the winner color, or None if
+        # an engine failed and the game should be discarded.
+        black, white = game["black"], game["white"]
+        black_engine = self._get_engine(black, slot)
+        white_engine = self._get_engine(white, slot)
+        judge = self._get_judge(slot)
 
+        wakeup_engines([black_engine, white_engine])
         while True:
-            curr_player = gtp_players[str(c)]
-            next_player = gtp_players[str(c.next())]
-
-            vtx = GtpVertex(curr_player.genmove(str(c)))
-
-            if vtx.is_resign():
-                winner, loser = players[str(c.next())], players[str(c)]
-                result = "{}+Resign".format(str(c.next()).upper()[:1])
-                break
-
-            rep = judge.is_legal(str(c), str(vtx))
-            # 0 is illegal
-            # 1 is legal
-            if int(rep) == 0:
-                winner, loser = players[str(c.next())], players[str(c)]
-                result = "{}+Illegal".format(str(c.next()).upper()[:1])
-                break
-
-            if vtx.is_pass():
-                num_passes += 1
-            else:
-                num_passes = 0
-
             try:
-                next_player.play(str(c), str(vtx))
-                judge.play(str(c), str(vtx))
-                history.append((c, vtx))
-            except Exception as err:
-                print("Not a legal move.")
+                start = time.perf_counter()
+                think_times = dict()
+                history, result, winner = play_engine_game(
+                    black_engine, white_engine, judge, game["position"],
+                    self._make_referee(), self.time_margin, self._make_adjudicator(), think_times)
+                game["timing"] = make_timing(time.perf_counter() - start, think_times)
                 break
+            except OpeningError as err:
+                if game["opening"] is None:
+                    raise err
+                self.resample_opening(game)
+            except GtpEngineError as err:
+                if err.engine is judge:
+                    print("The judge failed. Discard the game.")
+                else:
+                    print("{} Discard the game.".format(err))
+                return None
+        sleep_engines([black_engine, white_engine])
+        return history, result, winner
 
-            if num_passes >= 2:
-                rep = judge.final_score()
-                result = rep
-                if "b+" in rep.lower():
-                    winner, loser = black, white
-                elif "w+" in rep.lower():
-                    winner, loser = white, black
-                break
-            c = c.next()
+    def finish_game(self, game, history, result, winner_color):
+        black, white = game["black"], game["white"]
+        winner, loser = None, None
+        if winner_color is not None:
+            winner, loser = black, white
+            if winner_color.is_white():
+                winner, loser = white, black
 
-        for e in gtp_players.values():
-            e.clear_board()
-            e.protocol_version() # interrupt ponder
+        with self._lock:
+            self._save_sgf(black, white, history, result)
+            self._finish_and_update(winner, loser, black, white)
+            if self._sprt is not None:
+                self._update_sprt(game, winner)
+            self._write_journal(game, winner, result)
+            self._record_result(game, history, winner, result)
+            self._save_match_result()
+            dump = self.played_games % self.latency_interval == 0
+        if dump:
+            self.dump_latency(force=True)
 
-        self._save_sgf(black, white, history, result)
-        self._finish_and_update(winner, loser, black, white)
-        self._save_match_result()
+    def discard_game(self, game, slot=None):
+        black, white = game["black"], game["white"]
+        if slot is not None:
+            sleep_engines([ p["engines"].get(slot) for p in [black, white] ])
+        with self._lock:
+            for p in [black, white]:
+                p["playing"] -= 1
+            self._update_scheduler([black, white])
+            self._running_games -= 1
+            if game["pair"] is not None:
+                # Play it again, so the pair is complete.
+                self._pending_games.insert(0, game)
 
     def shutdown(self):
         while len(self._status) > 0:
             s = self._status.pop(0)
-            e = s["engine"].quit_and_shutdown()
+            for e in s["engines"].values():
+                e.quit_and_shutdown()
             print("Quit the GTP engine: {}.".format(s["name"]))
-        if self._judge_gtp is not None:
-            self._judge_gtp.quit_and_shutdown()
-            self._judge_gtp = None
+        if len(self._judges) > 0:
+            for judge in self._judges.values():
+                judge.quit_and_shutdown()
+            self._judges.clear()
             print("Quit the judge engine.")
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            print("Quit the spare engines.")
+        if self._reactor is not None:
+            self._reactor.stop()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._results_db is not None:
+            self._results_db.close()
+            self._results_db = None
+        self.opening_book.close()
 
     def __del__(self):
         self.shutdown()
 
+class MatchCoordinator:
+    # Own the schedule, the ratings and the results of the MatchTool.
+    # The workers connect to it at any time and play the assigned games.
+    # The game of a leaving worker is discarded and scheduled again.
+    def __init__(self, tool, address):
+        self._tool = tool
+        self._address = address
+        self._sock = listen_socket(address)
+        self._lock = threading.Lock()
+        self._num_workers = 0
+        self._next_id = 0
+        self._running = True
+        self._accept_thread = threading.Thread(
+            target=self._accept_loop, daemon=True
+        )
+        self._accept_thread.start()
+
+    def num_workers(self):
+        with self._lock:
+            return self._num_workers
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                break # Closed by shutdown().
+            t = threading.Thread(
+                target=self._serve_worker, args=(conn,), daemon=True
+            )
+            t.start()
+
+    def _game_message(self, game):
+        position = game["position"]
+        with self._lock:
+            self._next_id += 1
+            game_id = self._next_id
+        return {
+            "type"       : "game",
+            "id"         : game_id,
+            "black"      : game["black"]["setting"],
+            "white"      : game["white"]["setting"],
+            "judge"      : self._tool.get_judge_setting(),
+            "board_size" : position.board_size,
+            "komi"       : position.komi,
+            "opening"    : [ [str(c), str(v)] for c, v in position.moves ],
+            "referee"    : self._tool.use_referee,
+            "scoring"    : self._tool.scoring,
+            "time_margin": self._tool.time_margin,
+            "adjudication" : self._tool.adjudication
+        }
+
+    def _remote_game(self, f, game):
+        # Send the game to the worker and return its reply. Return None
+        # if the worker left.
+        try:
+            send_message(f, self._game_message(game))
+            return recv_message(f)
+        except (OSError, ValueError):
+            return None
+
+    def _parse_result(self, game, reply):
+        # Return the history, the result and the winner color of the
+        # finished game, or None if the worker discarded it.
+        if reply["type"] != "result" or reply.get("result") is None:
+            if reply["type"] == "opening-error" and game["opening"] is not None:
+                self._tool.resample_opening(game)
+            print("The worker discarded the game: {}".format(reply.get("error")))
+            return None
+        history = [ (GtpColor(c), GtpVertex(v)) for c, v in reply["history"] ]
+        winner = None
+        if reply["winner"] is not None:
+            winner = GtpColor(reply["winner"])
+        game["timing"] = reply.get("timing")
+        return history, reply["result"], winner
+
+    def _serve_worker(self, conn):
+        f = conn.makefile("rwb")
+        with self._lock:
+            self._num_workers += 1
+        print("A worker joined.")
+        try:
+            while self._tool.claim_game():
+                try:
+                    game = self._tool.sample_game()
+                except Exception as err:
+                    # Give back the game reserved by claim_game().
+                    self._tool.unclaim_game()
+                    raise err
+                reply = self._remote_game(f, game)
+                if reply is None:
+                    print("A worker left. Discard the game.")
+                    self._tool.discard_game(game)
+                    return
+                try:
+                    played = self._parse_result(game, reply)
+                except Exception as err:
+                    print("Invalid reply of the worker: {}.".format(err))
+                    played = None
+                if played is None:
+                    self._tool.discard_game(game)
+                    continue
+                history, result, winner = played
+                self._tool.finish_game(game, history, result, winner)
+            send_message(f, { "type" : "stop" })
+        except (OSError, ValueError):
+            pass
+        except Exception as err:
+            sys.stderr.write("The worker connection failed: {}\n".format(err))
+        finally:
+            with self._lock:
+                self._num_workers -= 1
+            try:
+                f.close()
+            except OSError:
+                pass # The worker is gone, the buffered data is lost.
+            conn.close()
+
+    def shutdown(self):
+        if not self._running:
+            return
+        self._running = False
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._accept_thread.join()
+        family, addr = parse_address(self._address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.remove(addr)
+
+class MatchWorker:
+    # Connect to the coordinator and play the assigned games with the
+    # local engines. Every slot is one connection with its own engines.
+    def __init__(self, args):
+        self._address = args.worker
+        self.concurrency = max(args.concurrency, 1)
+        self._engines = dict() # { (slot, name) : engine }
+        self._judges = dict() # { slot : judge }
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._reactor = None
+        self._pool = None
+        self.played_games = 0
+
+        if args.reactor:
+            self._reactor = GtpReactor()
+        if args.pool_spares > 0:
+            memory_cap = None
+            if args.pool_memory_mb is not None:
+                memory_cap = args.pool_memory_mb * 1024 * 1024
+            self._pool = GtpPipePool(args.pool_spares, memory_cap)
+
+    def stop(self):
+        # Leave the coordinator after the current games.
+        with self._lock:
+            self._stopped = True
+
+    def is_stopped(self):
+        with self._lock:
+            return self._stopped
+
+    def _get_engine(self, slot, setting):
+        key = (slot, setting["name"])
+        e = self._engines.get(key)
+        if e is None:
+            e = make_engine(setting, self._reactor, self._pool)
+            with self._lock:
+                self._engines[key] = e
+            print("Setup the GTP engine, {}, in {:.2f} sec.".format(setting["name"], e.startup_time))
+        return e
+
+    def _get_judge(self, slot, setting):
+        if setting is None:
+            return None
+        judge = self._judges.get(slot)
+        if judge is None:
+            judge = make_judge(setting, self._reactor)
+            with self._lock:
+                self._judges[slot] = judge
+        return judge
+
+    def _play(self, slot, msg):
+        black = self._get_engine(slot, msg["black"])
+        white = self._get_engine(slot, msg["white"])
+        judge = self._get_judge(slot, msg["judge"])
+        position = GtpPosition(
+            msg["board_size"], msg["komi"],
+            [ (GtpColor(c), GtpVertex(v)) for c, v in msg["opening"] ])
+
+        wakeup_engines([black, white])
+        try:
+            referee = None
+            if msg.get("referee"):
+                referee = GameReferee(position.board_size, msg.get("scoring", "judge"))
+            adjudicator = None
+            if msg.get("adjudication") is not None:
+                adjudicator = Adjudicator(**msg["adjudication"])
+            start = time.perf_counter()
+            think_times = dict()
+            history, result, winner = play_engine_game(
+                black, white, judge, position, referee, msg.get("time_margin", 0.), adjudicator,
+                think_times)
+            reply = {
+                "type"    : "result",
+                "id"      : msg["id"],
+                "result"  : result,
+                "winner"  : None if winner is None else str(winner),
+                "history" : [ [str(c), str(v)] for c, v in history ],
+                "timing"  : make_timing(time.perf_counter() - start, think_times)
+            }
+        except OpeningError as err:
+            reply = { "type" : "opening-error", "id" : msg["id"], "error" : str(err) }
+        except GtpEngineError as err:
+            reply = { "type" : "discard", "id" : msg["id"], "error" : str(err) }
+        sleep_engines([black, white])
+        return reply
+
+    def run_slot(self, slot):
+        try:
+            sock = connect_socket(self._address)
+        except OSError as err:
+            sys.stderr.write("Fail to connect the coordinator: {}\n".format(err))
+            return
+        f = sock.makefile("rwb")
+        try:
+            while not self.is_stopped():
+                msg = recv_message(f)
+                if msg is None or msg["type"] == "stop":
+                    break
+                send_message(f, self._play(slot, msg))
+                with self._lock:
+                    self.played_games += 1
+        except Exception as err:
+            sys.stderr.write("The slot {} failed: {}\n".format(slot, err))
+        finally:
+            f.close()
+            sock.close()
+
+    def shutdown(self):
+        with self._lock:
+            engines = list(self._engines.values()) + list(self._judges.values())
+            self._engines.clear()
+            self._judges.clear()
+        for e in engines:
+            e.quit_and_shutdown()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._reactor is not None:
+            self._reactor.stop()
+
+def command_loop(is_alive, stop_fn, show_fn):
+    # Poll the control commands until is_alive() is false.
+    stdin_open = True
+    while is_alive():
+        if not stdin_open:
+            time.sleep(0.5)
+            continue
+        rlist, _, _ = select.select([sys.stdin], [], [], 0.5)
+        if rlist:
+            line = sys.stdin.readline()
+            if len(line) == 0:
+                stdin_open = False # EOF
+                continue
+            line = line.strip()
+            if line in ["stop", "quit"]:
+                print("Stop the match loop after the current games.")
+                stop_fn()
+            elif line == "show":
+                show_fn()
+            else:
+                print("Unknown command.")
+
 def match_loop(args):
     info = str()
     info += "Start the match loop...\n"
@@ -455,24 +1593,53 @@ def match_loop(args):
     print(info, end="")
 
     m = MatchTool(args)
-    while m.is_running():
-        rlist, _, _ = select.select([sys.stdin], [], [], 0)
-        if rlist:
-            line = sys.stdin.readline().strip()
-            if line in ["stop", "quit"]:
-                break
-            elif line == "show":
-                m.print_match_result()
-            else:
-                print("Unknown command.")
-        m.play_game()
-        if m.played_games % 100 == 0:
-            print("Played {} games.".format(m.played_games))
+    if args.coordinator is not None:
+        coordinator = MatchCoordinator(m, args.coordinator)
+        print("Wait for the workers on {}.".format(args.coordinator))
+        command_loop(
+            lambda: m.is_running() or m.running_games() > 0,
+            m.stop, m.print_match_result)
+        coordinator.shutdown()
+    else:
+        slots = list()
+        for i in range(m.concurrency):
+            t = threading.Thread(target=m.run_slot, args=(i,), daemon=True)
+            t.start()
+            slots.append(t)
+        command_loop(
+            lambda: any([ t.is_alive() for t in slots ]),
+            m.stop, m.print_match_result)
+        for t in slots:
+            t.join()
 
     m.print_match_result()
+    m.dump_latency(force=True)
     m.shutdown()
     print("Finished...")
 
+def worker_loop(args):
+    info = str()
+    info += "Start the worker...\n"
+    info += "Please enter the following commands to control the worker,\n"
+    info += "\tquit: leave after the current games\n"
+    info += "\tshow: print the number of played games\n"
+    print(info, end="")
+
+    w = MatchWorker(args)
+    slots = list()
+    for i in range(w.concurrency):
+        t = threading.Thread(target=w.run_slot, args=(i,), daemon=True)
+        t.start()
+        slots.append(t)
+    command_loop(
+        lambda: any([ t.is_alive() for t in slots ]),
+        w.stop, lambda: print("Played {} games.".format(w.played_games)))
+    for t in slots:
+        t.join()
+    print("Played {} games.".format(w.played_games))
+    w.shutdown()
+    print("Finished...")
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-e", "--engines",
@@ -485,6 +1652,26 @@ if __name__ == '__main__':
                         metavar="<path-to-SGF>",
                         default=None,
                         help="Load the SGF file from here.")
+    parser.add_argument("--opening-archive",
+                        type=str,
+                        metavar="<path>",
+                        default=None,
+                        help="Sample the openings from this game archive too. See archive_tool.py.")
+    parser.add_argument("--results-db",
+                        type=str,
+                        metavar="<path>",
+                        default=None,
+                        help="Record every game to this SQLite database. See results_tool.py for the queries.")
+    parser.add_argument("--write-queue",
+                        type=int,
+                        metavar="<int>",
+                        default=4096,
+                        help="The max number of pending writes of the SGF and result files.")
+    parser.add_argument("--fsync-interval",
+                        type=float,
+                        metavar="<float>",
+                        default=None,
+                        help="Fsync the SGF and result files at most every this number of seconds. Zero syncs every write batch. Never by default.")
     parser.add_argument("--save-dir",
                         type=str,
                         metavar="<save-path>",
@@ -509,7 +1696,7 @@ if __name__ == '__main__':
                         type=int,
                         metavar="<int>",
                         default=None,
-                        help="Stop the loop after playing this number of games.")
+                        help="Stop the loop after playing this number of games. The resumed games count.")
     parser.add_argument("--k-decay-factor",
                         type=float,
                         metavar="<float>",
@@ -520,8 +1707,128 @@ if __name__ == '__main__':
                         metavar="<float>",
                         default=400.0,
                         help="")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        metavar="<int>",
+                        default=1,
+                        help="Play this number of games concurrently. Every game slot has its own engines and judge.")
+    parser.add_argument("--coordinator",
+                        type=str,
+                        metavar="<address>",
+                        default=None,
+                        help="Schedule the games for the workers which connect to this address, <host>:<port> or unix:<path>.")
+    parser.add_argument("--worker",
+                        type=str,
+                        metavar="<address>",
+                        default=None,
+                        help="Play the games assigned by the coordinator at this address. Use --concurrency for the number of slots.")
+    parser.add_argument("--referee",
+                        action="store_true",
+                        default=False,
+                        help="Validate the moves with the built-in Go rules (positional superko) instead of the judge engine. The judge only scores the finished games.")
+    parser.add_argument("--scoring",
+                        type=str,
+                        choices=["judge", "tromp-taylor", "chinese"],
+                        default="judge",
+                        help="Score the games with the judge engine or the built-in area scoring. The chinese scoring removes the stones which both players list as dead. The built-in scoring implies --referee and needs no judge engine.")
+    parser.add_argument("--sprt",
+                        type=str,
+                        metavar="<name>,<name>",
+                        default=None,
+                        help="Only play the two engines and stop when the SPRT of the first one against the second one finishes.")
+    parser.add_argument("--sprt-elo0",
+                        type=float,
+                        metavar="<float>",
+                        default=0.,
+                        help="The Elo difference of the SPRT null hypothesis.")
+    parser.add_argument("--sprt-elo1",
+                        type=float,
+                        metavar="<float>",
+                        default=5.,
+                        help="The Elo difference of the SPRT alternative hypothesis.")
+    parser.add_argument("--sprt-alpha",
+                        type=float,
+                        metavar="<float>",
+                        default=0.05,
+                        help="The SPRT false positive rate.")
+    parser.add_argument("--sprt-beta",
+                        type=float,
+                        metavar="<float>",
+                        default=0.05,
+                        help="The SPRT false negative rate.")
+    parser.add_argument("--sprt-model",
+                        type=str,
+                        choices=["trinomial", "pentanomial"],
+                        default="trinomial",
+                        help="Count the single games or the game pairs which play the same opening with swapped colors.")
+    parser.add_argument("--time-margin",
+                        type=float,
+                        metavar="<float>",
+                        default=0.5,
+                        help="Don't charge this number of seconds of every move to the clock. It covers the pipe and the process overhead.")
+    parser.add_argument("--adjudicate-score",
+                        type=float,
+                        metavar="<float>",
+                        default=None,
+                        help="The side which is behind by this number of points resigns if the score estimate stays for --adjudicate-plies plies.")
+    parser.add_argument("--adjudicate-draw",
+                        type=float,
+                        metavar="<float>",
+                        default=None,
+                        help="The game is a draw if the score estimate stays within this number of points for --adjudicate-plies plies.")
+    parser.add_argument("--adjudicate-plies",
+                        type=int,
+                        metavar="<int>",
+                        default=10,
+                        help="The number of consecutive plies of the adjudication.")
+    parser.add_argument("--adjudicate-source",
+                        type=str,
+                        choices=["judge", "engines"],
+                        default="judge",
+                        help="Estimate the score with the judge or the players. Use estimate_score, or final_score if it is not supported.")
+    parser.add_argument("--max-moves",
+                        type=int,
+                        metavar="<int>",
+                        default=None,
+                        help="Score the game when it reaches this number of moves, including the opening.")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        default=False,
+                        help="Rebuild the Elo ratings and the results from the journal in the --save-dir, then continue the match.")
+    parser.add_argument("--pairing",
+                        type=str,
+                        choices=["elo", "info-gain"],
+                        default="elo",
+                        help="Sample the opponent by the Elo difference or pick the one which most reduces the rating uncertainty.")
+    parser.add_argument("--reactor",
+                        action="store_true",
+                        default=False,
+                        help="Drive all engine pipes with one selector thread instead of three threads per engine.")
+    parser.add_argument("--pool-spares",
+                        type=int,
+                        metavar="<int>",
+                        default=0,
+                        help="Keep this number of warm spare processes for each lazy engine.")
+    parser.add_argument("--pool-memory-mb",
+                        type=int,
+                        metavar="<int>",
+                        default=None,
+                        help="The memory cap of the resident spare processes in MB.")
+    parser.add_argument("--latency-dump",
+                        type=str,
+                        metavar="<path>",
+                        default=None,
+                        help="Dump the GTP latency histograms here. Use the Prometheus text format for .prom file, JSON otherwise.")
+    parser.add_argument("--latency-interval",
+                        type=int,
+                        metavar="<int>",
+                        default=10,
+                        help="Dump the GTP latency after playing this number of games.")
     args = parser.parse_args()
 
+    if args.worker is not None:
+        worker_loop(args)
+        exit()
     if args.engines is None:
         print("Please give the engines json file.")
         exit()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import time
+from core.results_db import ResultsDB
+
+def show_engines(db, args):
+    rows = db.engine_stats(args.engine)
+    print("{} games".format(db.num_games()))
+    print("[ name ] : [ games ] -> [ W/D/L ] [ black W/games ] [ white W/games ]")
+    for name, games, wins, draws, losses, b_games, b_wins, w_games, w_wins in rows:
+        print("{} : {} -> ({}/{}/{}) ({}/{}) ({}/{})".format(
+                  name, games, wins, draws, losses, b_wins, b_games, w_wins, w_games))
+
+def show_pairs(db, args):
+    rows = db.pair_stats(args.engine, args.opponent)
+    print("[ {} vs ] : [ games ] -> [ W/D/L ] [ avg moves ] [ avg sec ]".format(args.engine))
+    for opponent, games, wins, draws, losses, moves, duration in rows:
+        print("{} : {} -> ({}/{}/{}) {:.1f} {:.1f}".format(
+                  opponent, games, wins, draws, losses, moves, duration))
+
+def show_games(db, args):
+    def fmt_sec(sec):
+        return "-" if sec is None else "{:.1f}".format(sec)
+
+    for g in db.games(args.engine, args.opponent, args.limit):
+        opening = "-"
+        if g["opening"] is not None:
+            opening = "{}@{}".format(g["opening"], g["symmetry"])
+        print("#{} {} {}(B) vs {}(W) {} moves={} time={}/{} sec opening={}".format(
+                  g["id"],
+                  time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(g["finished"])),
+                  g["black"], g["white"], g["result"], g["moves"],
+                  fmt_sec(g["black_time"]), fmt_sec(g["white_time"]), opening))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database",
+                        type=str,
+                        metavar="<path>",
+                        help="The results database of match_tool.py --results-db.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    engines_parser = subparsers.add_parser("engines", help="The W/D/L of every engine.")
+    engines_parser.add_argument("engine",
+                                type=str,
+                                nargs="?",
+                                metavar="<name>",
+                                default=None,
+                                help="Only show this engine.")
+
+    pairs_parser = subparsers.add_parser("pairs", help="The W/D/L of one engine against each opponent.")
+    pairs_parser.add_argument("engine",
+                              type=str,
+                              metavar="<name>",
+                              help="The engine.")
+    pairs_parser.add_argument("opponent",
+                              type=str,
+                              nargs="?",
+                              metavar="<name>",
+                              default=None,
+                              help="Only show this opponent.")
+
+    games_parser = subparsers.add_parser("games", help="The latest games.")
+    games_parser.add_argument("--engine",
+                              type=str,
+                              metavar="<name>",
+                              default=None,
+                              help="Only the games of this engine.")
+    games_parser.add_argument("--opponent",
+                              type=str,
+                              metavar="<name>",
+                              default=None,
+                              help="Only the games against this opponent. Need the --engine.")
+    games_parser.add_argument("-n", "--limit",
+                              type=int,
+                              metavar="<int>",
+                              default=20,
+                              help="The number of games.")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        sys.stderr.write("The database {} does not exist.\n".format(args.database))
+        sys.exit(1)
+    db = ResultsDB(args.database, readonly=True)
+    if args.command == "pairs":
+        show_pairs(db, args)
+    elif args.command == "games":
+        if args.opponent is not None and args.engine is None:
+            parser.error("--opponent needs the --engine.")
+        show_games(db, args)
+    else:
+        if args.command is None:
+            args.engine = None
+        show_engines(db, args)
+    db.close()